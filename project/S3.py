@@ -12,13 +12,20 @@
 import base64
 import hmac
 import httplib
+import hashlib
+import Queue
 import re
 import sha
+import socket
 import sys
+import threading
 import time
 import urllib
 import urlparse
 import xml.sax
+from xml.sax.saxutils import escape
+
+import tracing
 
 DEFAULT_HOST = 's3.amazonaws.com'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
@@ -75,6 +82,20 @@ def canonical_string(method, bucket="", key="", query_args={}, headers={}, expir
         buf += "?logging"
     elif query_args.has_key("location"):
         buf += "?location"
+    elif query_args.has_key("delete"):
+        buf += "?delete"
+    else:
+        # multipart upload and response override subresources, signed with
+        # their values, sorted by name
+        subresources = []
+        for name in ('partNumber', 'response-content-disposition', 'uploadId', 'uploads'):
+            if query_args.has_key(name):
+                if query_args[name] is None:
+                    subresources.append(name)
+                else:
+                    subresources.append('%s=%s' % (name, query_args[name]))
+        if subresources:
+            buf += "?" + "&".join(subresources)
 
     return buf
 
@@ -141,9 +162,77 @@ class Location:
 
 
 
+# keeps idle keep-alive connections per (is_secure, host), so consecutive
+# requests to the same host do not each pay for a new tcp (and ssl) handshake.
+# safe to share between threads, a connection is only ever used by one
+# request at a time.
+class ConnectionPool:
+    def __init__(self, max_idle_per_host=10):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    # returns (connection, is_reused).  timeout is in seconds, for connecting
+    # and for every read, None to wait forever.
+    def get(self, is_secure, host, timeout=None):
+        self.lock.acquire()
+        try:
+            connections = self.idle.get((is_secure, host))
+            if connections:
+                connection = connections.pop()
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+        finally:
+            self.lock.release()
+        if is_secure:
+            return httplib.HTTPSConnection(host, timeout=timeout), False
+        return httplib.HTTPConnection(host, timeout=timeout), False
+
+    # call once the response has been read completely
+    def release(self, is_secure, host, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault((is_secure, host), [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+# shared by all AWSAuthConnections which are not given a pool of their own
+default_pool = ConnectionPool()
+
+# errors which mean a reused keep-alive connection was closed by the server
+# while it was idle
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error)
+
+# S3 takes at most this many keys in one multi-object delete
+MAX_DELETE_KEYS = 1000
+
+
+# timeout is in seconds, for connecting and for every read of a response,
+# None to wait forever.
 class AWSAuthConnection:
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN, pool=None,
+            timeout=None):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
@@ -154,6 +243,8 @@ class AWSAuthConnection:
         self.server = server
         self.port = port
         self.calling_format = calling_format
+        self.pool = pool or default_pool
+        self.timeout = timeout
 
     def create_bucket(self, bucket, headers={}):
         return Response(self._make_request('PUT', bucket, '', {}, headers))
@@ -173,6 +264,49 @@ class AWSAuthConnection:
     def list_bucket(self, bucket, options={}, headers={}):
         return ListBucketResponse(self._make_request('GET', bucket, '', options, headers))
 
+    # yields a ListEntry for every key starting with prefix and after marker,
+    # in key order, following the pages of the listing.  each page is read in
+    # chunks of chunk_size bytes and fed to an incremental parser, and entries
+    # are yielded as soon as they are parsed, so walking a bucket takes the
+    # same memory however many keys it has.  raises S3Error when a page fails,
+    # the walk can be resumed with the last key seen as marker.
+    def iter_bucket(self, bucket, prefix='', marker='', page_size=1000, chunk_size=64 * 1024):
+        while True:
+            options = {'prefix': prefix, 'max-keys': page_size}
+            if marker:
+                options['marker'] = marker
+            resp = self._make_request('GET', bucket, '', options, {})
+            if resp.status >= 300:
+                raise S3Error(Response(resp).message)
+            handler = ListBucketHandler()
+            parser = xml.sax.make_parser()
+            parser.setContentHandler(handler)
+            finished = False
+            try:
+                while True:
+                    chunk = resp.read(chunk_size)
+                    if not chunk:
+                        break
+                    parser.feed(chunk)
+                    entries, handler.entries = handler.entries, []
+                    for entry in entries:
+                        marker = entry.key
+                        yield entry
+                parser.close()
+                for entry in handler.entries:
+                    marker = entry.key
+                    yield entry
+                finished = True
+            finally:
+                # a page left half read can not be followed by another request
+                if finished:
+                    resp.release()
+                else:
+                    resp.discard()
+            if not handler.is_truncated:
+                return
+            marker = handler.next_marker or marker
+
     def delete_bucket(self, bucket, headers={}):
         return Response(self._make_request('DELETE', bucket, '', {}, headers))
 
@@ -198,6 +332,54 @@ class AWSAuthConnection:
         return Response(
                 self._make_request('DELETE', bucket, key, {}, headers))
 
+    # deletes many keys with one request per MAX_DELETE_KEYS keys, using the
+    # multi-object delete.  returns a DeleteObjectsResponse per request.
+    def delete_objects(self, bucket, keys, quiet=True, headers={}):
+        responses = []
+        keys = list(keys)
+        for start in range(0, len(keys), MAX_DELETE_KEYS):
+            body = '<?xml version="1.0" encoding="UTF-8"?><Delete>'
+            if quiet:
+                body += '<Quiet>true</Quiet>'
+            for key in keys[start:start + MAX_DELETE_KEYS]:
+                body += '<Object><Key>%s</Key></Object>' % escape(key)
+            body += '</Delete>'
+            final_headers = headers.copy()
+            final_headers['Content-MD5'] = base64.encodestring(hashlib.md5(body).digest()).strip()
+            final_headers['Content-Type'] = 'application/xml'
+            responses.append(DeleteObjectsResponse(
+                    self._make_request('POST', bucket, '', { 'delete': None }, final_headers, body)))
+        return responses
+
+    # multipart upload: initiate, upload the parts (each at least 5MB but the
+    # last), then complete with the etags of the parts.  see MultipartUploader.
+    def initiate_multipart_upload(self, bucket, key, headers={}, metadata={}):
+        return InitiateMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploads': None }, headers, '', metadata))
+
+    def upload_part(self, bucket, key, upload_id, part_number, data, headers={}):
+        return Response(
+                self._make_request(
+                    'PUT',
+                    bucket,
+                    key,
+                    { 'partNumber': part_number, 'uploadId': upload_id },
+                    headers,
+                    data))
+
+    # parts is a list of (part_number, etag)
+    def complete_multipart_upload(self, bucket, key, upload_id, parts, headers={}):
+        body = '<CompleteMultipartUpload>'
+        for part_number, etag in sorted(parts):
+            body += '<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % (part_number, escape(etag))
+        body += '</CompleteMultipartUpload>'
+        return CompleteMultipartUploadResponse(
+                self._make_request('POST', bucket, key, { 'uploadId': upload_id }, headers, body))
+
+    def abort_multipart_upload(self, bucket, key, upload_id, headers={}):
+        return Response(
+                self._make_request('DELETE', bucket, key, { 'uploadId': upload_id }, headers))
+
     def get_bucket_logging(self, bucket, headers={}):
         return GetResponse(self._make_request('GET', bucket, '', { 'logging': None }, headers))
 
@@ -233,6 +415,10 @@ class AWSAuthConnection:
     # end public methods
 
     def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+        with tracing.span('s3', method = method, bucket = bucket, key = key):
+            return self._send_request(method, bucket, key, query_args, headers, data, metadata)
+
+    def _send_request(self, method, bucket, key, query_args, headers, data, metadata):
 
         server = ''
         if bucket == '':
@@ -263,25 +449,20 @@ class AWSAuthConnection:
         is_secure = self.is_secure
         host = "%s:%d" % (server, self.port)
         while True:
-            if (is_secure):
-                connection = httplib.HTTPSConnection(host)
-            else:
-                connection = httplib.HTTPConnection(host)
-
             final_headers = merge_meta(headers, metadata);
             # add auth header
             self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
 
-            connection.request(method, path, data, final_headers)
-            resp = connection.getresponse()
+            resp = self._send(is_secure, host, method, path, data, final_headers)
             if resp.status < 300 or resp.status >= 400:
                 return resp
             # handle redirect
             location = resp.getheader('location')
             if not location:
                 return resp
-            # (close connection)
+            # (give the connection back)
             resp.read()
+            resp.release()
             scheme, host, path, params, query, fragment \
                     = urlparse.urlparse(location)
             if scheme == "http":    is_secure = True
@@ -290,6 +471,28 @@ class AWSAuthConnection:
             if query: path += "?" + query
             # retry with redirect
 
+    # sends the request on a pooled connection.  a reused connection may have
+    # been closed by the server while idle, then the request is sent once more
+    # on a new connection.  the response has a release() method which gives the
+    # connection back to the pool, call it once the body has been read, and
+    # discard() which closes the connection, when it has not.
+    def _send(self, is_secure, host, method, path, data, headers):
+        while True:
+            connection, is_reused = self.pool.get(is_secure, host, self.timeout)
+            try:
+                connection.request(method, path, data, headers)
+                resp = connection.getresponse()
+            except STALE_CONNECTION_ERRORS, e:
+                connection.close()
+                # a timeout is a slow server, not a stale connection
+                if is_reused and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            pool = self.pool
+            resp.release = lambda: pool.release(is_secure, host, connection, resp)
+            resp.discard = connection.close
+            return resp
+
     def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
         if not headers.has_key('Date'):
             headers['Date'] = time.strftime("%a, %d %b %Y %X GMT", time.gmtime())
@@ -354,8 +557,8 @@ class QueryStringAuthGenerator:
                 {},
                 merge_meta(headers, object.metadata))
 
-    def get(self, bucket, key, headers={}):
-        return self.generate_url('GET', bucket, key, {}, headers)
+    def get(self, bucket, key, headers={}, expires=None):
+        return self.generate_url('GET', bucket, key, {}, headers, expires)
 
     def delete(self, bucket, key, headers={}):
         return self.generate_url('DELETE', bucket, key, {}, headers)
@@ -386,9 +589,13 @@ class QueryStringAuthGenerator:
         full_url = self.generate_url(self, bucket, key)
         return full_url[:full_url.index('?')]
 
-    def generate_url(self, method, bucket='', key='', query_args={}, headers={}):
-        expires = 0
-        if self.__expires_in != None:
+    # expires, when given, is the time the url expires at, and overrides
+    # set_expires_in and set_expires.  this way threads sharing a generator
+    # can each sign with their own expiry time.
+    def generate_url(self, method, bucket='', key='', query_args={}, headers={}, expires=None):
+        if expires != None:
+            expires = int(expires)
+        elif self.__expires_in != None:
             expires = int(time.time() + self.__expires_in)
         elif self.__expires != None:
             expires = int(self.__expires)
@@ -402,6 +609,8 @@ class QueryStringAuthGenerator:
 
         url += "/%s" % urllib.quote_plus(key)
 
+        # do not add the signature to the caller's (or the default) dict
+        query_args = query_args.copy()
         query_args['Signature'] = encoded_canonical
         query_args['Expires'] = expires
         query_args['AWSAccessKeyId'] = self.aws_access_key_id
@@ -411,6 +620,116 @@ class QueryStringAuthGenerator:
         return url
 
 
+class S3Error(Exception):
+    pass
+
+# uploads a stream of strings (like the chunks() of a django UploadedFile) as
+# one object, in parts of part_size bytes.  parts are uploaded by a few
+# threads while the next ones are read, and a failed part is retried on its
+# own, up to retries times.  at most about 2 * threads parts are held in
+# memory at once.
+class MultipartUploader:
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, connection, bucket, key, part_size=MIN_PART_SIZE, threads=4, retries=3,
+            headers={}, metadata={}):
+        self.connection = connection
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.threads = threads
+        self.retries = retries
+        self.headers = headers
+        self.metadata = metadata
+
+    # returns the CompleteMultipartUploadResponse, raises S3Error (after
+    # aborting the upload) if a part could not be uploaded.
+    def upload(self, chunks):
+        response = self.connection.initiate_multipart_upload(self.bucket, self.key, self.headers, self.metadata)
+        if response.http_response.status >= 300:
+            raise S3Error('Could not start the upload of %s: %s' % (self.key, response.message))
+        upload_id = response.upload_id
+        parts = Queue.Queue(self.threads)
+        etags = []
+        errors = []
+        workers = [threading.Thread(target=self._upload_parts, args=(upload_id, parts, etags, errors))
+                for i in range(self.threads)]
+        for worker in workers:
+            worker.setDaemon(True)
+            worker.start()
+        try:
+            try:
+                part_number = 0
+                for part in self._parts(chunks):
+                    if errors:
+                        break
+                    part_number += 1
+                    parts.put((part_number, part))
+            finally:
+                for worker in workers:
+                    parts.put(None)
+                for worker in workers:
+                    worker.join()
+        except Exception:
+            # reading the chunks failed, do not leave the parts stored
+            self.connection.abort_multipart_upload(self.bucket, self.key, upload_id)
+            raise
+        if errors:
+            self.connection.abort_multipart_upload(self.bucket, self.key, upload_id)
+            raise S3Error('Could not upload part %s of %s: %s' % errors[0])
+        response = self.connection.complete_multipart_upload(self.bucket, self.key, upload_id, etags)
+        if response.error:
+            self.connection.abort_multipart_upload(self.bucket, self.key, upload_id)
+            raise S3Error('Could not complete the upload of %s: %s' % (self.key, response.error))
+        return response
+
+    # regroups the chunks into parts of part_size, the last one may be smaller
+    def _parts(self, chunks):
+        buffered = []
+        size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            while size >= self.part_size:
+                data = ''.join(buffered)
+                yield data[:self.part_size]
+                buffered = [data[self.part_size:]]
+                size -= self.part_size
+        if size or not buffered:
+            yield ''.join(buffered)
+
+    def _upload_parts(self, upload_id, parts, etags, errors):
+        while True:
+            item = parts.get()
+            if item is None:
+                return
+            part_number, data = item
+            if errors:
+                continue
+            # any other error fails the upload too, a worker which died would
+            # leave the parts queue full and upload() waiting on it forever
+            try:
+                self._upload_part(upload_id, part_number, data, etags, errors)
+            except Exception, e:
+                errors.append((part_number, self.key, '%s: %s' % (e.__class__.__name__, e)))
+
+    def _upload_part(self, upload_id, part_number, data, etags, errors):
+        message = ''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                response = self.connection.upload_part(self.bucket, self.key, upload_id, part_number, data)
+            except (socket.error, httplib.HTTPException), e:
+                message = str(e)
+                continue
+            etag = response.http_response.getheader('etag')
+            if response.http_response.status < 300 and etag:
+                etags.append((part_number, etag))
+                return
+            message = response.message
+        errors.append((part_number, self.key, message))
+
 class S3Object:
     def __init__(self, data, metadata={}):
         self.data = data
@@ -445,6 +764,8 @@ class Response:
         # you have to do this read, even if you don't expect a body.
         # otherwise, the next request fails.
         self.body = http_response.read()
+        if hasattr(http_response, 'release'):
+            http_response.release()
         if http_response.status >= 300 and self.body:
             self.message = self.body
         else:
@@ -470,6 +791,41 @@ class ListBucketResponse(Response):
         else:
             self.entries = []
 
+class DeleteObjectsResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        if http_response.status < 300:
+            handler = DeleteResultHandler()
+            xml.sax.parseString(self.body, handler)
+            self.deleted = handler.deleted
+            self.errors = handler.errors
+        else:
+            self.deleted = []
+            self.errors = []
+
+class InitiateMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.upload_id = None
+        if http_response.status < 300:
+            handler = ValuesHandler()
+            xml.sax.parseString(self.body, handler)
+            self.upload_id = handler.values.get('UploadId')
+
+# s3 may answer a complete request with 200 and still fail, with an Error
+# document as the body.  error is the message then, else None.
+class CompleteMultipartUploadResponse(Response):
+    def __init__(self, http_response):
+        Response.__init__(self, http_response)
+        self.error = None
+        if http_response.status >= 300:
+            self.error = self.message
+        elif self.body:
+            handler = ValuesHandler()
+            xml.sax.parseString(self.body, handler)
+            if handler.root == 'Error':
+                self.error = '%s %s' % (handler.values.get('Code'), handler.values.get('Message'))
+
 class ListAllMyBucketsResponse(Response):
     def __init__(self, http_response):
         Response.__init__(self, http_response)
@@ -572,6 +928,53 @@ class ListBucketHandler(xml.sax.ContentHandler):
         self.curr_text += content
 
 
+# deleted is the list of deleted keys (empty in quiet mode), errors a list of
+# (key, code, message) for the keys which could not be deleted
+class DeleteResultHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.deleted = []
+        self.errors = []
+        self.curr_values = {}
+        self.curr_text = ''
+
+    def startElement(self, name, attrs):
+        if name in ('Deleted', 'Error'):
+            self.curr_values = {}
+        self.curr_text = ''
+
+    def endElement(self, name):
+        if name == 'Deleted':
+            self.deleted.append(self.curr_values.get('Key', ''))
+        elif name == 'Error':
+            self.errors.append((self.curr_values.get('Key', ''), self.curr_values.get('Code', ''), self.curr_values.get('Message', '')))
+        else:
+            self.curr_values[name] = self.curr_text
+        self.curr_text = ''
+
+    def characters(self, content):
+        self.curr_text += content
+
+
+# collects the text of the (leaf) elements of a small document by name
+class ValuesHandler(xml.sax.ContentHandler):
+    def __init__(self):
+        self.root = None
+        self.values = {}
+        self.curr_text = ''
+
+    def startElement(self, name, attrs):
+        if self.root is None:
+            self.root = name
+        self.curr_text = ''
+
+    def endElement(self, name):
+        self.values.setdefault(name, self.curr_text)
+        self.curr_text = ''
+
+    def characters(self, content):
+        self.curr_text += content
+
+
 class ListAllMyBucketsHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.entries = []
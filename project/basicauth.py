@@ -1,18 +1,71 @@
 
 #Copied from djangosnippets
 import base64
+import hashlib
+import hmac
+import time
 
+from django.conf import settings
 from django.http import HttpResponse
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.models import User
+
+import defaults
+from lrucache import LRUCache
+import telemetry
 
 #############################################################################
 #
-def view_or_basicauth(view, request, test_func, realm = "", *args, **kwargs):
+# Checking a password with PBKDF2 takes tens of milliseconds, and feed readers
+# send theirs with every poll. Credentials which were checked are remembered
+# for defaults.basicauth_cache_ttl seconds, under a keyed hash of the header,
+# so the passwords themselves are not kept in memory. An entry is only used
+# while the user still has the same password hash, so changing the password
+# ends it at once. It keeps the backend which authenticated the user too, for
+# login() and get_user().
+_verified = LRUCache(defaults.basicauth_cache_size)
+telemetry.watch_cache('basicauth', _verified)
+
+def credentials_key(header):
+    return hmac.new(settings.SECRET_KEY, header, hashlib.sha256).hexdigest()
+
+def authenticate_header(header):
+    """Returns the active user whose basic auth credentials are in header, or None."""
+    key = credentials_key(header)
+    cached = _verified.get(key)
+    if cached is not None:
+        user_id, backend, password, expires = cached
+        if expires > time.time():
+            try:
+                user = User.objects.get(id = user_id)
+            except User.DoesNotExist:
+                user = None
+            if user is not None and user.password == password and user.is_active:
+                user.backend = backend
+                return user
+        _verified.delete(key)
+    try:
+        uname, passwd = base64.b64decode(header).split(':', 1)
+    except (TypeError, ValueError):
+        return None
+    user = authenticate(username=uname, password=passwd)
+    if user is None or not user.is_active:
+        return None
+    _verified.set(key, (user.id, user.backend, user.password, time.time() + defaults.basicauth_cache_ttl))
+    return user
+
+#############################################################################
+#
+def view_or_basicauth(view, request, test_func, realm = "", sessionless = False, *args, **kwargs):
     """
     This is a helper function used by both 'logged_in_or_basicauth' and
     'has_perm_or_basicauth' that does the nitty of determining if they
     are already logged in or if they have provided proper http-authorization
     and returning the view if all goes well, otherwise responding with a 401.
+
+    With sessionless, a user authenticated by the header is not logged in,
+    so no session is written. Clients sending credentials every time, like
+    feed readers, do not need one.
     """
     if test_func(request.user):
         # Already logged in, just return the view.
@@ -27,13 +80,12 @@ def view_or_basicauth(view, request, test_func, realm = "", *args, **kwargs):
             # NOTE: We are only support basic authentication for now.
             #
             if auth[0].lower() == "basic":
-                uname, passwd = base64.b64decode(auth[1]).split(':')
-                user = authenticate(username=uname, password=passwd)
-                if user is not None:
-                    if user.is_active:
+                user = authenticate_header(auth[1])
+                if user is not None and test_func(user):
+                    if not sessionless:
                         login(request, user)
-                        request.user = user
-                        return view(request, *args, **kwargs)
+                    request.user = user
+                    return view(request, *args, **kwargs)
 
     # Either they did not provide an authorization header or
     # something in the authorization attempt failed. Send a 401
@@ -46,7 +98,7 @@ def view_or_basicauth(view, request, test_func, realm = "", *args, **kwargs):
     
 #############################################################################
 #
-def logged_in_or_basicauth(realm = ""):
+def logged_in_or_basicauth(realm = "", sessionless = False):
     """
     A simple decorator that requires a user to be logged in. If they are not
     logged in the request is examined for a 'authorization' header.
@@ -73,19 +125,20 @@ def logged_in_or_basicauth(realm = ""):
     def your_view:
         ...
 
-    You can provide the name of the realm to ask for authentication within.
+    You can provide the name of the realm to ask for authentication within,
+    and ask for sessionless authentication, see view_or_basicauth.
     """
     def view_decorator(func):
         def wrapper(request, *args, **kwargs):
             return view_or_basicauth(func, request,
                                      lambda u: u.is_authenticated(),
-                                     realm, *args, **kwargs)
+                                     realm, sessionless, *args, **kwargs)
         return wrapper
     return view_decorator
 
 #############################################################################
 #
-def has_perm_or_basicauth(perm, realm = ""):
+def has_perm_or_basicauth(perm, realm = "", sessionless = False):
     """
     This is similar to the above decorator 'logged_in_or_basicauth'
     except that it requires the logged in user to have a specific
@@ -102,6 +155,6 @@ def has_perm_or_basicauth(perm, realm = ""):
         def wrapper(request, *args, **kwargs):
             return view_or_basicauth(func, request,
                                      lambda u: u.has_perm(perm),
-                                     realm, *args, **kwargs)
+                                     realm, sessionless, *args, **kwargs)
         return wrapper
     return view_decorator
@@ -4,14 +4,14 @@ from django.forms import widgets
 from django.contrib.auth.models import User
 
 import re
+import hashlib
 
 from models import *
 from django.utils.translation import ugettext as _
 from dojofields import *
 import prefs.models as pmodel
 import datetime
-import S3
-import secrets
+import storage
 import defaults
 
 
@@ -107,31 +107,55 @@ class InviteUserForm(MarkedForm):
         invite.save()
         return invite
         
+def user_choices(project):
+    """Choices for the user fields of the forms of project."""
+    users = [subs.user for subs in project.subscribeduser_set.select_related('user')]
+    return [('None','None')] + [(user.username, user.username) for user in users]
+
+def task_choices(project):
+    """Choices for the task fields of the forms of project."""
+    return list(project.task_set.values_list('number', 'name'))
+
+def users_by_name(usernames):
+    """The users with these usernames, by username, from one query. 'None' is not a user."""
+    usernames = set(usernames) - set(['None'])
+    return dict((user.username, user) for user in User.objects.filter(username__in = usernames))
+
 class CreateTaskForm(MarkedForm):
-    """Create a top level task."""
+    """Create a top level task.
+    user_choices: The choices of user_responsible, when they were computed already, see FormCollection."""
     name = DojoCharField(max_length = 200, help_text='Name of the task')
     start_date = DojoDateField(help_text = 'When will this task start?')
     end_date = DojoDateField(required = False, help_text = 'When will this task end?')
     user_responsible = DojoChoiceField(help_text = 'Who is reponsible for this task?')
     def __init__(self, project , user, *args, **kwargs):
+        choices = kwargs.pop('user_choices', None)
         super(CreateTaskForm, self).__init__(*args, **kwargs)
         self.project = project
         self.user = user
-        users = [subs.user for subs in project.subscribeduser_set.all()]
-        self.fields['user_responsible'].choices = [('None','None')] + [(user.username, user.username) for user in users]
+        if choices is None:
+            choices = user_choices(project)
+        self.fields['user_responsible'].choices = choices
+        
+    @classmethod
+    def shared_choices(self, project):
+        return {'user_choices': user_choices(project)}
         
     def clean(self):
-        if self.cleaned_data['end_date'] and self.cleaned_data['start_date'] > self.cleaned_data['end_date']:
+        start_date, end_date = self.cleaned_data.get('start_date'), self.cleaned_data.get('end_date')
+        if start_date and end_date and start_date > end_date:
             raise ValidationError('Start date can not be greater than end date')
         return super(CreateTaskForm, self).clean()
         
-    def save_without_db(self):
+    def save_without_db(self, users = None):
+        """users: The users by username, when they were looked up already."""
         task = Task(name = self.cleaned_data['name'], expected_start_date = self.cleaned_data['start_date'], )
         if self.cleaned_data['end_date']:
             task.expected_end_date = self.cleaned_data['end_date']
         if not self.cleaned_data['user_responsible'] == 'None':
-            user = User.objects.get(username = self.cleaned_data['user_responsible'])
-            task.user_responsible = user
+            if users is None:
+                users = users_by_name([self.cleaned_data['user_responsible']])
+            task.user_responsible = users[self.cleaned_data['user_responsible']]
         task.project = self.project
         task.created_by = self.user
         task.last_updated_by = self.user
@@ -176,15 +200,17 @@ class CreateTaskItemForm(MarkedForm):
         return self.cleaned_data['time']
         #return super(CreateTaskItemForm, self).clean()
         
-    def save_without_db(self):
+    def save_without_db(self, users = None):
+        """users: The users by username, when they were looked up already."""
         item = TaskItem(name = self.cleaned_data['item_name'], )
         item.project = self.project
         item.created_by = self.user
         item.last_updated_by = self.user
         item.task_num = self.task.number
         if not self.cleaned_data['user'] == 'None':
-            user = User.objects.get(username = self.cleaned_data['user'])
-            item.user = user
+            if users is None:
+                users = users_by_name([self.cleaned_data['user']])
+            item.user = users[self.cleaned_data['user']]
         item.expected_time = self.cleaned_data['time']
         item.unit = self.cleaned_data['units']
         return item
@@ -203,13 +229,21 @@ class TaskItemQuickForm(CreateTaskItemForm):
     task = forms.ChoiceField()
     
     def __init__(self, project, user, *args, **kwargs):
+        users = kwargs.pop('user_choices', None)
+        tasks = kwargs.pop('task_choices', None)
         super(MarkedForm, self).__init__(*args, **kwargs)
         self.project = project
         self.user = user
-        users = [subs.user for subs in project.subscribeduser_set.all()]
-        self.fields['user'].choices = [('None','None')] + [(user.username, user.username) for user in users]
-        tasks = [task for task in project.task_set.all()]
-        self.fields['task'].choices = [(task.number, task.name) for task in tasks]
+        if users is None:
+            users = user_choices(project)
+        if tasks is None:
+            tasks = task_choices(project)
+        self.fields['user'].choices = users
+        self.fields['task'].choices = tasks
+        
+    @classmethod
+    def shared_choices(self, project):
+        return {'user_choices': user_choices(project), 'task_choices': task_choices(project)}
          
     def save(self):
         task = self.cleaned_data['task']
@@ -218,6 +252,17 @@ class TaskItemQuickForm(CreateTaskItemForm):
         item.save()
         return item
         
+    @classmethod
+    def save_many(self, forms):
+        """Save valid forms together, looking up their users and tasks with one query each."""
+        if not forms:
+            return []
+        users = users_by_name([form.cleaned_data['user'] for form in forms])
+        tasks = current_tasks(forms[0].project.id, [int(form.cleaned_data['task']) for form in forms])
+        for form in forms:
+            form.task = tasks[int(form.cleaned_data['task'])]
+        return TaskItem.create_many([form.save_without_db(users) for form in forms], tasks)
+        
         """task = Task.objects.get(project = self.project, number = self.cleaned_data['task'])
         self.task = task
         taskitem = TaskItem(project = self.project, task = task, name = self.cleaned_data['item_name'],)
@@ -461,20 +506,33 @@ class AddFileForm(forms.Form):
         self.project = project
         self.user = user
     
-    def save(self):
-            conn = S3.AWSAuthConnection(secrets.AWS_ID, secrets.AWS_SECRET_KEY)
-            uploaded_filename = self.cleaned_data['filename'].name
+    def store(self, file_storage, uploaded):
+        """Store the uploaded content once, under its digest, and return its StoredBlob with a reference added.
+        The content is hashed before uploading, so content which is stored already is not uploaded again."""
+        digest = hashlib.sha256()
+        for chunk in uploaded.chunks():
+            digest.update(chunk)
+        digest = digest.hexdigest()
+        blob = StoredBlob.objects.reference(digest)
+        if blob is None:
+            file_storage.save(StoredBlob.key_for(digest), uploaded)
+            blob = StoredBlob.objects.create_referenced(digest, uploaded.size)
+        return blob
+    
+    def save(self, file_storage = None):
+            file_storage = file_storage or storage.get_storage()
+            uploaded = self.cleaned_data['filename']
+            uploaded_filename = uploaded.name
             filename = '/%s/%s' % (self.project, uploaded_filename)
-            content = self.cleaned_data['filename'].read()
             try:        
                 old_file = self.project.projectfile_set.get(filename = uploaded_filename)
                 versions = old_file.projectfileversion_set.all().count()
                 split_f = filename.rsplit('.', 1)
                 name_no_ext = ''.join(split_f[:-1])
                 filename = '%s-%s.%s' % (name_no_ext, versions + 1, split_f[-1])
-                response = conn.put(defaults.bucket, filename, content)
+                blob = self.store(file_storage, uploaded)
                 saved_file = old_file
-                saved_file_revision = ProjectFileVersion(file = saved_file, revision_name=filename, user = self.user, size = len(content))
+                saved_file_revision = ProjectFileVersion(file = saved_file, revision_name=filename, blob = blob, user = self.user, size = uploaded.size)
                 saved_file_revision.save()
                 saved_file.current_revision = saved_file_revision
                 saved_file.total_size += saved_file_revision.size
@@ -483,10 +541,10 @@ class AddFileForm(forms.Form):
                 split_f = filename.rsplit('.', 1)
                 name_no_ext = ''.join(split_f[:-1])
                 filename = '%s-%s.%s' % (name_no_ext, 1, split_f[-1])
-                response = conn.put(defaults.bucket, filename, content)
+                blob = self.store(file_storage, uploaded)
                 saved_file = ProjectFile(project = self.project, filename = uploaded_filename, total_size = 0)
                 saved_file.save()
-                saved_file_revision = ProjectFileVersion(file = saved_file, revision_name=filename, user = self.user, size = len(content))
+                saved_file_revision = ProjectFileVersion(file = saved_file, revision_name=filename, blob = blob, user = self.user, size = uploaded.size)
                 saved_file_revision.save()
                 saved_file.current_revision = saved_file_revision
                 saved_file.total_size = saved_file_revision.size
@@ -495,38 +553,133 @@ class AddFileForm(forms.Form):
 class AddTaskOrSubTaskForm(CreateTaskForm):
     parent_task = forms.ChoiceField()
     def __init__(self, project , user, *args, **kwargs):
+        tasks = kwargs.pop('task_choices', None)
         super(AddTaskOrSubTaskForm, self).__init__(project, user, *args, **kwargs)
-        tasks = [task for task in project.task_set.all()]
-        self.fields['parent_task'].choices = [('None','None')] + [(task.number, task.name) for task in tasks]#[(user.username, user.username) for user in users]
+        if tasks is None:
+            tasks = task_choices(project)
+        self.fields['parent_task'].choices = [('None','None')] + tasks
     
-    def save(self):
-        task = super(AddTaskOrSubTaskForm, self).save_without_db()
+    @classmethod
+    def shared_choices(self, project):
+        return {'user_choices': user_choices(project), 'task_choices': task_choices(project)}
+    
+    def save_without_db(self, users = None, parents = None):
+        """parents: The numbers of the tasks of the project, when they were looked up already."""
+        task = super(AddTaskOrSubTaskForm, self).save_without_db(users)
         if self.cleaned_data['parent_task'] == 'None':
             task.parent_task = None
         else:
             task_num = int(self.cleaned_data['parent_task'])
-            par_task = Task.objects.get(project = self.project, number = task_num)
-            task.parent_task_num = par_task.number
+            if parents is None:
+                parents = set([Task.objects.get(project = self.project, number = task_num).number])
+            if task_num not in parents:
+                raise Task.DoesNotExist('No task %s in %s.' % (task_num, self.project))
+            task.parent_task_num = task_num
+        return task
+    
+    def save(self):
+        task = self.save_without_db()
         task.save()    
+        
+    @classmethod
+    def save_many(self, forms):
+        """Save valid forms together, looking up their users and parent tasks with one query each."""
+        if not forms:
+            return []
+        users = users_by_name([form.cleaned_data['user_responsible'] for form in forms])
+        numbers = [int(form.cleaned_data['parent_task']) for form in forms if form.cleaned_data['parent_task'] != 'None']
+        parents = set(Task.objects.filter(project = forms[0].project, number__in = numbers).values_list('number', flat = True))
+        return Task.create_many([form.save_without_db(users, parents) for form in forms])
 
+class ImportTaskForm(CreateTaskForm):
+    """A row of an imported task file, see importer. It has the columns of Task.as_csv.
+    parent: The number of an existing task, or the name of a task, which this is a sub task of. The importer looks it up."""
+    #The date fields of the task forms are text, the date picker checks them. Nothing checks a file, so these parse dates.
+    start_date = forms.DateField()
+    end_date = forms.DateField(required = False)
+    actual_start_date = forms.DateField(required = False)
+    actual_end_date = forms.DateField(required = False)
+    is_complete = forms.BooleanField(required = False)
+    parent = forms.CharField(required = False)
+    
+    def save_without_db(self, users = None):
+        task = super(ImportTaskForm, self).save_without_db(users)
+        task.actual_start_date = self.cleaned_data['actual_start_date']
+        task.actual_end_date = self.cleaned_data['actual_end_date']
+        task.is_complete = self.cleaned_data['is_complete']
+        return task
+        
+class ImportTaskItemForm(CreateTaskItemForm):
+    """A row of an imported task item file, see importer. It has the columns of TaskItem.as_csv.
+    task: Number of the task of the item. The importer looks the tasks up and sets self.task, before saving."""
+    task = forms.IntegerField()
+    is_complete = forms.BooleanField(required = False)
+    
+    def __init__(self, project, user, *args, **kwargs):
+        choices = kwargs.pop('user_choices', None)
+        super(MarkedForm, self).__init__(*args, **kwargs)
+        self.project = project
+        self.user = user
+        if choices is None:
+            choices = user_choices(project)
+        self.fields['user'].choices = choices
+        
+    def save_without_db(self, users = None):
+        item = super(ImportTaskItemForm, self).save_without_db(users)
+        item.is_complete = self.cleaned_data['is_complete']
+        return item
+        
+class ImportForm(forms.Form):
+    """Upload a csv file of tasks or task items to import."""
+    file = forms.FileField(help_text = 'A csv file, like the ones the task pages export.')
+    task = forms.IntegerField(required = False, help_text = 'Number of the task the items are for, when the file has no Task column.')
+    
+    def __init__(self, project, user, *args, **kwargs):
+        super(ImportForm, self).__init__(*args, **kwargs)
+        self.project = project
+        self.user = user
+        
+    def save(self):
+        """Import the file. Returns the importer.ImportResult."""
+        import importer
+        return importer.import_csv(self.project, self.user, self.cleaned_data['file'].chunks(), task_num = self.cleaned_data['task'])
+        
 class FormCollection:
+    """num_form forms of FormClass, to enter many objects at once. Rows left blank are skipped.
+    The choices of the forms are computed once for all of them, when FormClass has shared_choices, and the rows
+    are saved together when it has save_many."""
     def __init__(self, FormClass, attrs, num_form):
+        self.FormClass = FormClass
+        attrs = dict(attrs)
+        if hasattr(FormClass, 'shared_choices'):
+            attrs.update(FormClass.shared_choices(attrs['project']))
         self.data = []
         for i in xrange(num_form):
             self.data.append(FormClass(prefix = i, **attrs))
             
+    def is_blank(self, form):
+        """Whether nothing was entered in the row. Choice fields always have a value, so they do not count."""
+        for name, field in form.fields.items():
+            if not isinstance(field, forms.ChoiceField) and form[name].value() not in (None, ''):
+                return False
+        return True
+        
+    def filled(self):
+        return [form for form in self.data if form.is_bound and not self.is_blank(form)]
+            
     def is_valid(self):
-        "Are all the forms valid"
-        for form in self.data:
-            if form.is_bound and not form.is_valid():
+        "Are all the rows which were filled in valid"
+        for form in self.filled():
+            if not form.is_valid():
                 return False
-            return True
+        return True
             
     def save(self):
-        """Save the forms which are valid."""
-        for form in self.data:
-            if form.is_valid():
-                form.save()
+        """Save the rows which are valid."""
+        valid = [form for form in self.filled() if form.is_valid()]
+        if hasattr(self.FormClass, 'save_many'):
+            return self.FormClass.save_many(valid)
+        return [form.save() for form in valid]
                 
 class PreferencesForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,336 @@
+"""Time the queries of requests, by query and by view, and log the slow ones with their plan.
+
+QueryCountMiddleware samples defaults.query_sample_rate of the requests. While a sampled request runs, the
+cursors of the connection are wrapped in a TimedCursor, which times every query and adds it up under its
+fingerprint: the query with its parameters, numbers and strings taken out, so the same query for another row,
+or the raw sql of models.py with other numbers in it, matches. At the end of the request its queries are added
+up under its view: how many it ran, the most of one request, the time spent in the database, and the
+fingerprints which ran more than once in it, which is what a query per row of a list looks like.
+Latencies are kept in Histograms over the last two windows of defaults.query_histogram_window seconds, so
+they follow what the site does now. A query slower than defaults.slow_query_seconds is logged to the
+project.slowqueries logger, with the EXPLAIN of its first slow run in the window.
+Requests which are not sampled, and anything outside a request, use the plain cursor and cost nothing more.
+stats(), top_fingerprints() and slow_queries() have the numbers, metrics.query_stats shows them to staff,
+and last_request() has what the last request of this thread did, for the tests.
+"""
+import bisect
+import collections
+import logging
+import random
+import re
+import threading
+import time
+
+from django.db import DatabaseError
+from django.db.backends import BaseDatabaseWrapper
+
+import defaults
+from lrucache import LRUCache
+
+logger = logging.getLogger('project.slowqueries')
+
+_lock = threading.Lock()
+_views = {}
+_fingerprints = {}
+_slow = collections.deque(maxlen = defaults.slow_query_log_size)
+_local = threading.local()
+#Fingerprints of the sql the cursors were given, which repeats a lot more than it varies.
+_fingerprint_cache = LRUCache(defaults.query_fingerprint_cache_size)
+
+#Upper bounds of the buckets of the histograms, in seconds. The last bucket has everything slower.
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+#Where the queries go once defaults.query_stats_max_fingerprints are kept.
+OTHER = '(other queries)'
+
+literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+in_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+def fingerprint(sql):
+    """The query with its placeholders and literals as ?, and lists of them as (?...)."""
+    key = _fingerprint_cache.get(sql)
+    if key is None:
+        key = literal_re.sub('?', sql.replace('%s', '?'))
+        key = ' '.join(in_list_re.sub('(?...)', key).split())
+        _fingerprint_cache.set(sql, key)
+    return key
+
+def format_seconds(seconds):
+    if seconds < 1:
+        return '%gms' % (seconds * 1000)
+    return '%gs' % seconds
+
+class Histogram(object):
+    """Number of latencies in each of BUCKETS, in the current window and the one before it."""
+    def __init__(self):
+        self.window = None
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.previous = [0] * (len(BUCKETS) + 1)
+
+    def roll(self, now):
+        window = int(now // defaults.query_histogram_window)
+        if window != self.window:
+            if self.window is not None and window == self.window + 1:
+                self.previous = self.counts
+            else:
+                self.previous = [0] * (len(BUCKETS) + 1)
+            self.counts = [0] * (len(BUCKETS) + 1)
+            self.window = window
+
+    def add(self, seconds, now):
+        self.roll(now)
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def totals(self, now = None):
+        self.roll(now or time.time())
+        return [a + b for a, b in zip(self.previous, self.counts)]
+
+    def percentile(self, fraction, now = None):
+        """Label of the bucket the fraction of the latencies are within, like 20ms, or None when it is empty."""
+        totals = self.totals(now)
+        wanted = sum(totals) * fraction
+        if not wanted:
+            return None
+        seen = 0
+        for i, count in enumerate(totals):
+            seen += count
+            if seen >= wanted:
+                break
+        if i == len(BUCKETS):
+            return '>' + format_seconds(BUCKETS[-1])
+        return format_seconds(BUCKETS[i])
+
+class FingerprintStats(object):
+    """The runs of one fingerprint. example: The sql of its latest run. plan: EXPLAIN of its latest slow run."""
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.slow = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = Histogram()
+        #View to the number of runs in it.
+        self.views = {}
+        self.example = None
+        self.plan = None
+        self.plan_window = None
+
+    def add(self, sql, seconds, now, view):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.histogram.add(seconds, now)
+        if view in self.views or len(self.views) < 10:
+            self.views[view] = self.views.get(view, 0) + 1
+        self.example = sql
+
+    def p50(self):
+        return self.histogram.percentile(0.5)
+
+    def p95(self):
+        return self.histogram.percentile(0.95)
+
+    def top_views(self):
+        return sorted(self.views.items(), key = lambda item: item[1], reverse = True)
+
+class RequestQueries(object):
+    """The queries of one request, as they run."""
+    def __init__(self, view):
+        self.view = view
+        self.count = 0
+        self.seconds = 0.0
+        #Fingerprint to the number of runs.
+        self.counts = {}
+
+    def add(self, key, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    @property
+    def duplicates(self):
+        """Fingerprints which ran more than once, with the number of times."""
+        return dict((key, count) for key, count in self.counts.items() if count > 1)
+
+    def __repr__(self):
+        return '<RequestQueries %s: %s queries, %.3fs>' % (self.view, self.count, self.seconds)
+
+class ViewStats(object):
+    """The requests of one view. histogram: Of the database time per request."""
+    def __init__(self, view):
+        self.view = view
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.seconds = 0.0
+        self.histogram = Histogram()
+        #Fingerprint to the number of times it ran again, over all requests.
+        self.duplicates = {}
+
+    def add(self, record, now):
+        self.requests += 1
+        self.queries += record.count
+        self.max_queries = max(self.max_queries, record.count)
+        self.seconds += record.seconds
+        self.histogram.add(record.seconds, now)
+        for key, count in record.duplicates.items():
+            if key in self.duplicates or len(self.duplicates) < defaults.query_stats_max_fingerprints:
+                self.duplicates[key] = self.duplicates.get(key, 0) + count - 1
+
+    def average_queries(self):
+        return float(self.queries) / self.requests
+
+    def p50(self):
+        return self.histogram.percentile(0.5)
+
+    def p95(self):
+        return self.histogram.percentile(0.95)
+
+    def top_duplicates(self, n = 5):
+        """The n fingerprints which ran again the most, as (times, fingerprint)."""
+        return sorted([(count, key) for key, count in self.duplicates.items()], reverse = True)[:n]
+
+def explain(db, sql, params):
+    """The plan of a select, as text. It runs on a cursor of its own, which is not timed."""
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    prefix = db.vendor == 'sqlite' and 'EXPLAIN QUERY PLAN ' or 'EXPLAIN '
+    cursor = db._cursor()
+    try:
+        cursor.execute(prefix + sql, params)
+        return '\n'.join(' '.join(unicode(value) for value in row) for row in cursor.fetchall())
+    except DatabaseError, e:
+        return 'EXPLAIN failed: %s' % e
+    finally:
+        cursor.close()
+
+def slow_query(db, stats, sql, params, seconds, now, view):
+    window = int(now // defaults.query_histogram_window)
+    with _lock:
+        stats.slow += 1
+        explaining = stats.plan_window != window
+        stats.plan_window = window
+    if explaining:
+        stats.plan = explain(db, sql, params)
+    logger.warning('Slow query, %.3fs in %s: %s; args=%r\n%s', seconds, view, sql, params, explaining and stats.plan or '')
+    _slow.append({'time': now, 'seconds': seconds, 'view': view, 'sql': sql, 'params': repr(params)[:500]})
+
+def observe(db, sql, params, seconds):
+    current = getattr(_local, 'current', None)
+    if current is None:
+        return
+    key = fingerprint(sql)
+    current.add(key, seconds)
+    now = time.time()
+    with _lock:
+        stats = _fingerprints.get(key)
+        if stats is None:
+            if len(_fingerprints) >= defaults.query_stats_max_fingerprints:
+                key = OTHER
+            stats = _fingerprints.setdefault(key, FingerprintStats(key))
+        stats.add(sql, seconds, now, current.view)
+    if seconds >= defaults.slow_query_seconds:
+        slow_query(db, stats, sql, params, seconds, now, current.view)
+
+class TimedCursor(object):
+    def __init__(self, cursor, db):
+        self.cursor = cursor
+        self.db = db
+
+    def execute(self, sql, params = ()):
+        start = time.time()
+        result = self.cursor.execute(sql, params)
+        observe(self.db, sql, params, time.time() - start)
+        return result
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        result = self.cursor.executemany(sql, param_list)
+        observe(self.db, sql, (), time.time() - start)
+        return result
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+_plain_cursor = BaseDatabaseWrapper.cursor
+
+def timed_cursor(self):
+    cursor = _plain_cursor(self)
+    if getattr(_local, 'current', None) is None:
+        return cursor
+    return TimedCursor(cursor, self)
+
+def install():
+    """Have the connections hand out TimedCursors while this thread is timing queries."""
+    BaseDatabaseWrapper.cursor = timed_cursor
+
+def start(view = None):
+    """Time the queries of this thread, for view, until stop()."""
+    install()
+    _local.current = RequestQueries(view)
+
+def stop():
+    """Stop timing queries, add them up under their view, and return their RequestQueries."""
+    current = getattr(_local, 'current', None)
+    _local.current = None
+    if current is None:
+        return None
+    if current.view is not None:
+        now = time.time()
+        with _lock:
+            if current.view not in _views:
+                _views[current.view] = ViewStats(current.view)
+            _views[current.view].add(current, now)
+    _local.last = current
+    return current
+
+def stats():
+    """ViewStats of every view which has served a request, busiest in the database first."""
+    with _lock:
+        return sorted(_views.values(), key = lambda s: s.seconds, reverse = True)
+
+def top_fingerprints(n = 20):
+    """FingerprintStats of the n queries which took the most time."""
+    with _lock:
+        return sorted(_fingerprints.values(), key = lambda s: s.seconds, reverse = True)[:n]
+
+def slow_queries():
+    """The latest slow queries, newest first, as {'time', 'seconds', 'view', 'sql', 'params'}."""
+    return list(reversed(_slow))
+
+def reset():
+    with _lock:
+        _views.clear()
+        _fingerprints.clear()
+        _slow.clear()
+
+def current():
+    """RequestQueries of the queries this thread is timing, or None."""
+    return getattr(_local, 'current', None)
+
+def last_request():
+    """RequestQueries of the last request this thread served, or None."""
+    return getattr(_local, 'last', None)
+
+def view_name(view_func):
+    return '%s.%s' % (view_func.__module__, getattr(view_func, '__name__', view_func.__class__.__name__))
+
+class QueryCountMiddleware(object):
+    """Put it first, so the queries of the other middleware are counted too."""
+    def __init__(self):
+        install()
+
+    def process_request(self, request):
+        if random.random() < defaults.query_sample_rate:
+            start()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        current = getattr(_local, 'current', None)
+        if current is not None:
+            current.view = view_name(view_func)
+
+    def process_response(self, request, response):
+        stop()
+        return response
@@ -7,4 +7,61 @@ objects_on_quickentry_page = 8
 base_url = 'http://shabda.tld:8000'
 
 expires_in = 60*60*24 #One day
-bucket = 'i-love-foobar'
\ No newline at end of file
+bucket = 'i-love-foobar'
+
+diff_cache_size = 500 #Number of revision diffs kept in memory.
+
+wiki_snapshot_interval = 10 #Every n-th wiki revision stores the full text, the others store a delta.
+wiki_text_cache_size = 200 #Number of rebuilt wiki revision texts kept in memory.
+
+wiki_diff_engine = 'line' #'line' for the line level diff engine, 'char' for plain diff_match_patch.
+diff_time_limit = 2.0 #Seconds after which changed hunks of a line level diff are no longer refined.
+diff_refine_max_chars = 20000 #Changed hunks larger than this are shown as a plain delete and insert.
+search_results_per_page = 20
+
+multipart_threshold = 16 * 1024 * 1024 #Uploads of this many bytes or more are streamed to S3 in parts.
+multipart_part_size = 8 * 1024 * 1024 #Size of the parts. S3 wants at least 5MB, except for the last part.
+multipart_threads = 4 #Number of parts uploaded at the same time.
+
+signed_url_refresh = 60*60 #Signed file urls are reused for this many seconds, must be well under expires_in.
+signed_url_cache_size = 5000 #Number of signed file urls kept in memory.
+
+file_storage = 's3' #'s3' to keep files in the S3 bucket, 'local' to keep them under local_storage_root.
+local_storage_root = '/var/lib/dashbard/files'
+local_storage_accel = None #'x-accel-redirect' (nginx) or 'x-sendfile' (apache, lighttpd) to let the web server send local files.
+local_storage_accel_prefix = '/protected-files/' #Internal nginx location which maps to local_storage_root.
+local_storage_mode = None #Permissions of stored files, like 0640. None for 0666 less the umask, so the web server can read them.
+
+s3_timeout = 30 #Seconds to wait for S3 to connect or send more of a response.
+transfer_threads = 4 #Number of S3 requests run at the same time by the transfer manager.
+transfer_retries = 3 #Number of times a failed S3 request is sent again.
+
+feed_cache_size = 200 #Number of rendered project feeds kept in memory.
+
+basicauth_cache_ttl = 300 #Seconds a checked basic auth password is trusted without checking it again.
+basicauth_cache_size = 1000 #Number of checked basic auth credentials kept in memory.
+
+fragment_cache_size = 2000 #Number of rendered template fragments, like task rows, kept in memory.
+
+import_batch_size = 500 #Rows of an imported csv file created together, in one transaction.
+import_max_errors = 1000 #Number of failed rows of an import which are reported one by one.
+
+query_sample_rate = 0.01 #Fraction of the requests whose queries are timed, see dbinstrument. 0 turns it off.
+query_stats_max_fingerprints = 1000 #Number of query fingerprints kept, and of repeated ones kept per view.
+query_fingerprint_cache_size = 2000 #Number of query texts whose fingerprint is kept in memory.
+query_histogram_window = 10*60 #Seconds of each of the two windows the query latency histograms cover.
+slow_query_seconds = 0.5 #Queries slower than this are logged, with their EXPLAIN.
+slow_query_log_size = 100 #Number of the latest slow queries shown to staff.
+query_stats_top = 20 #Number of queries shown to staff, of those which take the most time.
+
+telemetry_dir = None #Directory the worker processes write their metrics to, when there is more than one, see telemetry.
+telemetry_flush_seconds = 5 #Seconds between writes of the metrics of a worker, while they change.
+
+trace_sample_rate = 0.01 #Fraction of the requests which are traced, see tracing.
+trace_output = None #File the traces are appended to as lines of json, or 'stdout'. None turns tracing off.
+trace_min_seconds = 0.0 #Only traces of requests which took at least this long are written.
+
+profile_dir = '/var/lib/dashbard/profiles' #Where profiles of requests are written, see profiler. None turns profiling off.
+profile_token_max_age = 24*60*60 #Seconds a profile token works for.
+profile_max_per_minute = 6 #Number of requests a process profiles a minute, at most.
+profile_sample_interval = 0.005 #Seconds between the stack samples of a profiled request.
\ No newline at end of file
@@ -0,0 +1,77 @@
+"""Cache of html diffs between two revisions.
+Diffs are keyed by (kind, revision_a_id, revision_b_id), so a diff is computed once per pair of revisions
+and served from memory after that. Consecutive revisions are diffed when the new revision is saved.
+"""
+import diff_match_patch
+import linediff
+from html2text import html2text
+from lrucache import LRUCache
+import defaults
+import telemetry
+import tracing
+
+_cache = LRUCache(defaults.diff_cache_size)
+telemetry.watch_cache('diff', _cache)
+diff_seconds = telemetry.histogram('dashbard_diff_seconds', 'Time to diff two revisions.', ('engine',))
+
+#Wiki pages can be large, so they may use the line level engine.
+engines = {'wiki': defaults.wiki_diff_engine}
+
+def wiki_text(revision):
+    """Text of a wiki page revision which is diffed."""
+    return html2text(revision.html_text)
+
+def version_text(version):
+    """Text of a task or taskitem version which is diffed."""
+    return version.as_text()
+
+def compute_diff(text1, text2, engine = 'char'):
+    """Diff two texts. Returns the list of diff tuples.
+    engine: 'char' for diff_match_patch.diff_main, 'line' for the line level linediff engine."""
+    app = diff_match_patch.diff_match_patch()
+    with diff_seconds.time(engine = engine), tracing.span('diff', engine = engine, chars = len(text1) + len(text2)):
+        if engine == 'line':
+            diff = linediff.line_diff(text1, text2, defaults.diff_time_limit, defaults.diff_refine_max_chars)
+        else:
+            diff = app.diff_main(text1, text2)
+        app.diff_cleanupSemantic(diff)
+    return diff
+
+def reverse_diff(diff):
+    """The diff going from text2 to text1, given the diff from text1 to text2.
+    The merge cleanup puts deletions back ahead of insertions, as diff_main would."""
+    reverse = [(-op, data) for op, data in diff]
+    diff_match_patch.diff_match_patch().diff_cleanupMerge(reverse)
+    return reverse
+
+def pretty_html(diff):
+    """Render a diff as html. diff_prettyHtml annotates the tuples in place, so work on a copy."""
+    return diff_match_patch.diff_match_patch().diff_prettyHtml(list(diff))
+
+def get_diff(kind, rev1, rev2, text_func):
+    """Get the html diff between rev1 and rev2, computing and caching it if needed."""
+    key = (kind, rev1.id, rev2.id)
+    htmldiff = _cache.get(key)
+    if htmldiff is None:
+        htmldiff = populate(kind, rev1, rev2, text_func)
+    return htmldiff
+
+def populate(kind, rev1, rev2, text_func):
+    """Compute the diff between two revisions and cache it both ways. Returns the rev1 -> rev2 html diff."""
+    diff = compute_diff(text_func(rev1), text_func(rev2), engines.get(kind, 'char'))
+    htmldiff = pretty_html(diff)
+    _cache.set((kind, rev1.id, rev2.id), htmldiff)
+    _cache.set((kind, rev2.id, rev1.id), pretty_html(reverse_diff(diff)))
+    return htmldiff
+
+def wiki_diff(rev1, rev2):
+    return get_diff('wiki', rev1, rev2, wiki_text)
+
+def task_diff(ver1, ver2):
+    return get_diff('task', ver1, ver2, version_text)
+
+def taskitem_diff(ver1, ver2):
+    return get_diff('taskitem', ver1, ver2, version_text)
+
+def clear():
+    _cache.clear()
@@ -5,13 +5,16 @@ from helpers import *
 from models import *
 import bforms
 import time
+import logging
 import hmac
 import sha
 import base64
 import secrets
 import defaults
 
-import S3
+import storage
+
+logger = logging.getLogger('project.storage')
 
 @login_required
 def files(request, project_name):
@@ -20,7 +23,7 @@ def files(request, project_name):
     Add files:  Owner Participant
     """
     project = get_project(request, project_name)
-    gen = S3.QueryStringAuthGenerator(secrets.AWS_ID, secrets.AWS_SECRET_KEY)
+    file_storage = storage.get_storage()
     addfileform = bforms.AddFileForm(project = project, user = request.user)    
     if request.method == 'POST':
         if request.POST.has_key('Addfile'):
@@ -31,9 +34,36 @@ def files(request, project_name):
         if request.POST.has_key('fileid'):
             fileid = int(request.POST['fileid'])
             file = ProjectFile.objects.get(project = project, id = fileid)
-            conn = S3.AWSAuthConnection(secrets.AWS_ID, secrets.AWS_SECRET_KEY)
-            for revision in file.projectfileversion_set.all():
-                conn.delete(defaults.bucket, revision.revision_name)
+            revisions = list(file.projectfileversion_set.all())
+            #Old revisions have an object of their own, content addressed ones share their blob.
+            #Unused blobs are deleted by reconcile_storage, an upload may be storing the same content again.
+            keys = [revision.revision_name for revision in revisions if not revision.blob_id]
             file.delete()
+            StoredBlob.objects.release([revision.blob_id for revision in revisions if revision.blob_id])
+            for key, code, message in file_storage.delete_many(keys):
+                #The rows are gone, reconcile_storage finds the object again as an orphan.
+                logger.error('Could not delete %s of file %s: %s %s', key, fileid, code, message)
+    #Get the urls of the whole listing at once, with S3 most of them come from the cache.
+    revisions = list(ProjectFileVersion.objects.filter(file__project = project).select_related('blob', 'file__project').order_by('id'))
+    file_revisions = {}
+    for revision, url in zip(revisions, file_storage.urls(revisions)):
+        revision.url = url
+        file_revisions.setdefault(revision.file_id, []).append(revision)
+    project_files = list(project.projectfile_set.select_related('current_revision__user'))
+    for file in project_files:
+        file.revisions = file_revisions.get(file.id, [])
+        file.url = dict((revision.id, revision.url) for revision in file.revisions).get(file.current_revision_id)
     payload = locals()
     return render(request, 'project/files.html', payload)
+
+@login_required
+def download(request, project_name, revision_id):
+    """Download a file revision. Redirects to S3, or sends the file when files are stored locally.
+    Actions available:
+    None"""
+    project = get_project(request, project_name)
+    try:
+        revision = ProjectFileVersion.objects.select_related('blob', 'file').get(id = revision_id, file__project = project)
+    except ProjectFileVersion.DoesNotExist:
+        raise Http404
+    return storage.get_storage().serve(revision)
@@ -3,14 +3,15 @@ from django.http import HttpResponse
 from helpers import *
 
 def proj_json(request, project_name):
+    """The tasks of the project, with references to their sub tasks, from one query."""
     project = get_project(request, project_name)
-    tasks = project.task_set.filter()
+    tasks = list(project.task_set.values_list('number', 'name', 'parent_task_num'))
+    children = {}
+    for number, name, parent_task_num in tasks:
+        children.setdefault(parent_task_num, []).append({'_reference':name})
     items = []
-    for task in tasks:
-        children = []
-        for subtask in task.task_set.all():
-            children.append({'_reference':subtask.name})
-        task = {'name':task.name, 'type':'task', 'children':children}
+    for number, name, parent_task_num in tasks:
+        task = {'name':name, 'type':'task', 'children':children.get(number, [])}
         items.append(task)
     payload = { 'label': 'name',
     'identifier': 'name',
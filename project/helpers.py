@@ -10,10 +10,18 @@ from django.template import Context
 import StringIO
 import sx.pisa3 as pisa
 import defaults
+import telemetry
+import tracing
 
 import BeautifulSoup as soup
 from models import *
 
+render_seconds = telemetry.histogram('dashbard_render_seconds', 'Time to render a page, pdfs included.', ('template',))
+pdf_seconds = telemetry.histogram('dashbard_pdf_seconds', 'Time pisa takes to make a pdf of a page.')
+pdf_results = telemetry.counter('dashbard_pdfs_total', 'Pdfs made from pages, by whether pisa could make them.', ('template', 'result'))
+pdf_bytes = telemetry.counter('dashbard_pdf_bytes_total', 'Bytes of the pdfs made.')
+csv_exports = telemetry.counter('dashbard_csv_exports_total', 'Csv exports. The time they take is under the format csv of dashbard_request_seconds.')
+
 def get_project(request, project_name):
     """Returns the project with the given name if the logged in user has access to the project. Raises 404 otherwise."""
     try:
@@ -34,9 +42,14 @@ def render(request, template, payload):
     """This populates the site wide template context in the payload passed to the template.
         It the job of this methods to make sure that, if user want to see the PDF they are able to see it.
     """
+    with render_seconds.time(template = template), tracing.span('render', template = template):
+        return render_page(request, template, payload)
+
+def render_page(request, template, payload):
     if request.GET.get('pdf', ''):
         tarr = template.split('/')
         template = '%s/%s/%s' % (tarr[0], 'pdf', tarr[1])
+        name = template
         template = get_template(template)
         html = template.render(Context(payload))
         import copy
@@ -47,9 +60,13 @@ def render(request, template, payload):
                 link['href'] = '%s%s' % (defaults.base_url, link['href'])
         html = StringIO.StringIO(str(hsoup))
         result = StringIO.StringIO()
-        pdf = pisa.CreatePDF(html, result)
+        with pdf_seconds.time(), tracing.span('pdf', template = name):
+            pdf = pisa.CreatePDF(html, result)
         if pdf.err:
+            pdf_results.inc(template = name, result = 'error')
             return HttpResponse(pdf.log)
+        pdf_results.inc(template = name, result = 'ok')
+        pdf_bytes.inc(len(result.getvalue()))
         return HttpResponse(result.getvalue(), mimetype='application/pdf')
     if not payload.get('subs', ''):
         try:
@@ -122,6 +139,7 @@ def delete_task(request):
 def reponse_for_cvs(filename = 'filename.csv', project=None):
     response = HttpResponse(mimetype='text/csv')
     response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    csv_exports.inc()
     writer = csv.writer(response)
     if project:
         writer.writerow(Project.as_csv_header())
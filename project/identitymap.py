@@ -0,0 +1,40 @@
+"""Objects looked up during a request, shared by everything which asks for them again in the same request.
+
+Task items and sub tasks point at their task by number, so every item of a list would look its task up on its
+own. models.current_tasks keeps the tasks it loads here, by key, and IdentityMapMiddleware starts an empty map
+for every request and drops it at the end. Outside of a request, as in commands and tests, nothing is kept.
+Writes which can change what is kept call clear().
+"""
+import threading
+
+_local = threading.local()
+
+def get(key):
+    objects = getattr(_local, 'objects', None)
+    if objects is None:
+        return None
+    return objects.get(key)
+
+def add(key, obj):
+    objects = getattr(_local, 'objects', None)
+    if objects is not None:
+        objects[key] = obj
+
+def clear():
+    objects = getattr(_local, 'objects', None)
+    if objects is not None:
+        objects.clear()
+
+def start():
+    _local.objects = {}
+
+def stop():
+    _local.objects = None
+
+class IdentityMapMiddleware(object):
+    def process_request(self, request):
+        start()
+
+    def process_response(self, request, response):
+        stop()
+        return response
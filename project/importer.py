@@ -0,0 +1,226 @@
+"""Import tasks and task items from csv files, like the ones the task pages export with ?csv=1.
+
+The file is parsed as its chunks are read, so it is never held in memory whole. Every row is checked with
+bforms.ImportTaskForm or ImportTaskItemForm, one form being bound to row after row, and the valid rows are
+created batch_size at a time: their parent tasks and tasks are looked up with a query per batch, and they are
+numbered and inserted in bulk in a transaction of their own, see Task.create_many. Rows which fail do not stop
+the import, their line and errors are reported in the ImportResult.
+Files can be comma or tab separated. Rows before the header, like the project rows of an export, are skipped.
+Tasks can have a Parent column, the number of an existing task or the name of a task, and items a Task column,
+the number of their task.
+"""
+import csv
+import itertools
+import re
+
+from django.db import transaction
+
+from models import *
+import bforms
+import defaults
+
+class ImportFileError(Exception):
+    pass
+
+#Columns of the files, by lowercased header, to the fields of the import forms.
+TASK_COLUMNS = {'name': 'name', 'user': 'user_responsible', 'start date': 'start_date', 'end date': 'end_date',
+                'actual start date': 'actual_start_date', 'actual end date': 'actual_end_date',
+                'is complete': 'is_complete', 'parent': 'parent'}
+ITEM_COLUMNS = {'name': 'item_name', 'user': 'user', 'time': 'time', 'complete?': 'is_complete', 'task': 'task'}
+
+#Time is exported with its unit, like 2.00Hours.
+time_re = re.compile(r'^\s*(.*?)\s*([A-Za-z]*)\s*$')
+
+class ImportResult(object):
+    """kind: 'tasks' or 'items'. created: Number of objects created.
+    errors: (line, message) of the rows which were not imported, up to defaults.import_max_errors of them.
+    error_count: Number of rows which were not imported."""
+    def __init__(self):
+        self.kind = None
+        self.created = 0
+        self.errors = []
+        self.error_count = 0
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < defaults.import_max_errors:
+            self.errors.append((line, message))
+
+def lines(chunks):
+    """The lines of a file read in chunks, with their line ends, as the csv module wants them."""
+    rest = ''
+    for chunk in chunks:
+        parts = (rest + chunk).split('\n')
+        rest = parts.pop()
+        for part in parts:
+            yield part + '\n'
+    if rest:
+        yield rest
+
+def read_rows(chunks):
+    """(line number, row) of the file, with the cells decoded. Tab separated when its first line has more tabs than commas."""
+    file_lines = lines(chunks)
+    first = next(file_lines, '')
+    if first.startswith('\xef\xbb\xbf'):
+        first = first[3:]
+    delimiter = first.count('\t') > first.count(',') and '\t' or ','
+    reader = csv.reader(itertools.chain([first], file_lines), delimiter = delimiter)
+    try:
+        for row in reader:
+            try:
+                yield reader.line_num, [cell.decode('utf-8') for cell in row]
+            except UnicodeDecodeError:
+                yield reader.line_num, None
+    except csv.Error, e:
+        raise ImportFileError('Line %s: %s' % (reader.line_num, e))
+
+def find_header(rows):
+    """The kind of the file and its columns, as (index, field, header), from the first row which is a header."""
+    for line, row in rows:
+        if row is None:
+            continue
+        headers = [cell.strip().lower() for cell in row]
+        if set(['name', 'user', 'start date']) <= set(headers):
+            columns = TASK_COLUMNS
+            kind = 'tasks'
+        elif set(['name', 'time']) <= set(headers):
+            columns = ITEM_COLUMNS
+            kind = 'items'
+        else:
+            continue
+        return kind, [(i, columns[header], cell.strip()) for i, (header, cell) in enumerate(zip(headers, row)) if header in columns]
+    raise ImportFileError('The file has no task or task item header, like %s or %s.' % (', '.join(Task.as_csv_header()), ', '.join(TaskItem.as_csv_header())))
+
+def row_data(row, columns):
+    data = {}
+    for i, field, header in columns:
+        if i < len(row):
+            data[field] = row[i].strip()
+    if 'time' in data:
+        data['time'], data['units'] = time_re.match(data['time']).groups()
+    for field in ('user', 'user_responsible'):
+        if data.get(field, None) == '':
+            data[field] = 'None'
+    return data
+
+def check(form, data):
+    """Bind form to data and validate it, reusing its fields, which is a lot quicker than making a form per row."""
+    form.data = data
+    form.is_bound = True
+    form._errors = None
+    return form.is_valid()
+
+def error_message(form, labels):
+    messages = []
+    for field, errors in form.errors.items():
+        label = labels.get(field, field)
+        messages.append(label == '__all__' and ' '.join(errors) or '%s: %s' % (label, ' '.join(errors)))
+    return '; '.join(messages)
+
+def import_csv(project, user, chunks, task_num = None, batch_size = None):
+    """Import the tasks or task items of a csv file, read from chunks, into project, as created by user.
+    task_num: Number of the task of the items, when the file has no Task column.
+    Returns an ImportResult. Raises ImportFileError when the file can not be read at all."""
+    batch_size = batch_size or defaults.import_batch_size
+    result = ImportResult()
+    rows = read_rows(chunks)
+    result.kind, columns = find_header(rows)
+    labels = dict((field, header) for i, field, header in columns)
+    labels['units'] = labels.get('time')
+    choices = bforms.user_choices(project)
+    users = bforms.users_by_name([name for name, label in choices])
+    if result.kind == 'tasks':
+        form = bforms.ImportTaskForm(project, user, user_choices = choices)
+        importer = TaskImporter(project, users)
+    else:
+        form = bforms.ImportTaskItemForm(project, user, user_choices = choices)
+        importer = ItemImporter(project, users)
+    batch = []
+    for line, row in rows:
+        if row is None:
+            result.add_error(line, 'The row is not utf-8 text.')
+            continue
+        if not ''.join(row).strip():
+            continue
+        data = row_data(row, columns)
+        if task_num is not None and not data.get('task'):
+            data['task'] = str(task_num)
+        if not check(form, data):
+            result.add_error(line, error_message(form, labels))
+            continue
+        batch.append((line, form.cleaned_data))
+        if len(batch) == batch_size:
+            importer.save(form, batch, result)
+            batch = []
+    if batch:
+        importer.save(form, batch, result)
+    return result
+
+class TaskImporter(object):
+    """Creates the tasks of an import, a batch at a time. The tasks it made are remembered by name, for later rows
+    to name as their parent."""
+    def __init__(self, project, users):
+        self.project = project
+        self.users = users
+        self.numbers = {}
+
+    def parents(self, batch):
+        """Number of the parents named in the batch which exist already, by what they are named by."""
+        numbers = set()
+        names = set()
+        for line, data in batch:
+            parent = data['parent']
+            if parent.isdigit():
+                numbers.add(int(parent))
+            elif parent and parent not in self.numbers:
+                names.add(parent)
+        tasks = Task.objects.filter(project = self.project)
+        found = dict((str(number), number) for number in tasks.filter(number__in = numbers).values_list('number', flat = True))
+        #When names repeat, the newest task of the name is the parent.
+        found.update(tasks.filter(name__in = names).order_by('number').values_list('name', 'number'))
+        return found
+
+    @transaction.commit_on_success
+    def save(self, form, batch, result):
+        found = self.parents(batch)
+        num = reserve_numbers(self.project, 'project_task')
+        tasks = []
+        for line, data in batch:
+            form.cleaned_data = data
+            task = form.save_without_db(self.users)
+            parent = data['parent']
+            if parent:
+                if parent.isdigit():
+                    parent_num = found.get(parent)
+                else:
+                    parent_num = self.numbers.get(parent, found.get(parent))
+                if parent_num is None:
+                    result.add_error(line, 'Parent: There is no task %s.' % parent)
+                    continue
+                task.parent_task_num = parent_num
+            task.number = num
+            num += 1
+            self.numbers[task.name] = task.number
+            tasks.append(task)
+        Task.create_many(tasks)
+        result.created += len(tasks)
+
+class ItemImporter(object):
+    """Creates the task items of an import, a batch at a time."""
+    def __init__(self, project, users):
+        self.project = project
+        self.users = users
+
+    @transaction.commit_on_success
+    def save(self, form, batch, result):
+        tasks = current_tasks(self.project.id, [data['task'] for line, data in batch])
+        items = []
+        for line, data in batch:
+            if data['task'] not in tasks:
+                result.add_error(line, 'Task: There is no task %s.' % data['task'])
+                continue
+            form.cleaned_data = data
+            form.task = tasks[data['task']]
+            items.append(form.save_without_db(self.users))
+        TaskItem.create_many(items, tasks)
+        result.created += len(items)
@@ -0,0 +1,123 @@
+"""Line level diff engine for large texts.
+
+diff_match_patch.diff_main falls back to its O(ND) diff_map on the whole text, which gets slow on big
+pages with many scattered changes. Here a patience diff over lines finds the unchanged lines first, and
+only the changed hunks are diffed character by character with diff_main. The whole diff is bounded by a
+time limit; hunks left over when it runs out are reported as a plain delete and insert.
+The result is a list of diff_match_patch diff tuples, so it can be cleaned up and rendered the same way.
+"""
+import time
+
+import diff_match_patch
+
+DIFF_DELETE = diff_match_patch.diff_match_patch.DIFF_DELETE
+DIFF_INSERT = diff_match_patch.diff_match_patch.DIFF_INSERT
+DIFF_EQUAL = diff_match_patch.diff_match_patch.DIFF_EQUAL
+
+def unique_matches(a, alo, ahi, b, blo, bhi):
+    """Pairs (i, j) of lines which occur exactly once in a[alo:ahi] and once in b[blo:bhi], ordered by i."""
+    counts = {}
+    for i in xrange(alo, ahi):
+        line = a[i]
+        count = counts.get(line)
+        if count is None:
+            counts[line] = [1, i, 0, None]
+        else:
+            count[0] += 1
+    for j in xrange(blo, bhi):
+        count = counts.get(b[j])
+        if count is not None:
+            count[2] += 1
+            count[3] = j
+    matches = [(count[1], count[3]) for count in counts.itervalues() if count[0] == 1 and count[2] == 1]
+    matches.sort()
+    return matches
+
+def longest_increasing(matches):
+    """The longest subsequence of matches whose b indexes are increasing, by patience sorting."""
+    import bisect
+    tops = []
+    piles = []
+    backrefs = []
+    for n, (i, j) in enumerate(matches):
+        k = bisect.bisect_left(tops, j)
+        if k == len(tops):
+            tops.append(j)
+            piles.append(n)
+        else:
+            tops[k] = j
+            piles[k] = n
+        backrefs.append(piles[k - 1] if k else None)
+    if not piles:
+        return []
+    result = []
+    n = piles[-1]
+    while n is not None:
+        result.append(matches[n])
+        n = backrefs[n]
+    result.reverse()
+    return result
+
+def match_lines(a, b):
+    """Matching line pairs (i, j) of the patience diff of the line lists a and b, in order."""
+    matched = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+        # Common leading and trailing lines match directly.
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matched.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matched.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        anchors = longest_increasing(unique_matches(a, alo, ahi, b, blo, bhi))
+        if not anchors:
+            # Nothing unique to anchor on, this region is a changed hunk.
+            continue
+        previous_i, previous_j = alo, blo
+        for i, j in anchors:
+            matched.append((i, j))
+            stack.append((previous_i, i, previous_j, j))
+            previous_i, previous_j = i + 1, j + 1
+        stack.append((previous_i, ahi, previous_j, bhi))
+    matched.sort()
+    return matched
+
+def line_diff(text1, text2, time_limit = 1.0, refine_max_chars = 20000):
+    """Diff text1 and text2 line by line, refining changed hunks character by character.
+    time_limit: Seconds after which changed hunks are no longer refined. 0 for no limit.
+    refine_max_chars: Hunks larger than this are not refined."""
+    deadline = time_limit and time.time() + time_limit
+    a = text1.splitlines(True)
+    b = text2.splitlines(True)
+    app = diff_match_patch.diff_match_patch()
+    diffs = []
+    i = j = 0
+    for mi, mj in match_lines(a, b) + [(len(a), len(b))]:
+        if i < mi or j < mj:
+            diffs.extend(refine_hunk(app, ''.join(a[i:mi]), ''.join(b[j:mj]), deadline, refine_max_chars))
+        if mi < len(a):
+            diffs.append((DIFF_EQUAL, a[mi]))
+        i, j = mi + 1, mj + 1
+    app.diff_cleanupMerge(diffs)
+    return diffs
+
+def refine_hunk(app, text1, text2, deadline, refine_max_chars):
+    """Character level diff of a changed hunk, as long as there is time left and the hunk is small enough."""
+    if not text1:
+        return [(DIFF_INSERT, text2)]
+    if not text2:
+        return [(DIFF_DELETE, text1)]
+    if deadline:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return [(DIFF_DELETE, text1), (DIFF_INSERT, text2)]
+        app.Diff_Timeout = remaining
+    if len(text1) + len(text2) > refine_max_chars:
+        return [(DIFF_DELETE, text1), (DIFF_INSERT, text2)]
+    return app.diff_main(text1, text2, False)
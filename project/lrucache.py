@@ -0,0 +1,59 @@
+"""A small thread safe, size bounded, least recently used cache."""
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Keeps at most max_size entries, evicting the least recently used one first."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        """Get the value for key, marking it as most recently used."""
+        self.lock.acquire()
+        try:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.data[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        """Store the value for key, evicting old entries if the cache is full."""
+        self.lock.acquire()
+        try:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.max_size:
+                self.data.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.data.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.data.clear()
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
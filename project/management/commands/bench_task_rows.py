@@ -0,0 +1,75 @@
+"""Time listing the tasks of a project as Task instances against rows.TaskRow, the way the csv export lists them.
+
+For both, the tasks are loaded and written as csv, and the objects the loaded list keeps alive are counted
+with the gc module. With --synthetic, a project with that many tasks is made for the run, and rolled back after it.
+"""
+import csv
+import datetime
+import gc
+import time
+import StringIO
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from project.models import Project, Task
+from project import rows
+
+def export(tasks):
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    for task in tasks:
+        writer.writerow(task.as_csv())
+    return out.getvalue()
+
+class Command(BaseCommand):
+    args = '[project shortname]'
+    help = 'Benchmarks listing and exporting tasks as model instances and as rows.'
+    option_list = BaseCommand.option_list + (
+        make_option('--synthetic', type = 'int', dest = 'synthetic', default = 0,
+            help = 'Make a project with this many tasks for the run, instead of using an existing one.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['synthetic']:
+            with transaction.commit_manually():
+                try:
+                    self.compare(synthetic_project(options['synthetic']))
+                finally:
+                    transaction.rollback()
+        elif len(args) == 1:
+            try:
+                project = Project.objects.get(shortname = args[0])
+            except Project.DoesNotExist:
+                raise CommandError('There is no project %s.' % args[0])
+            self.compare(project)
+        else:
+            raise CommandError('Give a project shortname, or --synthetic.')
+
+    def compare(self, project):
+        queryset = Task.objects.filter(project = project)
+        for name, load in (('models', list), ('rows', rows.task_rows)):
+            gc.collect()
+            before = len(gc.get_objects())
+            start = time.time()
+            tasks = load(queryset)
+            loaded = time.time() - start
+            objects = len(gc.get_objects()) - before
+            export(tasks)
+            exported = time.time() - start - loaded
+            self.stdout.write('%s: %s tasks, %s objects kept, loaded in %.3fs, exported in %.3fs\n' % (name, len(tasks), objects, loaded, exported))
+            del tasks
+
+def synthetic_project(count):
+    """A project with count tasks, half of them with a user responsible."""
+    user = User.objects.create_user('bench_task_rows', '', 'bench_task_rows')
+    project = Project(shortname = 'bench_task_rows', name = 'Task rows benchmark', owner = user, start_date = datetime.date.today())
+    project.save()
+    today = datetime.date.today()
+    tasks = [Task(name = 'Task %s' % i, project = project, expected_start_date = today, created_by = user, last_updated_by = user,
+                  user_responsible = i % 2 and user or None) for i in xrange(count)]
+    for start in xrange(0, count, 1000):
+        Task.create_many(tasks[start:start + 1000])
+    return project
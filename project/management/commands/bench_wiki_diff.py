@@ -0,0 +1,71 @@
+"""Time the character and line level diff engines on the largest wiki pages.
+
+For each of the largest pages the first and the current revision are diffed with both engines.
+With --synthetic, a generated page with scattered edits is diffed as well, so the engines can be
+compared without production data.
+"""
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from project import diffcache, defaults
+from project.models import WikiPage
+
+class Command(BaseCommand):
+    help = 'Benchmarks the wiki diff engines on the largest wiki pages.'
+    option_list = BaseCommand.option_list + (
+        make_option('--pages', type = 'int', dest = 'pages', default = 10,
+            help = 'Number of the largest pages to diff.'),
+        make_option('--synthetic', type = 'int', dest = 'synthetic', default = 0,
+            help = 'Also diff a generated page with this many lines.'),
+    )
+
+    def handle(self, *args, **options):
+        cases = self.page_cases(options['pages'])
+        if options['synthetic']:
+            cases.append(('synthetic (%s lines)' % options['synthetic'],) + synthetic_texts(options['synthetic']))
+        worst = {}
+        for name, text1, text2 in cases:
+            timings = []
+            for engine in ('char', 'line'):
+                start = time.time()
+                diffcache.compute_diff(text1, text2, engine)
+                elapsed = time.time() - start
+                worst[engine] = max(worst.get(engine, 0), elapsed)
+                timings.append(elapsed)
+            self.stdout.write('%s: %s chars, char %.3fs, line %.3fs\n' % (name, len(text1) + len(text2), timings[0], timings[1]))
+        for engine in ('char', 'line'):
+            self.stdout.write('Worst case %s: %.3fs\n' % (engine, worst.get(engine, 0)))
+
+    def page_cases(self, count):
+        """(name, first text, current text) of the count pages with the largest current revision."""
+        pages = []
+        for page in WikiPage.objects.all().iterator():
+            revisions = page.revisions()
+            if len(revisions) < 2:
+                continue
+            first = min(revisions, key = lambda revision: revision.id)
+            current = page.current_revision
+            pages.append((page.name, diffcache.wiki_text(first), diffcache.wiki_text(current)))
+        pages.sort(key = lambda case: len(case[2]), reverse = True)
+        return pages[:count]
+
+def synthetic_texts(lines):
+    """A page of lines and an edited copy, with lines changed, removed and added all over it."""
+    rand = random.Random(lines)
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit']
+    text1 = ['%s %s\n' % (n, ' '.join(rand.choice(words) for i in range(10))) for n in xrange(lines)]
+    text2 = []
+    for line in text1:
+        choice = rand.random()
+        if choice < 0.05:
+            text2.append(line.replace(' ', ' %s ' % rand.choice(words), 1))
+        elif choice < 0.07:
+            continue
+        elif choice < 0.09:
+            text2.extend([line, 'new %s\n' % rand.choice(words)])
+        else:
+            text2.append(line)
+    return ''.join(text1), ''.join(text2)
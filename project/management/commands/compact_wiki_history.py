@@ -0,0 +1,55 @@
+"""Rewrite the history of every wiki page into snapshots and deltas.
+
+Revisions saved before delta storage existed store the full text. This adds the delta columns to the
+revision table when they are missing (syncdb does not alter existing tables), then rewrites the
+revisions of each page, oldest first, exactly as WikiPageRevision.save would have stored them.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from project.models import WikiPage, WikiPageRevision, _wiki_text_cache
+from project.schema import add_missing_columns
+
+class Command(BaseCommand):
+    help = 'Compacts wiki page history into periodic snapshots and deltas.'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action = 'store_true', dest = 'dry_run', default = False,
+            help = 'Only report how much space compaction would save.'),
+    )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        add_missing_columns(WikiPageRevision, ['delta_base', 'delta', 'chain_length'])
+        before = after = 0
+        for page in WikiPage.objects.all().iterator():
+            page_before, page_after = self.compact_page(page, dry_run)
+            before += page_before
+            after += page_after
+        _wiki_text_cache.clear()
+        self.stdout.write('Wiki history: %s bytes before, %s bytes after compaction.\n' % (before, after))
+
+    def compact_page(self, page, dry_run):
+        """Re-encode the revisions of a page. Returns the stored sizes before and after."""
+        before = after = 0
+        previous = None
+        for revision in sorted(page.revisions(), key = lambda revision: revision.id):
+            text = revision.wiki_text
+            before += stored_size(revision)
+            revision.encode(previous, text)
+            after += stored_size(revision)
+            if not dry_run:
+                WikiPageRevision.objects.filter(id = revision.id).update(
+                    stored_wiki_text = revision.stored_wiki_text,
+                    stored_html_text = revision.stored_html_text,
+                    delta_base = revision.delta_base,
+                    delta = revision.delta,
+                    chain_length = revision.chain_length)
+            previous = revision
+        if not dry_run:
+            transaction.commit_unless_managed()
+        return before, after
+
+def stored_size(revision):
+    return len(revision.stored_wiki_text) + len(revision.stored_html_text) + len(revision.delta or '')
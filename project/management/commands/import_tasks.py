@@ -0,0 +1,39 @@
+"""Import tasks or task items from a csv file into a project, like the import page does, see project.importer."""
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from project.models import Project
+from project import importer
+
+class Command(BaseCommand):
+    args = '<project shortname> <username> <file>'
+    help = 'Imports the tasks or task items of a csv file into a project, as created by the user.'
+    option_list = BaseCommand.option_list + (
+        make_option('--task', type = 'int', dest = 'task', default = None,
+            help = 'Number of the task of the items, when the file has no Task column.'),
+        make_option('--batch-size', type = 'int', dest = 'batch_size', default = None,
+            help = 'Rows created together, in one transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError('Usage: import_tasks %s' % self.args)
+        shortname, username, path = args
+        try:
+            project = Project.objects.get(shortname = shortname)
+            user = User.objects.get(username = username)
+        except (Project.DoesNotExist, User.DoesNotExist), e:
+            raise CommandError(str(e))
+        csv_file = open(path, 'rb')
+        try:
+            chunks = iter(lambda: csv_file.read(64 * 1024), '')
+            result = importer.import_csv(project, user, chunks, options['task'], options['batch_size'])
+        except importer.ImportFileError, e:
+            raise CommandError(str(e))
+        finally:
+            csv_file.close()
+        for line, message in result.errors:
+            self.stdout.write('line %s: %s\n' % (line, message))
+        self.stdout.write('%s %s imported, %s rows failed.\n' % (result.created, result.kind, result.error_count))
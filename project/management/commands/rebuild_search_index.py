@@ -0,0 +1,56 @@
+"""Rebuild the search index of some or all projects.
+
+The index is kept up to date as things are saved, so this is needed only for data which was there
+before the index existed, or when the way documents are indexed changes. The entries of task notes which
+do not know their project, see upgrade_schema, are kept as they are.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from project.models import Project, Task, TaskItem, TaskNote, Notice, WikiPage, ProjectFile, SearchDocument, SearchTerm, current_tasks
+
+class Command(BaseCommand):
+    args = '[project shortname ...]'
+    help = 'Rebuilds the search index of the given projects, or of all projects.'
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        if args:
+            projects = projects.filter(shortname__in = args)
+        for project in projects.iterator():
+            with transaction.commit_on_success():
+                count = self.rebuild(project)
+            self.stdout.write('%s: indexed %s documents.\n' % (project.shortname, count))
+
+    def rebuild(self, project):
+        """Reindex everything in project. Returns the number of documents indexed."""
+        stale = SearchDocument.objects.filter(project = project).exclude(kind = 'note')
+        SearchTerm.objects.filter(document__in = stale).delete()
+        stale.delete()
+        notes = SearchDocument.objects.filter(project = project, kind = 'note')
+        gone = notes.exclude(key__in = TaskNote.objects.filter(project__isnull = True).values_list('id', flat = True))
+        SearchTerm.objects.filter(document__in = gone).delete()
+        gone.delete()
+        count = 0
+        for task in Task.objects.filter(project = project).iterator():
+            task.index()
+            count += 1
+        for item in TaskItem.objects.filter(project = project).iterator():
+            item.index()
+            count += 1
+        notes = list(TaskNote.objects.filter(project = project))
+        tasks = current_tasks(project.id, [note.task_num for note in notes])
+        for note in notes:
+            if note.task_num in tasks:
+                note.index(tasks[note.task_num])
+                count += 1
+        for notice in Notice.objects.filter(project = project).select_related('user').iterator():
+            notice.index()
+            count += 1
+        for page in WikiPage.objects.filter(project = project, current_revision__isnull = False).select_related('current_revision').iterator():
+            page.index(page.current_revision.wiki_text)
+            count += 1
+        for projectfile in ProjectFile.objects.filter(project = project).iterator():
+            projectfile.index()
+            count += 1
+        return count
@@ -0,0 +1,160 @@
+"""Compare the stored file objects with the database, and report or repair where they disagree.
+
+The bucket listing and the rows which point at stored objects (StoredBlobs, and the revisions stored
+before content addressing, under their revision_name) are both walked in key order and merge-joined,
+so the memory used does not grow with the number of objects. Only the keys the site stores files under are
+looked at: blobs/, and /<shortname>/ of every project for the revisions stored before content addressing.
+Other objects in the bucket, or files under the storage root, are left alone. It finds:
+ orphan: an object no row points at. Repairing deletes it, when it is older than --min-age hours,
+         younger ones may belong to an upload which has not recorded its blob yet.
+ missing: a row whose object is not stored. This can only be reported.
+ size: a row whose size is not the size of its object. Repairing sets the size from the object.
+ total: a file whose total_size is not the sum of the sizes of its revisions. Repairing recomputes it.
+"""
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q, Sum
+
+from project.models import Project, ProjectFile, ProjectFileVersion, StoredBlob
+from project import storage
+from project import S3
+
+def walk(queryset, fields, batch_size = 1000):
+    """Yield values_list rows of queryset, ordered by fields[0] then id, fetching batch_size rows per query.
+    fields must include 'id'."""
+    field = fields[0]
+    position = fields.index('id')
+    last = None
+    while True:
+        rows = queryset.order_by(field, 'id')
+        if last is not None:
+            rows = rows.filter(Q(**{field + '__gt': last[0]}) | Q(**{field: last[0], 'id__gt': last[1]}))
+        rows = list(rows.values_list(*fields)[:batch_size])
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0], rows[-1][position]
+
+BLOBS = 'blobs/'
+
+def prefixes():
+    """The prefixes of the keys the files are stored under, in byte order. Legacy keys start with a /,
+    which sorts before blobs/."""
+    shortnames = Project.objects.values_list('shortname', flat = True)
+    return sorted('/%s/' % shortname.encode('utf-8') for shortname in shortnames) + [BLOBS]
+
+def stored_rows(prefix):
+    """(key, kind, id, size) of every row pointing at a stored object under prefix, in the byte order of the keys."""
+    if prefix == BLOBS:
+        source = ((BLOBS + digest, 'blob', id, size) for digest, id, size in walk(StoredBlob.objects.all(), ['digest', 'id', 'size']))
+    else:
+        revisions = ProjectFileVersion.objects.filter(blob__isnull = True, revision_name__startswith = prefix)
+        source = ((name, 'revision', id, size) for name, id, size in walk(revisions, ['revision_name', 'id', 'size']))
+    previous = None
+    for key, kind, id, size in source:
+        key = key.encode('utf-8')
+        if previous is not None and key < previous:
+            raise CommandError('The database does not sort %r before %r, use a binary collation for the key columns.' % (previous, key))
+        previous = key
+        yield key, kind, id, size
+
+def utf8_keys(entries):
+    """Compare listed keys as utf-8 bytes, like the rows and like S3 sorts them."""
+    for entry in entries:
+        if isinstance(entry.key, unicode):
+            entry.key = entry.key.encode('utf-8')
+        yield entry
+
+def merge_join(entries, rows):
+    """Yield (entry, row) for every key of the sorted entries and rows, with None on the side where the key is not."""
+    entry = next(entries, None)
+    row = next(rows, None)
+    while entry is not None or row is not None:
+        if row is None or (entry is not None and entry.key < row[0]):
+            yield entry, None
+            entry = next(entries, None)
+        elif entry is None or row[0] < entry.key:
+            yield None, row
+            row = next(rows, None)
+        else:
+            yield entry, row
+            entry = next(entries, None)
+            row = next(rows, None)
+
+def modified_on(entry):
+    return datetime.datetime.strptime(entry.last_modified[:19], '%Y-%m-%dT%H:%M:%S')
+
+class Command(BaseCommand):
+    help = 'Reports, or repairs, stored file objects and file rows which do not match.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repair', action = 'store_true', dest = 'repair', default = False,
+            help = 'Delete orphan objects and fix the sizes in the database.'),
+        make_option('--min-age', type = 'int', dest = 'min_age', default = 24,
+            help = 'Only delete orphan objects older than this many hours.'),
+    )
+
+    def handle(self, *args, **options):
+        counts = self.reconcile(storage.get_storage(), options['repair'], options['min_age'])
+        self.stdout.write('%(objects)s objects: %(orphan)s orphans, %(missing)s missing, %(size)s wrong sizes, %(total)s wrong file totals.\n' % counts)
+
+    def reconcile(self, file_storage, repair = False, min_age = 24):
+        """Merge-join the stored objects with the rows. Returns the number of each problem found."""
+        counts = {'objects': 0, 'orphan': 0, 'missing': 0, 'size': 0, 'total': 0}
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours = min_age)
+        orphans = []
+        for entry, row in self.joined(file_storage):
+            if entry is not None:
+                counts['objects'] += 1
+            if row is None:
+                counts['orphan'] += 1
+                self.stdout.write('orphan %s (%s bytes)\n' % (entry.key, entry.size))
+                if repair and modified_on(entry) < cutoff:
+                    orphans.append(entry.key)
+                    if len(orphans) == S3.MAX_DELETE_KEYS:
+                        self.delete(file_storage, orphans)
+                        orphans = []
+            elif entry is None:
+                counts['missing'] += 1
+                self.stdout.write('missing %s (%s %s)\n' % (row[0], row[1], row[2]))
+            elif entry.size != row[3]:
+                counts['size'] += 1
+                self.stdout.write('size %s: %s bytes stored, %s recorded\n' % (row[0], entry.size, row[3]))
+                if repair:
+                    self.fix_size(row[1], row[2], entry.size)
+        if orphans:
+            self.delete(file_storage, orphans)
+        counts['total'] = self.check_totals(repair)
+        return counts
+
+    def joined(self, file_storage):
+        """merge_join of the objects and the rows, one prefix after the other."""
+        for prefix in prefixes():
+            for pair in merge_join(utf8_keys(file_storage.iter_keys(prefix)), stored_rows(prefix)):
+                yield pair
+
+    def delete(self, file_storage, keys):
+        for key, code, message in file_storage.delete_many(keys):
+            self.stdout.write('not deleted %s: %s %s\n' % (key, code, message))
+
+    def fix_size(self, kind, id, size):
+        if kind == 'blob':
+            StoredBlob.objects.filter(id = id).update(size = size)
+            ProjectFileVersion.objects.filter(blob = id).update(size = size)
+        else:
+            ProjectFileVersion.objects.filter(id = id).update(size = size)
+
+    def check_totals(self, repair):
+        """Compare the total_size of every file with its revisions. Returns the number of files which are off."""
+        count = 0
+        files = ProjectFile.objects.annotate(actual = Sum('projectfileversion__size'))
+        for id, filename, total_size, actual in walk(files, ['id', 'filename', 'total_size', 'actual']):
+            actual = actual or 0
+            if total_size != actual:
+                count += 1
+                self.stdout.write('total %s (file %s): %s recorded, %s in revisions\n' % (filename, id, total_size, actual))
+                if repair:
+                    ProjectFile.objects.filter(id = id).update(total_size = actual)
+        return count
@@ -0,0 +1,25 @@
+"""Add the columns which were added to the models after their tables were created, with their indexes, and fill
+in what the new columns need. Run syncdb first, for the new tables.
+"""
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import get_app, get_models
+
+from project.schema import add_missing_columns, add_indexes, backfill_note_projects
+
+class Command(BaseCommand):
+    help = 'Adds missing columns to the tables of the project app.'
+
+    def handle(self, *args, **options):
+        tables = connection.introspection.table_names()
+        for model in get_models(get_app('project')):
+            if model._meta.db_table not in tables:
+                continue
+            columns = add_missing_columns(model)
+            for column in columns:
+                self.stdout.write('Added %s.%s\n' % (model._meta.db_table, column))
+            if columns:
+                self.stdout.write('Added %s indexes to %s\n' % (add_indexes(model, columns), model._meta.db_table))
+        counts = backfill_note_projects()
+        if sum(counts.values()):
+            self.stdout.write('Task notes: %(indexed)s projects from the search index, %(authors)s from their authors, %(unknown)s unknown.\n' % counts)
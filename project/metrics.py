@@ -1,9 +1,15 @@
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, HttpResponse
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 
 from helpers import *
 from models import *
 import bforms
+import dbinstrument
+import defaults
+import telemetry
+import basicauth
+import profiler
 
 import pygooglechart
 
@@ -64,3 +70,28 @@ def user_stats(request, project_name):
     Actions available: None
     """
     pass
+
+@staff_member_required
+def query_stats(request):
+    """Shows the queries and the views which take the most time in the database, and the latest slow queries.
+    Actions available:
+    Start the numbers over: Staff"""
+    if request.method == 'POST':
+        dbinstrument.reset()
+        return HttpResponseRedirect('.')
+    fingerprints = dbinstrument.top_fingerprints(defaults.query_stats_top)
+    views = dbinstrument.stats()[:defaults.query_stats_top]
+    slow_queries = dbinstrument.slow_queries()
+    sample_rate = defaults.query_sample_rate
+    slow_query_seconds = defaults.slow_query_seconds
+    profile_token = profiler.profile_token(request.user)
+    profile_token_hours = defaults.profile_token_max_age // 3600
+    payload = locals()
+    return render(request, 'project/querystats.html', payload)
+
+def metrics_text(request):
+    """The metrics of the site in the Prometheus text format, for staff, who can send their password with basic auth.
+    Actions available: None"""
+    def exposition(request):
+        return HttpResponse(telemetry.exposition(), content_type = 'text/plain; version=0.0.4; charset=utf-8')
+    return basicauth.view_or_basicauth(exposition, request, lambda u: u.is_staff, 'metrics', True)
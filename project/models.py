@@ -4,10 +4,19 @@ from django import forms
 import datetime
 
 from dojofields import *
-from django.db import connection
+from django.db import connection, transaction, IntegrityError
 import re
+import diffcache
+import storage
+import diff_match_patch
+import defaults
+import identitymap
+from lrucache import LRUCache
+import telemetry
+import tracing
 
 import time
+import math
 
 class AddTodoItemForm(forms.Form):
     """A form to add a todo item to a todo list."""
@@ -123,6 +132,10 @@ class Project(models.Model):
         """Url to the calendars page."""
         return '/%s/calendar/' % self.shortname
     
+    def search_url(self):
+        """Url to the search page."""
+        return '/%s/search/' % self.shortname
+    
     
     def metrics_url(self):
         """Url to the metrics page."""
@@ -140,6 +153,7 @@ class Project(models.Model):
         """Url to the settings for this project."""
         return '/%s/settings/' % self.shortname
     
+    @tracing.traced('sql')
     def get_last_date(self):
         """Returns a reasonable last date even if the end date for the project is null."""
         cursor = connection.cursor()
@@ -148,6 +162,7 @@ class Project(models.Model):
         data = cursor.fetchone()
         return data[0]
     
+    @tracing.traced('sql')
     def get_interesting_months(self):
         """Get interesting months for this project. Interesting months are those month in which either a task started or a task ended."""
         cursor = connection.cursor()
@@ -168,18 +183,21 @@ class Project(models.Model):
         """Shows the users which have been invited, but have not accepted the invitation."""
         return self.inviteduser_set.all()
     
+    @tracing.traced('sql')
     def num_deadline_miss(self):
         cursor = connection.cursor()
         cursor.execute('SELECT COUNT(id) FROM project_task WHERE expected_end_date < actual_end_date AND project_id = %s AND is_current = %s' % (self.id, True))
         data = cursor.fetchone()
         return data[0]
     
+    @tracing.traced('sql')
     def extra_hours(self):
         cursor = connection.cursor()
         cursor.execute('SELECT COUNT(project_taskitem.id) FROM project_task, project_taskitem WHERE project_task.number = project_taskitem.task_num AND project_taskitem.expected_time < project_taskitem.actual_time AND project_task.project_id = %s AND project_taskitem.is_current = %s AND project_task.is_current = %s' % (self.id, True, True))
         data = cursor.fetchone()
         return data[0]
     
+    @tracing.traced('sql')
     def num_taskitems(self):
         cursor = connection.cursor()
         stmt = 'SELECT COUNT(project_taskitem.id) FROM project_task, project_taskitem WHERE project_task.number = project_taskitem.task_num AND project_task.project_id = %s AND project_taskitem.is_current = %s  AND project_task.is_current = %s' % (self.id, True, True)
@@ -191,6 +209,7 @@ class Project(models.Model):
         print cursor.fetchall()
         return data[0]
     
+    @tracing.traced('sql')
     def sum_time(self):
         cursor = connection.cursor()
         stmt = 'SELECT unit, sum(CASE WHEN project_taskitem.actual_time IS NULL THEN project_taskitem.expected_time ELSE project_taskitem.actual_time END) FROM project_task, project_taskitem WHERE project_task.number = project_taskitem.task_num AND project_task.project_id = %s AND project_taskitem.is_current = %s  AND project_task.is_current = %s GROUP BY unit' % (self.id, True, True)
@@ -198,24 +217,28 @@ class Project(models.Model):
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def sum_time_complete(self):
         cursor = connection.cursor()
         cursor.execute('SELECT unit, sum(CASE WHEN project_taskitem.actual_time IS NULL THEN project_taskitem.expected_time ELSE project_taskitem.actual_time END) FROM project_task, project_taskitem WHERE project_task.number = project_taskitem.task_num AND project_task.project_id = %s AND project_taskitem.is_current = %s AND project_taskitem.is_complete = %s  AND project_task.is_current = %s GROUP BY unit' % (self.id, True, True, True))
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def start_month(self):
         cursor = connection.cursor()
         cursor.execute('SELECT monthname(expected_start_date), year(expected_start_date), count(id) FROM project_task WHERE project_id = %s AND is_current = %s GROUP BY month(expected_start_date), month(expected_start_date)' % (self.id, True))
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def end_month(self):
         cursor = connection.cursor()
         cursor.execute('SELECT monthname(expected_end_date), year(expected_end_date), count(id) FROM project_task WHERE project_id = %s AND is_current = %s GROUP BY month(expected_end_date), month(expected_end_date)' % (self.id, True))
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def user_tasks_sp(self, user):
         """How many tasks does a specific user have."""
         cursor = connection.cursor()
@@ -224,6 +247,7 @@ class Project(models.Model):
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def user_timeload(self):
         """How much load does a user have."""
         cursor = connection.cursor()
@@ -232,6 +256,7 @@ class Project(models.Model):
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def user_timeload_sp(self, user):
         """How much load does a specific user have."""
         cursor = connection.cursor()
@@ -240,6 +265,7 @@ class Project(models.Model):
         data = cursor.fetchall()
         return data
         
+    @tracing.traced('sql')
     def start_task_dates(self):
         """Number of tasks per day."""
         cursor = connection.cursor()
@@ -247,6 +273,7 @@ class Project(models.Model):
         data = cursor.fetchall()
         return data
         
+    @tracing.traced('sql')
     def task_start_dates_month(self, year, month):
         """Number of tasks per day."""
         cursor = connection.cursor()
@@ -254,6 +281,7 @@ class Project(models.Model):
         data = cursor.fetchall()
         return data
     
+    @tracing.traced('sql')
     def task_end_dates_month(self, year, month):
         """Number of tasks per day."""
         cursor = connection.cursor()
@@ -409,8 +437,12 @@ class Task(models.Model):
         log_description = 'Task was deleted on %s' % time.strftime('%d %B %y')
         log = Log(project = self.project, text=log_text, description = log_description)
         log.save()
+        #The bulk delete does not go through TaskItem, so its items leave the index here.
+        unindex_document(self.project, 'taskitem', list(self.taskitem_set.all().values_list('number', flat = True)))
         self.taskitem_set.all().delete()
+        unindex_document(self.project, 'task', self.number)
         super(Task, self).delete()
+        identitymap.clear()
     
     @classmethod
     def as_csv_header(self):
@@ -419,6 +451,17 @@ class Task(models.Model):
     def as_csv(self):
         return (self.name, self.user_responsible, self.expected_start_date, self.expected_end_date, self.actual_start_date, self.actual_end_date, self.is_complete)
     
+    def get_parent(self):
+        """The current version of the parent task, None for a top level task. See prefetch_tasks."""
+        if self.parent_task_num is None:
+            return None
+        parent = getattr(self, '_parent', None)
+        if parent is None or parent.number != self.parent_task_num:
+            parent = current_task(self.project_id, self.parent_task_num)
+            self._parent = parent
+        return parent
+    parent = property(get_parent, None, None)
+    
     def get_sub_tasks(self):
         """Get subtasks for this task."""
         return Task.objects.filter(project = self.project, parent_task_num = self.number)
@@ -433,44 +476,74 @@ class Task(models.Model):
         """If this is the firsts time populate required details, if this is update version it."""
         if not self.id:
             self.version_number = 1
-            cursor = connection.cursor()
-            cursor.execute('SELECT MAX(number) from project_task WHERE project_id = %s' % self.project.id)
-            num = cursor.fetchone()[0]
-            if not num:
-                num = 0
-            self.number = num + 1#Task.objects.filter(project = self.project, is_current = True).count() + 1
-            if self.user_responsible:
-                log_text = 'Task %s has for %s been created.  ' % (self.name, self.user_responsible)
-            else:
-                log_text = 'Task %s has been created.  ' % self.name
-            log_description = 'Task was created by %s on %s' % (self.created_by.username, time.strftime('%d %B %y'))
-            log = Log(project = self.project, text=log_text, description = log_description)
-            log.save()             
+            self.number = reserve_numbers(self.project, 'project_task')
+            self.creation_log().save()
             super(Task, self).save()
+            self.index()
         else:
             #Version it
             import copy
             new_task = copy.copy(self)
+            previous = Task.all_objects.get(id = self.id)
             """self.is_current = False
             self.effective_end_date = datetime.datetime.now()
             super(Task, self).save()"""
             self.update_field('is_current', False)
             new_task.id = None
             new_task.is_current = True
-            new_task.version_number = self.version_number + 1
+            #After the latest version, this may be an old one which is being rolled back to.
+            cursor = connection.cursor()
+            cursor.execute('SELECT MAX(version_number) FROM project_task WHERE project_id = %s AND number = %s', [self.project_id, self.number])
+            new_task.version_number = cursor.fetchone()[0] + 1
             if self.user_responsible:
                 log_text = 'Task %s for %s has been updated.  ' % (self.name, self.user_responsible)
             else:
                 log_text = 'Task %s has been updated' % (self.name)
             log_description = 'Task was updated by %s on %s' % (self.last_updated_by.username, time.strftime('%d %B %y'))
             log = Log(project = self.project, text=log_text, description = log_description)
-            log.save()            
+            log.save()
             super(Task, new_task).save()
+            diffcache.populate('task', previous, new_task, diffcache.version_text)
+            new_task.index()
+            #The tasks kept for this request may be this one, or sub tasks marked complete with it.
+            identitymap.clear()
             
+    def creation_log(self):
+        if self.user_responsible:
+            log_text = 'Task %s has for %s been created.  ' % (self.name, self.user_responsible)
+        else:
+            log_text = 'Task %s has been created.  ' % self.name
+        log_description = 'Task was created by %s on %s' % (self.created_by.username, time.strftime('%d %B %y'))
+        return Log(project = self.project, text=log_text, description = log_description)
+        
+    @classmethod
+    def create_many(self, tasks):
+        """Create new tasks of one project together, like save would one by one. Tasks without a number are numbered
+        with one query, and they and their logs are inserted in bulk. The ids of the tasks are not set."""
+        if not tasks:
+            return tasks
+        project = tasks[0].project
+        unnumbered = [task for task in tasks if task.number is None]
+        if unnumbered:
+            num = reserve_numbers(project, 'project_task')
+            for task in unnumbered:
+                task.number = num
+                num += 1
+        for task in tasks:
+            task.version_number = 1
+        Log.objects.bulk_create([task.creation_log() for task in tasks])
+        Task.objects.bulk_create(tasks)
+        index_documents(project, 'task', [(task.number, task.name, task.get_absolute_url(), task.name) for task in tasks])
+        return tasks
+        
     def save_without_versioning(self):
         """Have a way to Save without versioning, as we overriden save()"""
         super(Task, self).save()
         
+    def index(self):
+        """Add this task to the search index of the project."""
+        index_document(self.project, 'task', self.number, self.name, self.get_absolute_url(), self.name)
+        
     def update_field(self, field, value):
         """Update a field without updating any other field. We need this when we are versioning a Task and we want to save
         the objects to set its is_current, but not modify any other field."""
@@ -531,14 +604,19 @@ class Task(models.Model):
     
     def add_note(self, text, user):
         """Add a note to this task."""
-        note = TaskNote(text = text, user = user)
+        note = TaskNote(text = text, user = user, project = self.project)
         note.task_num = self.number
         note.save()
+        note.index(self)
+        self._notes = None
         return note
     
     def get_notes(self):
-        """Get notes for this task."""
-        return TaskNote.objects.filter(task_num = self.number)
+        """Get notes for this task, oldest first. They are looked up once, see prefetch_notes."""
+        notes = getattr(self, '_notes', None)
+        if notes is None:
+            notes = self._notes = TaskNote.objects.for_tasks(self.project_id, [self.number]).get(self.number, [])
+        return notes
     
     class Meta:
         ordering = ('-created_on',)
@@ -607,18 +685,10 @@ class TaskItem(models.Model):
         """If this is the firsts time populate required details, if this is update version it."""
         if not self.id:
             self.version_number = 1
-            self.number = -1
-            cursor = connection.cursor()
-            cursor.execute('SELECT MAX(number) from project_taskitem WHERE project_id = %s' % self.project.id)
-            num = cursor.fetchone()[0]
-            if not num:
-                num = 0
-            self.number = num + 1
+            self.number = reserve_numbers(self.project, 'project_taskitem')
             super(TaskItem, self).save()
-            log_text = 'Item %s created for task %s.' % (self.name, self.task.name)
-            log_description = 'Item was created by %s on %s' % (self.created_by.username, time.strftime('%d %B %y'))
-            log = Log(project = self.task.project, text = log_text, description = log_description)
-            log.save()
+            self.creation_log(self.task).save()
+            self.index()
         else:
             #Version it
             import copy
@@ -640,11 +710,42 @@ class TaskItem(models.Model):
             log_description = 'Task was updated by %s on %s' % (self.last_updated_by.username, time.strftime('%d %B %y'))
             log = Log(project = self.task.project, text = log_text, description = log_description)
             log.save()
+            new_item.index()
             
     def save_without_versioning(self):
         """But we migth want the old save which we have overriden. So provide a method which does not version."""
         super(TaskItem, self).save()
         
+    def creation_log(self, task):
+        log_text = 'Item %s created for task %s.' % (self.name, task.name)
+        log_description = 'Item was created by %s on %s' % (self.created_by.username, time.strftime('%d %B %y'))
+        return Log(project = task.project, text = log_text, description = log_description)
+        
+    @classmethod
+    def create_many(self, items, tasks):
+        """Create new task items of one project together, like save would one by one. tasks maps the task_num of the
+        items to their tasks. The items are numbered with one query, and they and their logs are inserted in bulk."""
+        if not items:
+            return items
+        project = items[0].project
+        num = reserve_numbers(project, 'project_taskitem')
+        for item in items:
+            item.number = num
+            item.version_number = 1
+            num += 1
+        TaskItem.objects.bulk_create(items)
+        Log.objects.bulk_create([item.creation_log(tasks[item.task_num]) for item in items])
+        index_documents(project, 'taskitem', [(item.number, item.name, item.search_url(), item.name) for item in items])
+        return items
+        
+    def search_url(self):
+        """Taskitems are shown on the page of their task."""
+        return '/%s/taskdetails/%s/' % (self.project.shortname, self.task_num)
+        
+    def index(self):
+        """Add this taskitem to the search index of the project."""
+        index_document(self.project, 'taskitem', self.number, self.name, self.search_url(), self.name)
+        
     def as_text(self):
         """Summary representation of the taskitem."""
         txt = 'Name: %s \n Task: %s \n Expected time: %s %s \n Actual time: %s %s User: %s' % (self.name, self.task.name, self.expected_time, self.unit, self.actual_time, self.unit, self.user)
@@ -659,8 +760,13 @@ class TaskItem(models.Model):
     
             
     def get_task(self):
-        """Get the task from the taskitem. This is not a direct FK reference as the tasks may be versioned."""
-        return Task.objects.get(project = self.project, number = self.task_num, is_current = True)
+        """Get the task from the taskitem. This is not a direct FK reference as the tasks may be versioned.
+        It is looked up once, see prefetch_tasks."""
+        task = getattr(self, '_task', None)
+        if task is None or task.number != self.task_num:
+            task = current_task(self.project_id, self.task_num)
+            self._task = task
+        return task
     task = property(get_task, None, None)
     
     def version_url(self):
@@ -673,7 +779,7 @@ class TaskItem(models.Model):
     
     def revision_url(self):
         """The url where a previous revision can be seen."""
-        return '/%s/itemrevision/%s/' % (self.task.project, self.id)
+        return '/%s/itemrevision/%s/' % (self.project.shortname, self.id)
         
     
     def old_versions(self):
@@ -805,6 +911,15 @@ class Notice(models.Model):
     def as_csv(self):
         return (self.text, self.user.username, self.created_on.strftime('%Y-%m-%d'))    
     
+    def save(self):
+        super(Notice, self).save()
+        self.index()
+        
+    def index(self):
+        """Add this notice to the search index of the project."""
+        title = 'Notice by %s' % self.user.username
+        index_document(self.project, 'notice', self.id, title, self.project.noticeboard_url(), self.text)
+    
     class Admin:
         pass
     
@@ -835,6 +950,29 @@ class WikiPage(models.Model):
     def version_url(self):
         return '/%s/wiki/%s/revisions/' % (self.project.shortname, self.name)
     
+    def index(self, text):
+        """Add this page, with text as its current text, to the search index of the project."""
+        index_document(self.project, 'wiki', self.id, self.title, self.get_absolute_url(), '%s\n%s' % (self.title, text))
+    
+    def revisions(self):
+        """All the revisions of this page, with their texts rebuilt in one pass, oldest delta bases first."""
+        revisions = list(self.wikipagerevision_set.all())
+        texts = {}
+        for revision in sorted(revisions, key = lambda revision: revision.id):
+            if revision.delta_base_id in texts:
+                text = _wiki_text_cache.get(revision.id)
+                if text is None:
+                    text = texts[revision.delta_base_id]
+                    if revision.delta:
+                        app = diff_match_patch.diff_match_patch()
+                        text, results = app.patch_apply(app.patch_fromText(revision.delta), text)
+                        if not all(results):
+                            raise ValueError('Could not rebuild the text of wiki page revision %s.' % revision.id)
+                    _wiki_text_cache.set(revision.id, text)
+                revision.wiki_text = text
+            texts[revision.id] = revision.wiki_text
+        return revisions
+    
     def save(self):
         if not self.name:
             name = '_'.join(self.title.split())
@@ -867,23 +1005,83 @@ class WikiPageRevision(models.Model):
     created_on: When was this revision created. Auto filled.
     
     Version_number: Version number for this revision. Starts from 1 and increemnst there after.
+    
+    Revisions are stored either as a full snapshot or as a delta against an earlier revision.
+    stored_wiki_text, stored_html_text: The full text, for snapshots. Empty for deltas.
+    delta_base: The revision the delta applies to. Null for snapshots.
+    delta: diff_match_patch patch text which turns the text of delta_base into the text of this revision.
+    chain_length: Number of patches to apply to the nearest snapshot to get this revision. 0 for snapshots.
     """
     user = models.ForeignKey(User)
     wiki_page = models.ForeignKey(WikiPage)
-    wiki_text = models.TextField()
-    html_text = models.TextField()
+    stored_wiki_text = models.TextField(db_column = 'wiki_text', blank = True)
+    stored_html_text = models.TextField(db_column = 'html_text', blank = True)
+    delta_base = models.ForeignKey('self', null = True, blank = True, related_name = 'deltas')
+    delta = models.TextField(null = True, blank = True)
+    chain_length = models.IntegerField(default = 0)
     created_on = models.DateTimeField(auto_now_add = 1)
     version_number = models.IntegerField(default = 0)
     
+    def __init__(self, *args, **kwargs):
+        """Remember which row the stored text was loaded from, so that copies of a revision can rebuild its text."""
+        self._wiki_text = None
+        super(WikiPageRevision, self).__init__(*args, **kwargs)
+        self._loaded_id = self.id
+        
+    def get_wiki_text(self):
+        if self._wiki_text is None:
+            if self._loaded_id and self.delta_base_id:
+                self._wiki_text = rebuild_wiki_text(self._loaded_id, self.wiki_page_id)
+            else:
+                self._wiki_text = self.stored_wiki_text
+        return self._wiki_text
+    
+    def set_wiki_text(self, text):
+        self._wiki_text = text
+        
+    wiki_text = property(get_wiki_text, set_wiki_text)
+    
+    def get_html_text(self):
+        """The html is the wiki text, see save()."""
+        return self.wiki_text
+    html_text = property(get_html_text)
+    
     def save(self):
-        self.html_text = self.wiki_text
+        text = self.wiki_text
         log_text = 'A revision for wiki page %s has been created.' % self.wiki_page.title
         log_description = 'Revision was created by %s on %s.' % (self.user.username, time.strftime('%d %B %y'))
         log = Log(project = self.wiki_page.project, text = log_text, description = log_description)
         last_version = WikiPageRevision.objects.filter(wiki_page = self.wiki_page).count()
         self.version_number = last_version + 1
         log.save()
+        previous = WikiPageRevision.objects.filter(wiki_page = self.wiki_page).order_by('-id')
+        if self.id:
+            previous = previous.filter(id__lt = self.id)
+        previous = previous[:1]
+        previous = previous and previous[0] or None
+        self.encode(previous, text)
         super(WikiPageRevision, self).save()
+        self._loaded_id = self.id
+        _wiki_text_cache.set(self.id, text)
+        if previous:
+            diffcache.populate('wiki', previous, self, diffcache.wiki_text)
+        self.wiki_page.index(text)
+            
+    def encode(self, previous, text):
+        """Store text as a delta against the previous revision, or as a snapshot when the delta chain
+        is long enough already, or when the delta is not smaller than the text."""
+        self.stored_wiki_text = self.stored_html_text = text
+        self.delta_base = None
+        self.delta = None
+        self.chain_length = 0
+        if previous is None or previous.chain_length + 1 >= defaults.wiki_snapshot_interval:
+            return
+        delta = wiki_delta(previous.wiki_text, text)
+        if len(delta) < len(text):
+            self.stored_wiki_text = self.stored_html_text = ''
+            self.delta_base = previous
+            self.delta = delta
+            self.chain_length = previous.chain_length + 1
         
     def get_absolute_url(self):
         return '/%s/wiki/%s/revisions/%s/' % (self.wiki_page.project.shortname, self.wiki_page.name, self.id)
@@ -893,21 +1091,82 @@ class WikiPageRevision(models.Model):
     
     class Meta:
         ordering = ('-created_on',)
-    
+        
+_wiki_text_cache = LRUCache(defaults.wiki_text_cache_size)
+telemetry.watch_cache('wiki_text', _wiki_text_cache)
+
+def wiki_delta(text1, text2):
+    """Patch text turning text1 into text2."""
+    app = diff_match_patch.diff_match_patch()
+    return app.patch_toText(app.patch_make(text1, text2))
+
+def rebuild_wiki_text(revision_id, page_id):
+    """Rebuild the text of a revision stored as a delta, by applying the patches along its delta chain
+    to the nearest snapshot (or cached text). The chain is usually fetched in a single query."""
+    text = _wiki_text_cache.get(revision_id)
+    if text is not None:
+        return text
+    rows = WikiPageRevision.objects.filter(wiki_page = page_id, id__lte = revision_id).order_by('-id')
+    rows = rows.values_list('id', 'delta_base', 'delta', 'stored_wiki_text')[:defaults.wiki_snapshot_interval]
+    rows = dict((row[0], row) for row in rows)
+    deltas = []
+    rev_id = revision_id
+    while True:
+        text = _wiki_text_cache.get(rev_id)
+        if text is not None:
+            break
+        if not rows.has_key(rev_id):
+            rows[rev_id] = WikiPageRevision.objects.filter(id = rev_id).values_list('id', 'delta_base', 'delta', 'stored_wiki_text')[0]
+        rev_id, delta_base, delta, stored_text = rows[rev_id]
+        if delta_base is None:
+            text = stored_text
+            break
+        deltas.append(delta)
+        rev_id = delta_base
+    app = diff_match_patch.diff_match_patch()
+    for delta in reversed(deltas):
+        if not delta:
+            continue
+        text, results = app.patch_apply(app.patch_fromText(delta), text)
+        if not all(results):
+            raise ValueError('Could not rebuild the text of wiki page revision %s.' % revision_id)
+    _wiki_text_cache.set(revision_id, text)
+    return text
+    
+    
+class TaskNoteManager(models.Manager):
+    def for_tasks(self, project_id, numbers):
+        """The notes of the tasks of a project with these numbers, as lists by task number, oldest first, from one query."""
+        notes = {}
+        for note in self.filter(project = project_id, task_num__in = list(numbers)).select_related('user').order_by('id'):
+            notes.setdefault(note.task_num, []).append(note)
+        return notes
     
 class TaskNote(models.Model):
     """
     Task_num: The task for which this note is created.
     We cant just use a foreign key coz, the note is for a specific task number, not a revision of it.
+    project: Project of the task. Notes written before it was added get it from upgrade_schema, see schema.backfill_note_projects.
     text: Text of the noe.
     user: User who wrote this note.
     created_on: When wa sthis note created.
     """
+    project = models.ForeignKey(Project, null = True)
     task_num = models.IntegerField()
     text = models.TextField()
     user = models.ForeignKey(User)
     created_on = models.DateTimeField(auto_now_add = 1)  
     
+    objects = TaskNoteManager()
+    
+    class Meta:
+        index_together = [('project', 'task_num')]
+    
+    def index(self, task):
+        """Add this note to the search index of the project of task."""
+        title = 'Note on %s' % task.name
+        index_document(task.project, 'note', self.id, title, task.get_absolute_url(), self.text)
+    
     
 class ProjectFile(models.Model):
     """project: The project for which this file is attached.
@@ -938,6 +1197,15 @@ class ProjectFile(models.Model):
         log.description = 'File was created on %s' % time.strftime('%d %B %y')
         log.save()
         super(ProjectFile, self).save()
+        self.index()
+
+    def index(self):
+        """Add this file to the search index of the project."""
+        index_document(self.project, 'file', self.id, self.filename, self.project.files_url(), self.filename)
+        
+    def delete(self):
+        unindex_document(self.project, 'file', self.id)
+        super(ProjectFile, self).delete()
         
     def get_s3_url(self):
         return self.current_revision.get_s3_url()
@@ -951,6 +1219,63 @@ class ProjectFile(models.Model):
     class Admin:
         pass
     
+class StoredBlobManager(models.Manager):
+    def reference(self, digest):
+        """Add a reference to the blob with this digest. Returns the blob, or None when it is not stored yet."""
+        if self.filter(digest = digest).update(refcount = models.F('refcount') + 1):
+            return self.get(digest = digest)
+        return None
+    
+    def create_referenced(self, digest, size):
+        """Record a newly stored blob, with one reference.
+        When another upload of the same content recorded it first, reference that one instead."""
+        sid = transaction.savepoint()
+        try:
+            blob = self.create(digest = digest, size = size, refcount = 1)
+            transaction.savepoint_commit(sid)
+            return blob
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            return self.reference(digest)
+        
+    def release(self, blob_ids):
+        """Drop one reference for every id in blob_ids, an id may be there more than once.
+        Deletes the rows of the blobs which are not referenced any more, and returns how many.
+        A blob is only deleted while its refcount is still zero, so one which was just referenced again is kept.
+        Their objects are left for reconcile_storage to delete once they are older than --min-age: an upload of
+        the same content can store the object again right after the row is gone, and deleting it here would
+        delete that new copy."""
+        counts = {}
+        for blob_id in blob_ids:
+            counts[blob_id] = counts.get(blob_id, 0) + 1
+        for blob_id, count in counts.items():
+            self.filter(id = blob_id).update(refcount = models.F('refcount') - count)
+        deleted = 0
+        cursor = connection.cursor()
+        for blob in self.filter(id__in = counts.keys(), refcount__lte = 0):
+            cursor.execute('DELETE FROM project_storedblob WHERE id = %s AND refcount <= 0', [blob.id])
+            deleted += cursor.rowcount
+        transaction.commit_unless_managed()
+        return deleted
+    
+class StoredBlob(models.Model):
+    """File content, stored on S3 once under its sha256 digest, and shared by all the file revisions with that content.
+    refcount: Number of file revisions using this blob."""
+    digest = models.CharField(max_length = 64, unique = True)
+    size = models.IntegerField()
+    refcount = models.IntegerField(default = 0)
+    created_on = models.DateTimeField(auto_now_add = 1)
+    
+    objects = StoredBlobManager()
+    
+    @classmethod
+    def key_for(self, digest):
+        return 'blobs/%s' % digest
+    
+    def key(self):
+        """The S3 key of the content."""
+        return StoredBlob.key_for(self.digest)
+    
 class ProjectFileVersion(models.Model):
     """A specific version of the file uploaded.
     file: file for which this revision was created.
@@ -958,9 +1283,11 @@ class ProjectFileVersion(models.Model):
     version_number = version number of the file uploaded. Starts at 1. Increments thereafter.
     user: The user who created this file.
     size: size of this file revision.
+    blob: The content of this revision. Revisions uploaded before content addressed storage are stored under their revision_name instead.
     """
     file = models.ForeignKey(ProjectFile)
     revision_name = models.CharField(max_length = 200)
+    blob = models.ForeignKey(StoredBlob, null = True, blank = True)
     version_number = models.IntegerField()
     user = models.ForeignKey(User)
     size = models.IntegerField()
@@ -974,16 +1301,28 @@ class ProjectFileVersion(models.Model):
     def get_real_name(self):
         return self.get_name()[1:]
     
+    def storage_key(self):
+        """The key this revision is stored under."""
+        if self.blob_id:
+            return self.blob.key()
+        return self.revision_name
+    
+    def url_key(self):
+        """What signedurls signs for this revision. Content addressed revisions download under the file name."""
+        if self.blob_id:
+            return (self.blob.key(), self.file.filename)
+        return self.get_real_name()
+    
+    def download_url(self):
+        """Url of the download view, used when files are stored locally."""
+        return '/%s/files/%s/download/' % (self.file.project.shortname, self.id)
+    
     def get_s3_url(self):
-        import secrets
-        import S3
-        import defaults
-        gen = S3.QueryStringAuthGenerator(secrets.AWS_ID, secrets.AWS_SECRET_KEY)
-        url = gen.get(defaults.bucket, self.get_real_name())
-        return url
+        """Url to download this revision from, with whichever storage is in use."""
+        return storage.get_storage().url(self)
         
     def save(self):
-        log = Log(text = "New revision for file %s has been created." % (self.filename, self.project.name), project = self.file.project)
+        log = Log(text = "New revision for file %s has been created." % self.file.filename, project = self.file.project)
         log.description = 'Revision was created on %s' % time.strftime('%d %B %y')
         log.save()
         last_version = self.file.projectfileversion_set.count()
@@ -996,6 +1335,208 @@ class ProjectFileVersion(models.Model):
     class Meta:
         ordering = ('-version_number', )
 
+class SearchDocumentManager(models.Manager):
+    def search(self, project, query):
+        """Ids of the documents of project which contain all the words of query, best match first.
+        Documents are ranked by BM25 over the term counts of the index."""
+        terms = list(set(search_terms(query)))
+        if not terms:
+            return []
+        postings = SearchTerm.objects.filter(document__project = project, term__in = terms).values_list('document_id', 'document__length', 'term', 'count')
+        documents = {}
+        frequencies = {}
+        for document_id, length, term, count in postings:
+            documents.setdefault(document_id, [length, {}])[1][term] = count
+            frequencies[term] = frequencies.get(term, 0) + 1
+        total = self.filter(project = project).count()
+        average_length = (self.filter(project = project).aggregate(models.Avg('length'))['length__avg'] or 1.0)
+        k1, b = 1.2, 0.75
+        ranked = []
+        for document_id, (length, counts) in documents.iteritems():
+            if len(counts) < len(terms):
+                continue
+            score = 0.0
+            for term, count in counts.iteritems():
+                idf = math.log(1 + (total - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+                score += idf * count * (k1 + 1) / (count + k1 * (1 - b + b * length / average_length))
+            ranked.append((-score, document_id))
+        ranked.sort()
+        return [document_id for score, document_id in ranked]
+    
+class SearchDocument(models.Model):
+    """An entry in the search index of a project.
+    kind: What was indexed, one of task, taskitem, note, notice, wiki or file.
+    key: Identifies the object within its kind. Task and taskitem numbers, as they stay the same across versions,
+    wiki page and project file ids, and note and notice ids.
+    title, url, summary: What is shown in the search results.
+    length: Number of words indexed, used in ranking."""
+    project = models.ForeignKey(Project)
+    kind = models.CharField(max_length = 20)
+    key = models.IntegerField()
+    title = models.CharField(max_length = 200)
+    url = models.CharField(max_length = 200)
+    summary = models.CharField(max_length = 300, blank = True)
+    length = models.IntegerField(default = 0)
+    updated_on = models.DateTimeField(auto_now = True)
+    
+    objects = SearchDocumentManager()
+    
+    def get_absolute_url(self):
+        return self.url
+    
+    class Meta:
+        unique_together = (('project', 'kind', 'key'),)
+        
+class SearchTerm(models.Model):
+    """Number of times a word appears in a search document."""
+    document = models.ForeignKey(SearchDocument)
+    term = models.CharField(max_length = 40, db_index = True)
+    count = models.IntegerField()
+    
+def search_terms(text):
+    """The lowercased words of text, with html tags left out."""
+    text = re.sub(r'<[^>]*>', ' ', text or '')
+    return [word[:40] for word in re.findall(r'\w+', text.lower(), re.UNICODE)]
+    
+def term_counts(text):
+    counts = {}
+    for term in search_terms(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+    
+def document_values(title, url, text, counts):
+    summary = ' '.join(re.sub(r'<[^>]*>', ' ', text or '').split())[:300]
+    return dict(title = title[:200], url = url, summary = summary, length = sum(counts.values()))
+    
+def current_tasks(project_id, numbers):
+    """The current tasks of a project with these numbers, by number. Tasks looked up before in the request come
+    from the identity map, the others are looked up together."""
+    found = {}
+    missing = []
+    for number in set(numbers):
+        task = identitymap.get(('task', project_id, number))
+        if task is None:
+            missing.append(number)
+        else:
+            found[number] = task
+    for start in range(0, len(missing), 500):
+        for task in Task.objects.filter(project = project_id, number__in = missing[start:start + 500]).select_related('project'):
+            identitymap.add(('task', project_id, task.number), task)
+            found[task.number] = task
+    return found
+    
+def current_task(project_id, number):
+    task = current_tasks(project_id, [number]).get(number)
+    if task is None:
+        raise Task.DoesNotExist('No task %s in project %s.' % (number, project_id))
+    return task
+    
+def prefetch_tasks(objects):
+    """Look up the tasks of task items, or the parents of tasks, for a whole list of them with a query per project,
+    so that their task or parent property does not. Returns the objects as a list."""
+    objects = list(objects)
+    numbers = {}
+    for obj in objects:
+        number = task_reference(obj)
+        if number is not None:
+            numbers.setdefault(obj.project_id, set()).add(number)
+    found = {}
+    for project_id, project_numbers in numbers.items():
+        for number, task in current_tasks(project_id, project_numbers).items():
+            found[(project_id, number)] = task
+    for obj in objects:
+        task = found.get((obj.project_id, task_reference(obj)))
+        if isinstance(obj, Task):
+            obj._parent = task
+        else:
+            obj._task = task
+    return objects
+    
+def prefetch_notes(tasks):
+    """Look up the notes of a page of tasks of one project with one query, so that their get_notes does not.
+    Returns the tasks as a list."""
+    tasks = list(tasks)
+    if tasks:
+        notes = TaskNote.objects.for_tasks(tasks[0].project_id, [task.number for task in tasks])
+        for task in tasks:
+            task._notes = notes.get(task.number, [])
+    return tasks
+    
+def prefetch_children(tasks):
+    """Look up the sub tasks and task items of a page of tasks of one project, with a query for each kind, as the
+    subtasks and task_items lists of every task. Their parent and task are the tasks of the page, see prefetch_tasks.
+    Returns the tasks as a list."""
+    tasks = list(tasks)
+    if not tasks:
+        return tasks
+    project_id = tasks[0].project_id
+    by_number = {}
+    for task in tasks:
+        identitymap.add(('task', project_id, task.number), task)
+        task.subtasks = []
+        task.task_items = []
+        by_number[task.number] = task
+    subtasks = Task.objects.filter(project = project_id, parent_task_num__in = by_number.keys()).select_related('project', 'user_responsible')
+    for subtask in prefetch_tasks(subtasks):
+        by_number[subtask.parent_task_num].subtasks.append(subtask)
+    items = TaskItem.objects.filter(project = project_id, task_num__in = by_number.keys()).select_related('project', 'user')
+    for item in prefetch_tasks(items):
+        by_number[item.task_num].task_items.append(item)
+    return tasks
+    
+def task_reference(obj):
+    """The number of the task obj points at: the parent of a task, the task of a task item."""
+    if isinstance(obj, Task):
+        return obj.parent_task_num
+    return obj.task_num
+    
+@tracing.traced('sql')
+def reserve_numbers(project, table):
+    """The number after the highest number in table, project_task or project_taskitem, for project.
+    Locks the project row till the transaction ends, so that creations running at the same time take turns."""
+    list(Project.objects.select_for_update().filter(id = project.id).values_list('id', flat = True))
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(number) FROM %s WHERE project_id = %%s' % table, [project.id])
+    return (cursor.fetchone()[0] or 0) + 1
+    
+def index_document(project, kind, key, title, url, text):
+    """Add the document to the search index of project, replacing what was indexed for it before."""
+    counts = term_counts(text)
+    values = document_values(title, url, text, counts)
+    document, created = SearchDocument.objects.get_or_create(project = project, kind = kind, key = key, defaults = values)
+    if not created:
+        for name, value in values.items():
+            setattr(document, name, value)
+        document.save()
+        document.searchterm_set.all().delete()
+    SearchTerm.objects.bulk_create([SearchTerm(document = document, term = term, count = count) for term, count in counts.iteritems()])
+    return document
+    
+def index_documents(project, kind, documents, batch_size = 500):
+    """Like index_document for many documents, (key, title, url, text) each, with a few queries per batch_size of them."""
+    for start in range(0, len(documents), batch_size):
+        batch = documents[start:start + batch_size]
+        keys = [key for key, title, url, text in batch]
+        unindex_document(project, kind, keys)
+        counts = {}
+        rows = []
+        for key, title, url, text in batch:
+            counts[key] = term_counts(text)
+            rows.append(SearchDocument(project = project, kind = kind, key = key, **document_values(title, url, text, counts[key])))
+        SearchDocument.objects.bulk_create(rows)
+        ids = SearchDocument.objects.filter(project = project, kind = kind, key__in = keys).values_list('key', 'id')
+        SearchTerm.objects.bulk_create([SearchTerm(document_id = id, term = term, count = count)
+                                        for key, id in ids for term, count in counts[key].iteritems()])
+    
+def unindex_document(project, kind, key):
+    """Remove a document from the search index of project. key can be a list of keys, to remove all of them."""
+    if isinstance(key, (list, tuple)):
+        documents = SearchDocument.objects.filter(project = project, kind = kind, key__in = key)
+    else:
+        documents = SearchDocument.objects.filter(project = project, kind = kind, key = key)
+    SearchTerm.objects.filter(document__in = documents).delete()
+    documents.delete()
+    
 def get_tree(task):
     "Given a task return its sub task hiearchy"
     task_list = []
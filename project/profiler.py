@@ -0,0 +1,152 @@
+"""Profile one request on the live site, for staff.
+
+A request with a profile token, from profile_token(), in its _profile parameter or its X-Profile-Token header
+is run under cProfile, while a thread samples its stack every defaults.profile_sample_interval seconds. The
+response is the normal one, with an X-Profile header naming the files written to defaults.profile_dir:
+<name>.prof, for pstats or snakeviz, and <name>.collapsed, one stack per line with the number of samples it
+was seen in, which flamegraph.pl and speedscope read.
+Tokens are signed with the SECRET_KEY, name a staff user and expire after defaults.profile_token_max_age
+seconds. A process profiles one request at a time and at most defaults.profile_max_per_minute a minute,
+requests over that get X-Profile: busy and are not profiled. Requests without a token are not looked at
+any further, so there is nothing to pay for them.
+"""
+import collections
+import cProfile
+import os
+import sys
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core import signing
+
+import defaults
+from dbinstrument import view_name
+
+SALT = 'project.profiler'
+
+_lock = threading.Lock()
+_started = collections.deque()
+_running = [0]
+
+def profile_token(user):
+    return signing.dumps(user.id, salt = SALT)
+
+def token_user(request):
+    """The staff user the profile token of request is for, or None when it has no valid token."""
+    token = request.GET.get('_profile') or request.META.get('HTTP_X_PROFILE_TOKEN')
+    if not token:
+        return None
+    try:
+        user_id = signing.loads(token, salt = SALT, max_age = defaults.profile_token_max_age)
+    except signing.BadSignature:
+        return None
+    try:
+        return User.objects.get(id = user_id, is_staff = True, is_active = True)
+    except User.DoesNotExist:
+        return None
+
+def acquire():
+    """Whether this process may profile a request now. release() when it is done."""
+    now = time.time()
+    with _lock:
+        while _started and _started[0] < now - 60:
+            _started.popleft()
+        if _running[0] or len(_started) >= defaults.profile_max_per_minute:
+            return False
+        _running[0] += 1
+        _started.append(now)
+        return True
+
+def release():
+    with _lock:
+        _running[0] -= 1
+
+class StackSampler(object):
+    """Counts the stacks a thread is seen in, from a thread of its own."""
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            if not self.running:
+                break
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self):
+        return ''.join('%s %s\n' % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+class RequestProfile(object):
+    def __init__(self, view):
+        self.view = view
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.current_thread().ident, defaults.profile_sample_interval)
+
+    def start(self):
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling and write the files. Returns their name, without the extensions."""
+        self.profile.disable()
+        self.sampler.stop()
+        if not os.path.isdir(defaults.profile_dir):
+            os.makedirs(defaults.profile_dir)
+        now = time.time()
+        name = '%s.%03d-%s-%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), now * 1000 % 1000, self.view, os.getpid())
+        path = os.path.join(defaults.profile_dir, name)
+        self.profile.dump_stats(path + '.prof')
+        f = open(path + '.collapsed', 'w')
+        try:
+            f.write(self.sampler.collapsed())
+        finally:
+            f.close()
+        return name
+
+class ProfilerMiddleware(object):
+    """Put it last, so the profile starts right before the view."""
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not defaults.profile_dir or not ('_profile' in request.GET or 'HTTP_X_PROFILE_TOKEN' in request.META):
+            return None
+        if token_user(request) is None:
+            return None
+        if not acquire():
+            request._profile_busy = True
+            return None
+        request._profile = RequestProfile(view_name(view_func))
+        request._profile.start()
+        return None
+
+    def process_response(self, request, response):
+        profile = getattr(request, '_profile', None)
+        if profile is not None:
+            try:
+                response['X-Profile'] = profile.stop()
+            except (IOError, OSError), e:
+                response['X-Profile'] = 'not written: %s' % e
+            finally:
+                release()
+        elif getattr(request, '_profile_busy', False):
+            response['X-Profile'] = 'busy'
+        return response
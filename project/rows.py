@@ -0,0 +1,74 @@
+"""Read only rows of tasks and task items, for pages and exports which list many of them.
+
+A Task carries a manager for its sub tasks and one for its items, and its user_responsible is loaded with a
+query of its own when it is first used. The rows here are built from values_list, with the usernames and the
+project shortname joined in, so listing any number of them is one query and one small object per row. They
+have the attributes, urls and as_csv of the models, as far as the list templates and the exports use them.
+Use the models where anything is changed or followed further.
+"""
+from models import Task, TaskItem
+
+class TaskRow(object):
+    """A task, as listed. user_responsible is the username, or None."""
+    __slots__ = ('id', 'project_id', 'shortname', 'number', 'name', 'parent_task_num', 'user_responsible',
+                 'expected_start_date', 'expected_end_date', 'actual_start_date', 'actual_end_date',
+                 'is_complete', 'version_number')
+    #What values_list fetches for the slots, in order.
+    fields = ('id', 'project', 'project__shortname', 'number', 'name', 'parent_task_num', 'user_responsible__username',
+              'expected_start_date', 'expected_end_date', 'actual_start_date', 'actual_end_date',
+              'is_complete', 'version_number')
+
+    def __init__(self, values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __unicode__(self):
+        return self.name
+
+    @classmethod
+    def as_csv_header(self):
+        return Task.as_csv_header()
+
+    def as_csv(self):
+        return (self.name, self.user_responsible, self.expected_start_date, self.expected_end_date, self.actual_start_date, self.actual_end_date, self.is_complete)
+
+    def get_absolute_url(self):
+        return '/%s/taskdetails/%s/' % (self.shortname, self.number)
+
+    def edit_url(self):
+        return '/%s/edittask/%s/' % (self.shortname, self.number)
+
+class TaskItemRow(object):
+    """A task item, as listed. user is the username, or None."""
+    __slots__ = ('id', 'project_id', 'shortname', 'number', 'name', 'task_num', 'user',
+                 'expected_time', 'actual_time', 'unit', 'is_complete', 'version_number')
+    fields = ('id', 'project', 'project__shortname', 'number', 'name', 'task_num', 'user__username',
+              'expected_time', 'actual_time', 'unit', 'is_complete', 'version_number')
+
+    def __init__(self, values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __unicode__(self):
+        return self.name
+
+    @classmethod
+    def as_csv_header(self):
+        return TaskItem.as_csv_header()
+
+    def as_csv(self):
+        return (self.name, str(self.expected_time) + self.unit, self.user, self.is_complete)
+
+    def time_worked(self):
+        return '%s %s' % (self.actual_time or self.expected_time, self.unit)
+
+    def edit_url(self):
+        return '/%s/edititem/%s/' % (self.shortname, self.number)
+
+def task_rows(queryset):
+    """TaskRows of the tasks of queryset, in its order, from one query."""
+    return [TaskRow(values) for values in queryset.values_list(*TaskRow.fields).iterator()]
+
+def taskitem_rows(queryset):
+    """TaskItemRows of the items of queryset, in its order, from one query."""
+    return [TaskItemRow(values) for values in queryset.values_list(*TaskItemRow.fields).iterator()]
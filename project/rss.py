@@ -1,9 +1,15 @@
-from django.http import HttpResponseRedirect
+import time
+
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseNotModified, Http404
 from django.contrib.auth.decorators import login_required
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 
 from helpers import *
 from models import *
 import bforms
+import defaults
+from lrucache import LRUCache
+import telemetry
 
 import basicauth
 from django.contrib.syndication.views import Feed as feed_view
@@ -11,30 +17,74 @@ from django.contrib.syndication.views import Feed as feed_view
 
 class ProjectRss(feed_view):
     """Returns the feed for a project."""
-    def get_object(self, bits):
-        if not len(bits) == 1:
-            raise ObjectDoesNotExist('No such feed.')
-        else:
-            project = Project.objects.get(shortname = bits[0])
-            return project
-        
+    def get_object(self, request, shortname):
+        return Project.objects.get(shortname = shortname)
+
     def title(self, obj):
         return 'Feed for project %s' % obj.name
-    
+
     def link(self, obj):
         return obj.get_absolute_url()
-    
+
     def description(self, obj):
         return 'Feed for project %s' % obj.name
-    
-    
+
+
     def items(self, obj):
         return obj.log_set.all()[:30]
-   
-@basicauth.logged_in_or_basicauth()    
+
+    def item_pubdate(self, item):
+        return item.created_on
+
+#Rendered feeds, by (path, is secure, newest log id). A new log changes the key, so entries never go stale.
+_feed_cache = LRUCache(defaults.feed_cache_size)
+telemetry.watch_cache('feed', _feed_cache)
+
+def latest_log(project):
+    """(id, created_on) of the newest log of the project, or None when it has none."""
+    latest = Log.objects.filter(project = project).order_by('-id').values_list('id', 'created_on')[:1]
+    if latest:
+        return latest[0]
+    return None
+
+def not_modified(request, etag, last_modified):
+    """Whether the feed reader has this version of the feed already."""
+    if 'HTTP_IF_NONE_MATCH' in request.META:
+        etags = parse_etags(request.META['HTTP_IF_NONE_MATCH'])
+        return '*' in etags or etag in etags
+    if last_modified is None:
+        return False
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and since >= last_modified
+
+@basicauth.logged_in_or_basicauth(sessionless = True)
 def proj_feed(request, url, feed_dict=None):
-    slug, param = url.split('/', 1)
+    """The feed of a project. It is rendered once per new log, polls in between get it from the cache,
+    or a 304 when the reader has it already."""
+    try:
+        slug, param = url.split('/', 1)
+        feed_class = feed_dict[slug]
+    except (ValueError, KeyError):
+        raise Http404
     project_name = param
     project = get_project(request, project_name)
-    return feed_view(request, url, feed_dict)
+    latest = latest_log(project)
+    latest_id, last_modified = 0, None
+    if latest:
+        latest_id, last_modified = latest[0], int(time.mktime(latest[1].timetuple()))
+    etag = '%s-%s-%s' % (slug, project.id, latest_id)
+    if not_modified(request, etag, last_modified):
+        response = HttpResponseNotModified()
+    else:
+        key = (request.path, request.is_secure(), latest_id)
+        cached = _feed_cache.get(key)
+        if cached is None:
+            feed = feed_class().get_feed(project, request)
+            cached = (feed.mime_type, feed.writeString('utf-8'))
+            _feed_cache.set(key, cached)
+        response = HttpResponse(cached[1], content_type = cached[0])
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
 
@@ -0,0 +1,89 @@
+"""Bring existing tables up to date with the models.
+syncdb creates missing tables but does not alter existing ones, so columns added to a model later are
+added here with ALTER TABLE.
+"""
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Min
+
+def add_missing_columns(model, names = None):
+    """Add the columns of the fields named in names (all local fields by default) which the table of model lacks.
+    Returns the names of the columns added."""
+    cursor = connection.cursor()
+    table = model._meta.db_table
+    columns = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+    qn = connection.ops.quote_name
+    if names is None:
+        names = [field.name for field in model._meta.local_fields]
+    added = []
+    for name in names:
+        field = model._meta.get_field(name)
+        if field.column in columns:
+            continue
+        if field.null:
+            definition = '%s NULL' % field.db_type(connection)
+        else:
+            definition = '%s NOT NULL DEFAULT %s' % (field.db_type(connection), field.get_default())
+        cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (qn(table), qn(field.column), definition))
+        added.append(field.column)
+    transaction.commit_unless_managed()
+    return added
+
+def add_indexes(model, columns):
+    """Create the indexes of model which cover any of columns, the ones add_missing_columns just added.
+    syncdb creates them only with the table."""
+    style = no_style()
+    statements = []
+    for field in model._meta.local_fields:
+        if field.column in columns:
+            statements.extend(connection.creation.sql_indexes_for_field(model, field, style))
+    for names in model._meta.index_together:
+        fields = [model._meta.get_field(name) for name in names]
+        if [field for field in fields if field.column in columns]:
+            statements.extend(connection.creation.sql_indexes_for_fields(model, fields, style))
+    cursor = connection.cursor()
+    for statement in statements:
+        cursor.execute(statement)
+    transaction.commit_unless_managed()
+    return len(statements)
+
+def backfill_note_projects(batch_size = 1000):
+    """Set the project of the task notes written before notes had one. Returns the number of notes which got it
+    from the search index, from their author, and which are left without one.
+    Notes were indexed under the project of their task when they were added, so where the index has a note, that
+    is its project. Other notes go to the one project of their author, if there is just one, which had a task of
+    their number when the note was written. Notes left without a project are not shown on any task."""
+    from project.models import Project, Task, TaskNote, SubscribedUser, SearchDocument
+    counts = {'indexed': 0, 'authors': 0, 'unknown': 0}
+    last = 0
+    while True:
+        notes = list(TaskNote.objects.filter(project__isnull = True, id__gt = last).order_by('id').values_list('id', 'task_num', 'user', 'created_on')[:batch_size])
+        if not notes:
+            return counts
+        last = notes[-1][0]
+        found = dict(SearchDocument.objects.filter(kind = 'note', key__in = [note[0] for note in notes]).values_list('key', 'project'))
+        counts['indexed'] += len(found)
+        rest = [note for note in notes if note[0] not in found]
+        users = set(note[2] for note in rest)
+        projects = {}
+        for user, project in SubscribedUser.objects.filter(user__in = users).values_list('user', 'project'):
+            projects.setdefault(user, set()).add(project)
+        for user, project in Project.objects.filter(owner__in = users).values_list('owner', 'id'):
+            projects.setdefault(user, set()).add(project)
+        candidates = set()
+        for user_projects in projects.values():
+            candidates.update(user_projects)
+        firsts = Task.all_objects.filter(project__in = candidates, number__in = set(note[1] for note in rest))
+        firsts = dict(((project, number), first) for project, number, first in firsts.values_list('project', 'number').annotate(first = Min('created_on')))
+        for id, task_num, user, created_on in rest:
+            matches = [project for project in projects.get(user, ()) if (project, task_num) in firsts and firsts[(project, task_num)] <= created_on]
+            if len(matches) == 1:
+                found[id] = matches[0]
+                counts['authors'] += 1
+            else:
+                counts['unknown'] += 1
+        by_project = {}
+        for id, project in found.items():
+            by_project.setdefault(project, []).append(id)
+        for project, ids in by_project.items():
+            TaskNote.objects.filter(id__in = ids).update(project = project)
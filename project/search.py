@@ -0,0 +1,21 @@
+from django.contrib.auth.decorators import login_required
+
+from helpers import *
+from models import *
+from defaults import *
+
+@login_required
+def search(request, project_name):
+    """Search the tasks, taskitems, notes, notices, wiki pages and files of the project.
+    Results are ranked, best match first, and paged.
+    Actions available here:
+    None"""
+    project = get_project(request, project_name)
+    access = get_access(project, request.user)
+    query = request.GET.get('q', '').strip()
+    ranked = SearchDocument.objects.search(project, query)
+    ids, page_data = get_paged_objects(ranked, request, search_results_per_page)
+    documents = SearchDocument.objects.in_bulk(ids)
+    results = [documents[id] for id in ids if id in documents]
+    payload = {'project':project, 'query':query, 'results':results, 'num_results':len(ranked), 'page_data':page_data}
+    return render(request, 'project/search.html', payload)
@@ -0,0 +1,65 @@
+"""Signed S3 urls for project files.
+One url generator is shared by the process. Urls are cached per (key, expiry bucket): time is cut into
+windows of defaults.signed_url_refresh seconds, and all urls signed in a window expire
+defaults.expires_in after the start of the window. A cached url is so always valid for at least
+expires_in - signed_url_refresh more seconds, and rendering a page of cached urls needs no signing at all.
+"""
+import time
+import threading
+
+import S3
+import secrets
+import defaults
+from lrucache import LRUCache
+import telemetry
+
+_cache = LRUCache(defaults.signed_url_cache_size)
+telemetry.watch_cache('signed_url', _cache)
+_generator = None
+_lock = threading.Lock()
+
+def get_generator():
+    """The url generator of this process."""
+    global _generator
+    if _generator is None:
+        _lock.acquire()
+        try:
+            if _generator is None:
+                _generator = S3.QueryStringAuthGenerator(secrets.AWS_ID, secrets.AWS_SECRET_KEY)
+        finally:
+            _lock.release()
+    return _generator
+
+def window(now = None):
+    """(window number, expiry time) of the expiry bucket now falls in."""
+    if now is None:
+        now = time.time()
+    number = int(now // defaults.signed_url_refresh)
+    return number, number * defaults.signed_url_refresh + defaults.expires_in
+
+def sign(key, now = None):
+    """A signed GET url for key in the files bucket."""
+    return sign_many([key], now)[key]
+
+def sign_many(items, now = None):
+    """Signed GET urls for all the items, as a dict of item to url. Only items which are not cached yet get signed.
+    An item is a key, or a (key, filename) pair for a url which downloads under filename."""
+    number, expires = window(now)
+    urls = {}
+    generator = None
+    for item in items:
+        url = _cache.get((item, number))
+        if url is None:
+            generator = generator or get_generator()
+            if isinstance(item, tuple):
+                key, filename = item
+                query_args = {'response-content-disposition': 'attachment; filename="%s"' % filename.replace('"', '')}
+            else:
+                key, query_args = item, {}
+            url = generator.generate_url('GET', defaults.bucket, key, query_args, {}, expires)
+            _cache.set((item, number), url)
+        urls[item] = url
+    return urls
+
+def clear():
+    _cache.clear()
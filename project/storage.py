@@ -0,0 +1,191 @@
+"""Where project files are stored.
+defaults.file_storage picks the backend: 's3' keeps files in defaults.bucket on S3, 'local' keeps them under
+defaults.local_storage_root, for installations which can not reach S3. Both store, delete and link to
+files by their storage key, see ProjectFileVersion.storage_key.
+"""
+import os
+import errno
+import time
+import mimetypes
+import tempfile
+
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.core.servers.basehttp import FileWrapper
+
+import S3
+import secrets
+import defaults
+import signedurls
+from transfers import TransferManager
+
+class S3Storage(object):
+    """Files in the S3 bucket. Downloads go straight to S3 with signed urls.
+    Requests go through a TransferManager, so they time out, are retried, and deletes run in parallel."""
+
+    def __init__(self, conn = None):
+        self.conn = conn
+        self.manager = None
+
+    def connection(self):
+        if self.conn is None:
+            self.conn = S3.AWSAuthConnection(secrets.AWS_ID, secrets.AWS_SECRET_KEY, timeout = defaults.s3_timeout)
+        return self.conn
+
+    def transfers(self):
+        if self.manager is None:
+            self.manager = TransferManager(self.connection(), threads = defaults.transfer_threads, retries = defaults.transfer_retries)
+        return self.manager
+
+    def save(self, key, uploaded):
+        """Store an uploaded file. Large files are streamed in parts, instead of being read into memory."""
+        return self.transfers().upload_file(defaults.bucket, key, uploaded, defaults.multipart_threshold,
+                                            defaults.multipart_part_size, defaults.multipart_threads).result()
+
+    def delete_many(self, keys):
+        """Delete the keys. Returns (key, code, message) of those S3 would not delete, the others are gone.
+        Keys which were not there are not failures."""
+        failed = []
+        for transfer in self.transfers().delete(defaults.bucket, keys):
+            failed.extend(error for error in transfer.result().errors if error[1] != 'NoSuchKey')
+        return failed
+
+    def list_keys(self, prefix = ''):
+        """The stored objects with keys starting with prefix, as S3.ListEntry objects."""
+        return self.transfers().list(defaults.bucket, prefix).result()
+
+    def iter_keys(self, prefix = '', marker = ''):
+        """Like list_keys, but yields the objects one by one as the listing is read, for buckets too big to hold in memory."""
+        return self.connection().iter_bucket(defaults.bucket, prefix, marker)
+
+    def url(self, revision):
+        return self.urls([revision])[0]
+
+    def urls(self, revisions):
+        """Download urls of the revisions. All of them are signed at once, most come from the cache."""
+        items = [revision.url_key() for revision in revisions]
+        signed = signedurls.sign_many(items)
+        return [signed[item] for item in items]
+
+    def serve(self, revision):
+        return HttpResponseRedirect(self.url(revision))
+
+class LocalStorage(object):
+    """Files on the local disk, under root.
+    Downloads go through a view, which checks access. The file itself is sent by the web server when accel is
+    'x-accel-redirect' (nginx, for internal locations under accel_prefix) or 'x-sendfile' (apache, lighttpd),
+    and streamed from the file otherwise.
+    Files get mode, or 0666 less the umask like any other new file."""
+
+    def __init__(self, root, accel = None, accel_prefix = '', mode = None):
+        self.root = os.path.abspath(root)
+        self.accel = accel
+        self.accel_prefix = accel_prefix
+        if mode is None:
+            #The umask can only be read by setting it.
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        self.mode = mode
+
+    def path(self, key):
+        """Path of the file stored under key. Keys can not point outside of root."""
+        path = os.path.normpath(os.path.join(self.root, key.lstrip('/')))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError('Invalid storage key %r.' % key)
+        return path
+
+    def save(self, key, uploaded):
+        """Store an uploaded file, chunk by chunk. The file appears under its name only once it is complete.
+        mkstemp makes the file readable by this user only, it gets self.mode before it is renamed."""
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir = directory)
+        try:
+            temp = os.fdopen(fd, 'wb')
+            try:
+                for chunk in uploaded.chunks():
+                    temp.write(chunk)
+            finally:
+                temp.close()
+            os.chmod(temp_path, self.mode)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def delete_many(self, keys):
+        """Like S3Storage.delete_many, returns (key, code, message) of the files which could not be removed."""
+        failed = []
+        for key in keys:
+            path = self.path(key)
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError, e:
+                failed.append((key, errno.errorcode.get(e.errno, 'OSError'), e.strerror))
+        return failed
+
+    def iter_keys(self, prefix = '', marker = ''):
+        """Like S3Storage.iter_keys, the stored files with keys starting with prefix and after marker, in key order.
+        One directory is listed at a time. Files are stored without the leading / of keys like the revision_name
+        of old revisions, they are listed with it when prefix has it."""
+        if prefix.startswith('/'):
+            return self._walk('', prefix[1:], marker[1:], '/')
+        return self._walk('', prefix, marker)
+
+    def _walk(self, directory, prefix, marker, shown = ''):
+        names = []
+        for name in os.listdir(os.path.join(self.root, directory)):
+            #The keys in a directory start with its name and a /, that is where it sorts.
+            if os.path.isdir(os.path.join(self.root, directory, name)):
+                name += '/'
+            names.append(name)
+        for name in sorted(names):
+            key = directory + name
+            if key.endswith('/'):
+                if key.startswith(prefix) or prefix.startswith(key):
+                    for entry in self._walk(key, prefix, marker, shown):
+                        yield entry
+            elif key.startswith(prefix) and key > marker:
+                stat = os.stat(os.path.join(self.root, key))
+                modified = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stat.st_mtime))
+                yield S3.ListEntry(shown + key, modified, '', stat.st_size)
+
+    def url(self, revision):
+        return revision.download_url()
+
+    def urls(self, revisions):
+        return [revision.download_url() for revision in revisions]
+
+    def serve(self, revision):
+        key = revision.storage_key()
+        path = self.path(key)
+        filename = revision.file.filename
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if self.accel == 'x-accel-redirect':
+            response = HttpResponse(content_type = content_type)
+            response['X-Accel-Redirect'] = '%s/%s' % (self.accel_prefix.rstrip('/'), key.lstrip('/'))
+        elif self.accel == 'x-sendfile':
+            response = HttpResponse(content_type = content_type)
+            response['X-Sendfile'] = path
+        else:
+            response = StreamingHttpResponse(FileWrapper(open(path, 'rb'), 64 * 1024), content_type = content_type)
+            response['Content-Length'] = str(os.path.getsize(path))
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename.replace('"', '')
+        return response
+
+_storage = None
+
+def get_storage():
+    """The storage backend chosen in defaults."""
+    global _storage
+    if _storage is None:
+        if defaults.file_storage == 'local':
+            _storage = LocalStorage(defaults.local_storage_root, defaults.local_storage_accel, defaults.local_storage_accel_prefix,
+                defaults.local_storage_mode)
+        else:
+            _storage = S3Storage()
+    return _storage
@@ -5,7 +5,9 @@ from helpers import *
 from models import *
 import bforms
 from defaults import *
-import diff_match_patch
+import diffcache
+import importer
+import rows
 import defaults
 
 def project_tasks(request, project_name):
@@ -25,6 +27,7 @@ def project_tasks(request, project_name):
         query_set = project.task_set.filter(parent_task_num__isnull = True)
     else:
         query_set = project.task_set.filter(parent_task_num__isnull = True, is_complete = False)
+    query_set = query_set.select_related('project', 'user_responsible')
     tasks, page_data = get_paged_objects(query_set, request, tasks_on_tasks_page)
     
     if request.method == 'POST':
@@ -43,9 +46,10 @@ def project_tasks(request, project_name):
     if request.GET.get('csv', ''):
         response, writer = reponse_for_cvs(project=project)
         writer.writerow(Task.as_csv_header())
-        for task in tasks:
+        for task in rows.task_rows(query_set):
             writer.writerow(task.as_csv())
         return response
+    tasks = prefetch_children(tasks)
     payload = {'project':project, 'tasks':tasks, 'taskform':taskform, 'page_data':page_data}    
     return render(request, 'project/projecttask.html', payload)
         
@@ -69,7 +73,7 @@ def task_details(request, project_name, task_num):
     
     project = get_project(request, project_name)
     access = get_access(project, request.user)
-    task = Task.objects.get(project = project, number = task_num)
+    task = Task.objects.select_related('project', 'user_responsible').get(project = project, number = task_num)
     
     addsubtaskform = bforms.CreateSubTaskForm(project, task)
     additemform = bforms.CreateTaskItemForm(project, request.user, task)
@@ -104,6 +108,7 @@ def task_details(request, project_name, task_num):
         writer.writerow(Task.as_csv_header())
         writer.writerow(task.as_csv())
         return response
+    prefetch_notes(prefetch_children([task]))
     payload = {'project':project, 'task':task, 'addsubtaskform':addsubtaskform, 'additemform':additemform, 'noteform':noteform}
     return render(request, 'project/taskdetails.html', payload)
 
@@ -235,10 +240,7 @@ def task_history(request, project_name, task_num):
     if version1 and version2:
         taskver1 = Task.all_objects.get(project = project, id = version1)
         taskver2 = Task.all_objects.get(project = project, id = version2)
-        app = diff_match_patch.diff_match_patch()
-        diff = app.diff_main(taskver1.as_text(), taskver2.as_text())
-        app.diff_cleanupSemantic(diff)
-        htmldiff = app.diff_prettyHtml(diff)
+        htmldiff = diffcache.task_diff(taskver1, taskver2)
         payload = {'project':project, 'task':task,'ver1':taskver1, 'ver2':taskver2, 'diff':htmldiff}
         return render(request, 'project/taskdiffresults.html', payload)
     else:
@@ -258,10 +260,7 @@ def taskitem_history(request, project_name, taskitem_num):
     if version1 and version2:
         taskitemver1 = TaskItem.all_objects.get(project = project, id = version1)
         taskitemver2 = TaskItem.all_objects.get(project = project, id = version2)
-        app = diff_match_patch.diff_match_patch()
-        diff = app.diff_main(taskitemver1.as_text(), taskitemver2.as_text())
-        app.diff_cleanupSemantic(diff)
-        htmldiff = app.diff_prettyHtml(diff)
+        htmldiff = diffcache.taskitem_diff(taskitemver1, taskitemver2)
         payload = {'project':project, 'task':taskitem,'ver1':taskitemver1, 'ver2':taskitemver2, 'diff':htmldiff}
         return render(request, 'project/taskdiffresults.html', payload)
     else:
@@ -307,6 +306,26 @@ def taskitems_quickentry(request, project_name):
     payload = {'project':project, 'itementry_form':itementry_form}
     return render(request, 'project/taskitemsquickentry.html', payload)
 
+def tasks_import(request, project_name):
+    """Import tasks, or task items, from a csv file like the ones the task pages export.
+    Actions available here.
+    Import tasks and taskitems: Owner Participant
+    """
+    project = get_project(request, project_name)
+    access = get_access(project, request.user)
+    result = error = None
+    if request.method == 'POST':
+        import_form = bforms.ImportForm(project, request.user, request.POST, request.FILES)
+        if import_form.is_valid():
+            try:
+                result = import_form.save()
+            except importer.ImportFileError, e:
+                error = str(e)
+    else:
+        import_form = bforms.ImportForm(project, request.user)
+    payload = {'project':project, 'import_form':import_form, 'result':result, 'error':error}
+    return render(request, 'project/tasksimport.html', payload)
+
 def task_hierachy(request, project_name):
     """SHow the tasks for project as nested list."""
     project = get_project(request, project_name)
@@ -0,0 +1,325 @@
+"""Counters, gauges and histograms of the site, shown as Prometheus text on /metrics/.
+
+Metrics are made once, at import, with counter(), gauge() or histogram(), and changed with inc(), set() and
+observe(), passing their labels as keywords. TelemetryMiddleware times every request by view, which is what
+Django resolves a url pattern to, and by format (html, csv or pdf), so the p50 and p99 of every page can be
+taken from its histogram. render(), the pdfs, S3 requests, diffs, csv exports and the LRU caches have their
+own metrics.
+A site served by several worker processes sets defaults.telemetry_dir. Every process then writes its values
+to a file of its own there, <pid>.json, every defaults.telemetry_flush_seconds while they change, and
+exposition() adds up the files of all of them. Gauges only count for processes which are still running,
+counters and histograms of stopped processes are kept, like a restart of one worker does not set the totals
+back. Empty the directory when the site is started.
+"""
+import glob
+import logging
+import os
+import threading
+import time
+
+from django.utils import simplejson
+
+import defaults
+from dbinstrument import view_name
+
+logger = logging.getLogger('project.telemetry')
+
+_lock = threading.Lock()
+_metrics = {}
+#Functions which bring the metrics of counts kept elsewhere, like the caches, up to date before they are read.
+_collectors = []
+_flush = {'pid': None, 'dirty': False, 'writer': None}
+#Set to wake the writer thread up, when it is to stop.
+_wake = threading.Event()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        #Label values, in the order of labels, to the value.
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(unicode(labels[label]) for label in self.labels)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        changed()
+
+    def set_total(self, value, **labels):
+        """For counts kept elsewhere, like the hits of a cache, which only grow."""
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = value
+        changed()
+
+    def inc(self, amount = 1, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        changed()
+
+    def dec(self, amount = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_current(self, value, **labels):
+        """For values kept elsewhere, like the size of a cache. Like Counter.set_total it does not call changed(),
+        the collectors run while the values are written and would have them written again every flush."""
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    """values: Label values to [count of each bucket and of +Inf, sum]."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels = (), buckets = DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+        changed()
+
+    def time(self, **labels):
+        """Context manager which observes the seconds its block took."""
+        return Timer(self, labels)
+
+class Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+def register(metric):
+    with _lock:
+        if metric.name not in _metrics:
+            _metrics[metric.name] = metric
+        return _metrics[metric.name]
+
+def counter(name, help, labels = ()):
+    return register(Counter(name, help, labels))
+
+def gauge(name, help, labels = ()):
+    return register(Gauge(name, help, labels))
+
+def histogram(name, help, labels = (), buckets = DEFAULT_BUCKETS):
+    return register(Histogram(name, help, labels, buckets))
+
+def add_collector(func):
+    _collectors.append(func)
+
+def collect():
+    for func in _collectors:
+        func()
+
+cache_requests = counter('dashbard_cache_requests_total', 'Lookups in the in memory caches.', ('cache', 'result'))
+cache_entries = gauge('dashbard_cache_entries', 'Entries in the in memory caches.', ('cache',))
+
+def watch_cache(name, cache):
+    """Report the hits, misses and size of an LRUCache."""
+    def collect_cache():
+        cache_requests.set_total(cache.hits, cache = name, result = 'hit')
+        cache_requests.set_total(cache.misses, cache = name, result = 'miss')
+        cache_entries.set_current(len(cache.data), cache = name)
+    add_collector(collect_cache)
+
+def snapshot():
+    """The metrics of this process, as they are written to its file."""
+    collect()
+    with _lock:
+        return [{'name': metric.name, 'kind': metric.kind, 'help': metric.help, 'labels': metric.labels,
+                 'buckets': getattr(metric, 'buckets', None),
+                 'values': [[list(key), value] for key, value in metric.values.items()]}
+                for metric in _metrics.values()]
+
+def changed():
+    """Have the values of this process written to its file, when there is a telemetry_dir."""
+    if defaults.telemetry_dir is None:
+        return
+    _flush['dirty'] = True
+    if _flush['pid'] != os.getpid():
+        #A new process, or one forked from a process whose writer thread did not come along.
+        _flush['pid'] = os.getpid()
+        writer = threading.Thread(target = write_loop)
+        writer.setDaemon(True)
+        _flush['writer'] = writer
+        writer.start()
+
+def write_loop():
+    pid = os.getpid()
+    while _flush['pid'] == pid:
+        _wake.wait(defaults.telemetry_flush_seconds)
+        if _flush['pid'] != pid:
+            break
+        if defaults.telemetry_dir is None:
+            #Turned off while the site runs. changed() starts a writer again when it is turned back on.
+            _flush['pid'] = None
+            break
+        if _flush['dirty']:
+            try:
+                write()
+            except (IOError, OSError):
+                #The directory may be made or emptied while the site runs, try again next time.
+                _flush['dirty'] = True
+            except Exception:
+                logger.exception('Writing the metrics of process %s failed.', pid)
+
+def stop():
+    """Stop the writer thread of this process, and wait for it."""
+    writer = _flush['writer']
+    _flush['pid'] = _flush['writer'] = None
+    _wake.set()
+    if writer is not None:
+        writer.join()
+    _wake.clear()
+
+def write():
+    """Write the values of this process to its file, replacing the file at once so readers never see half of it."""
+    _flush['dirty'] = False
+    path = os.path.join(defaults.telemetry_dir, '%s.json' % os.getpid())
+    f = open(path + '.tmp', 'w')
+    try:
+        simplejson.dump({'pid': os.getpid(), 'metrics': snapshot()}, f)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def worker_snapshots():
+    """(snapshot, is running) of every process, this one from memory, the others from their files."""
+    pid = os.getpid()
+    yield snapshot(), True
+    if defaults.telemetry_dir is None:
+        return
+    for path in glob.glob(os.path.join(defaults.telemetry_dir, '*.json')):
+        try:
+            f = open(path)
+            try:
+                data = simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            continue
+        if data['pid'] != pid:
+            yield data['metrics'], is_running(data['pid'])
+
+def merged():
+    """The metrics of all the processes, added up, by name."""
+    metrics = {}
+    for metrics_snapshot, running in worker_snapshots():
+        for metric in metrics_snapshot:
+            if metric['kind'] == 'gauge' and not running:
+                continue
+            total = metrics.setdefault(metric['name'], dict(metric, values = {}))
+            for key, value in metric['values']:
+                key = tuple(key)
+                if metric['kind'] == 'histogram':
+                    if key in total['values']:
+                        value = [a + b for a, b in zip(total['values'][key], value)]
+                else:
+                    value = total['values'].get(key, 0) + value
+                total['values'][key] = value
+    return metrics
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_text(names, values, extra = ()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+def number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def exposition():
+    """The metrics of all the processes, in the Prometheus text format."""
+    lines = []
+    metrics = merged()
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['kind']))
+        for key in sorted(metric['values']):
+            value = metric['values'][key]
+            if metric['kind'] != 'histogram':
+                lines.append('%s%s %s' % (name, label_text(metric['labels'], key), number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], value[:-1]):
+                cumulative += count
+                le = bound == '+Inf' and bound or number(float(bound))
+                lines.append('%s_bucket%s %s' % (name, label_text(metric['labels'], key, [('le', le)]), cumulative))
+            lines.append('%s_sum%s %s' % (name, label_text(metric['labels'], key), number(value[-1])))
+            lines.append('%s_count%s %s' % (name, label_text(metric['labels'], key), cumulative))
+    return u'\n'.join(lines).encode('utf-8') + '\n'
+
+request_seconds = histogram('dashbard_request_seconds', 'Time to respond to a request.', ('view', 'format'))
+requests = counter('dashbard_requests_total', 'Requests, by their status.', ('view', 'status'))
+
+def response_format(response):
+    content_type = response.get('Content-Type', '')
+    if content_type.startswith('text/csv'):
+        return 'csv'
+    if content_type.startswith('application/pdf'):
+        return 'pdf'
+    return 'html'
+
+class TelemetryMiddleware(object):
+    """Put it first, so the time of the other middleware is counted too."""
+    def process_request(self, request):
+        request._telemetry_start = time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._telemetry_view = view_name(view_func)
+
+    def process_response(self, request, response):
+        if hasattr(request, '_telemetry_start'):
+            #Requests which did not get to a view, like those for urls which are not there.
+            view = getattr(request, '_telemetry_view', 'none')
+            request_seconds.observe(time.time() - request._telemetry_start, view = view, format = response_format(response))
+            requests.inc(view = view, status = response.status_code)
+        return response
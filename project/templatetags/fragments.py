@@ -0,0 +1,45 @@
+"""Caches rendered template fragments in memory.
+
+    {% load fragments %}
+    {% fragment "taskrow" task.project_id task.number task.version_number %}
+        ...
+    {% endfragment %}
+
+A fragment is rendered once per name and key values, later renders come from an LRUCache. The keys must
+change whenever the output would, like the version_number which Task.save bumps, so entries never need
+to be invalidated, old ones just age out. Keep per request output, like {% csrf_token %} or {% cycle %},
+outside of fragments.
+"""
+from django import template
+
+from project import defaults
+from project.lrucache import LRUCache
+from project import telemetry
+
+register = template.Library()
+
+_fragments = LRUCache(defaults.fragment_cache_size)
+telemetry.watch_cache('fragment', _fragments)
+
+class FragmentNode(template.Node):
+    def __init__(self, name, keys, nodelist):
+        self.name = name
+        self.keys = keys
+        self.nodelist = nodelist
+
+    def render(self, context):
+        key = (self.name,) + tuple([key.resolve(context) for key in self.keys])
+        output = _fragments.get(key)
+        if output is None:
+            output = self.nodelist.render(context)
+            _fragments.set(key, output)
+        return output
+
+@register.tag
+def fragment(parser, token):
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError('%r takes a name and at least one key.' % bits[0])
+    nodelist = parser.parse(('endfragment',))
+    parser.delete_first_token()
+    return FragmentNode(bits[1].strip('"\''), [parser.compile_filter(bit) for bit in bits[2:]], nodelist)
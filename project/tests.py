@@ -1,6 +1,13 @@
 import unittest
 from models import *
 from bforms import *
+import diffcache
+import signedurls
+import storage
+import linediff
+import diff_match_patch
+import defaults
+from models import _wiki_text_cache
 from django.contrib.auth.models import User
 import datetime
 from django.forms import ValidationError
@@ -794,6 +801,2055 @@ class TestUserCreationForm(unittest.TestCase):
         self.assertEqual(form.is_valid(), False)
         
         
+class TestDiffCache(unittest.TestCase):
+    
+    def setUp(self):
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        wikipage = WikiPage(title = 'The best wiki page', project = self.project)
+        wikipage.save()
+        self.page = wikipage
+        diffcache.clear()
+        
+    def testConsecutiveRevisionsCached(self):
+        "Saving a revision caches the diff with the previous revision, both ways."
+        pagerev1 = WikiPageRevision(wiki_page = self.page, wiki_text = 'The quick brown fox', user = self.user)
+        pagerev1.save()
+        pagerev2 = WikiPageRevision(wiki_page = self.page, wiki_text = 'The quick red fox', user = self.user)
+        pagerev2.save()
+        self.assertTrue(('wiki', pagerev1.id, pagerev2.id) in diffcache._cache)
+        self.assertTrue(('wiki', pagerev2.id, pagerev1.id) in diffcache._cache)
+        
+    def testCachedDiffMatchesComputed(self):
+        "Cached diffs are the same as freshly computed ones."
+        pagerev1 = WikiPageRevision(wiki_page = self.page, wiki_text = 'The quick brown fox', user = self.user)
+        pagerev1.save()
+        pagerev2 = WikiPageRevision(wiki_page = self.page, wiki_text = 'The quick red fox jumps', user = self.user)
+        pagerev2.save()
+        cached = diffcache.wiki_diff(pagerev1, pagerev2)
+        diff = diffcache.compute_diff(diffcache.wiki_text(pagerev1), diffcache.wiki_text(pagerev2))
+        self.assertEqual(cached, diffcache.pretty_html(diff))
+        reverse = diffcache.reverse_diff(diff)
+        app = diffcache.diff_match_patch.diff_match_patch()
+        self.assertEqual(app.diff_text1(reverse), diffcache.wiki_text(pagerev2))
+        self.assertEqual(app.diff_text2(reverse), diffcache.wiki_text(pagerev1))
+        self.assertEqual(diffcache.wiki_diff(pagerev2, pagerev1), diffcache.pretty_html(reverse))
+            
+    def testTaskVersionsCached(self):
+        "Versioning a task caches the diff between the old and new version."
+        task = Task(name = 'Foo', user_responsible = self.user, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        task.save()
+        task = Task.objects.get(project = self.project, number = task.number)
+        old_id = task.id
+        task.name = 'Bar'
+        task.save()
+        new_task = Task.objects.get(project = self.project, number = task.number)
+        self.assertTrue(('task', old_id, new_task.id) in diffcache._cache)
+        
+    def tearDown(self):
+        self.user.delete()
+        self.project.delete()
+        
+class TestWikiRevisionStorage(unittest.TestCase):
+    
+    def setUp(self):
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        wikipage = WikiPage(title = 'The best wiki page', project = self.project)
+        wikipage.save()
+        self.page = wikipage
+        self.texts = []
+        text = '\n'.join(['Line %s of a long wiki page.' % i for i in range(100)])
+        for i in range(defaults.wiki_snapshot_interval * 2 + 3):
+            text = text.replace('Line %s ' % i, 'Line %s changed ' % i)
+            self.texts.append(text)
+            pagerev = WikiPageRevision(wiki_page = self.page, wiki_text = text, user = self.user)
+            pagerev.save()
+        _wiki_text_cache.clear()
+        
+    def revisions(self):
+        return WikiPageRevision.objects.filter(wiki_page = self.page).order_by('id')
+        
+    def testDeltas(self):
+        "Only every few revisions store the full text."
+        revisions = self.revisions()
+        snapshots = [revision for revision in revisions if revision.delta_base_id is None]
+        self.assertEqual(len(snapshots), 3)
+        for revision in revisions:
+            self.assertTrue(revision.chain_length < defaults.wiki_snapshot_interval)
+            if revision.delta_base_id:
+                self.assertEqual(revision.stored_wiki_text, '')
+        
+    def testRebuild(self):
+        "Every revision gets its text back."
+        for revision, text in zip(self.revisions(), self.texts):
+            self.assertEqual(revision.wiki_text, text)
+            self.assertEqual(revision.html_text, text)
+        _wiki_text_cache.clear()
+        for revision, text in zip(sorted(self.page.revisions(), key = lambda revision: revision.id), self.texts):
+            self.assertEqual(revision.wiki_text, text)
+            
+    def testBrokenChain(self):
+        "A delta which does not apply to its base is an error, not a wrong text."
+        first = self.revisions()[0]
+        WikiPageRevision.objects.filter(id = first.id).update(stored_wiki_text = 'Nothing like the page any more.')
+        _wiki_text_cache.clear()
+        self.assertRaises(ValueError, self.page.revisions)
+        self.assertRaises(ValueError, lambda: self.revisions()[1].wiki_text)
+        
+    def testRollback(self):
+        "A copy of an old revision saves with the old text."
+        from copy import copy
+        revision = self.revisions()[3]
+        revision = WikiPageRevision.objects.get(id = revision.id)
+        newrevision = copy(revision)
+        newrevision.id = None
+        newrevision.save()
+        _wiki_text_cache.clear()
+        self.assertEqual(WikiPageRevision.objects.get(id = newrevision.id).wiki_text, self.texts[3])
+        
+    def testCompaction(self):
+        "Compacting full text history keeps the texts."
+        for revision in self.revisions():
+            WikiPageRevision.objects.filter(id = revision.id).update(stored_wiki_text = revision.wiki_text, stored_html_text = revision.wiki_text, delta_base = None, delta = None, chain_length = 0)
+        _wiki_text_cache.clear()
+        from django.core.management import call_command
+        import StringIO
+        call_command('compact_wiki_history', stdout = StringIO.StringIO())
+        self.assertEqual(len([revision for revision in self.revisions() if revision.delta_base_id is None]), 3)
+        for revision, text in zip(self.revisions(), self.texts):
+            self.assertEqual(revision.wiki_text, text)
+        
+    def tearDown(self):
+        self.user.delete()
+        self.project.delete()
+        
+class TestLineDiff(unittest.TestCase):
+    
+    def setUp(self):
+        lines = ['line %s of the page\n' % n for n in range(300)]
+        self.text1 = ''.join(lines)
+        lines[10] = 'line ten, rewritten\n'
+        del lines[100:105]
+        lines[200:200] = ['an added line\n', 'line 3 of the page\n']
+        self.text2 = ''.join(lines)
+        self.app = diff_match_patch.diff_match_patch()
+        
+    def testRoundTrip(self):
+        "The line diff goes from text1 to text2, and only the changed lines differ."
+        diff = linediff.line_diff(self.text1, self.text2)
+        self.assertEqual(self.app.diff_text1(diff), self.text1)
+        self.assertEqual(self.app.diff_text2(diff), self.text2)
+        changed = ''.join([data for op, data in diff if op != 0])
+        self.assertTrue(len(changed) < 200)
+        
+    def testTimeLimit(self):
+        "Hunks are not refined once time is up, or when they are too large, and the diff is still correct."
+        for diff in (linediff.line_diff(self.text1, self.text2, time_limit = 1e-9), linediff.line_diff(self.text1, self.text2, refine_max_chars = 1)):
+            self.assertEqual(self.app.diff_text1(diff), self.text1)
+            self.assertEqual(self.app.diff_text2(diff), self.text2)
+            self.assertTrue('10 of the page' in [data for op, data in diff if op == -1])
+        
+    def testEngines(self):
+        "Both engines produce a diff between the same texts."
+        for engine in ('char', 'line'):
+            diff = diffcache.compute_diff(self.text1, self.text2, engine)
+            self.assertEqual(self.app.diff_text2(diff), self.text2)
+        from django.core.management import call_command
+        import StringIO
+        out = StringIO.StringIO()
+        call_command('bench_wiki_diff', synthetic = 200, stdout = out)
+        self.assertTrue('Worst case line' in out.getvalue())
+        
+class TestSearch(unittest.TestCase):
+    
+    def setUp(self):
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        self.task = Task(name = 'Write the release notes', user_responsible = self.user, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        self.task.save()
+        self.task.add_note('The release notes need a section on the upgrade.', self.user)
+        notice = Notice(text = 'Release party on friday!', user = self.user, project = self.project)
+        notice.save()
+        page = WikiPage(title = 'Upgrading', project = self.project)
+        page.save()
+        revision = WikiPageRevision(wiki_page = page, wiki_text = 'How to upgrade. The upgrade needs a <b>release</b> build.', user = self.user)
+        revision.save()
+        page.current_revision = revision
+        page.save()
+        
+    def search(self, query):
+        ids = SearchDocument.objects.search(self.project, query)
+        documents = SearchDocument.objects.in_bulk(ids)
+        return [documents[id].kind for id in ids]
+        
+    def testSearch(self):
+        "All words must match, and documents with more of them rank first."
+        self.assertEqual(sorted(self.search('release')), ['note', 'notice', 'task', 'wiki'])
+        self.assertEqual(self.search('upgrade'), ['wiki', 'note'])
+        self.assertEqual(self.search('release notes'), ['task', 'note'])
+        self.assertEqual(self.search('b'), [])
+        self.assertEqual(self.search(''), [])
+        
+    def testUpdates(self):
+        "A new version of a task replaces what was indexed for it."
+        self.task.name = 'Write the changelog'
+        self.task.save()
+        self.assertEqual(self.search('changelog'), ['task'])
+        self.assertEqual(self.search('release notes'), ['note'])
+        self.assertEqual(SearchDocument.objects.filter(project = self.project, kind = 'task').count(), 1)
+        
+    def testDeleted(self):
+        "Deleted tasks, with their items, and deleted files are not found any more."
+        item = TaskItem(name = 'Proofread the release notes', project = self.project, task_num = self.task.number, expected_time = 1, unit = 'Hours', created_by = self.user, last_updated_by = self.user)
+        item.save()
+        project_file = ProjectFile(project = self.project, filename = 'release-notes.txt', total_size = 0)
+        project_file.save()
+        self.assertEqual(sorted(self.search('release notes')), ['file', 'note', 'task', 'taskitem'])
+        Task.objects.get(id = self.task.id).delete()
+        project_file.delete()
+        self.assertEqual(self.search('release notes'), ['note'])
+        self.assertEqual(SearchDocument.objects.filter(project = self.project, kind__in = ['task', 'taskitem', 'file']).count(), 0)
+        
+    def testRebuild(self):
+        "Rebuilding the index gives the same results, and keeps the notes."
+        from django.core.management import call_command
+        import StringIO
+        SearchTerm.objects.exclude(document__kind = 'note').delete()
+        SearchDocument.objects.exclude(kind = 'note').delete()
+        call_command('rebuild_search_index', 'Foo', stdout = StringIO.StringIO())
+        self.assertEqual(sorted(self.search('release')), ['note', 'notice', 'task', 'wiki'])
+        
+    def testView(self):
+        c = Client()
+        c.login(username = 'Shabda', password = 'shabda')
+        response = c.get('/Foo/search/', {'q': 'upgrade'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result.kind for result in response.context['results']], ['wiki', 'note'])
+        
+    def tearDown(self):
+        self.user.delete()
+        self.project.delete()
+        
+#A local stand in for S3, for the tests of S3.py
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import urllib
+import time
+import hashlib
+import re as _re
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+        
+    def log_message(self, *args):
+        pass
+        
+    def key(self):
+        "Objects are stored by their path, which includes the bucket."
+        return urllib.unquote_plus(urlparse.urlparse(self.path)[2])
+        
+    def query(self):
+        return urlparse.parse_qs(urlparse.urlparse(self.path)[4], keep_blank_values = True)
+        
+    def reply(self, status, body = '', headers = {}):
+        self.server.requests.append((self.command, self.path))
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            status, body, headers = 500, '<Error><Code>InternalError</Code></Error>', {}
+        time.sleep(self.server.delay)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.drop_connections:
+            self.close_connection = 1
+            
+    def body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    
+    def do_PUT(self):
+        query = self.query()
+        if 'partNumber' in query:
+            return self.put_part(int(query['partNumber'][0]), query['uploadId'][0])
+        self.server.objects[self.key()] = self.body()
+        self.reply(200)
+        
+    def put_part(self, part_number, upload_id):
+        data = self.body()
+        if self.server.fail_parts.get(part_number):
+            self.server.fail_parts[part_number] -= 1
+            return self.reply(500, '<Error><Code>InternalError</Code></Error>')
+        self.server.uploads[upload_id][part_number] = data
+        self.reply(200, headers = {'ETag': '"etag-%s"' % part_number})
+        
+    def do_GET(self):
+        if '/' not in self.key().strip('/'):
+            return self.list_bucket(self.key().strip('/'))
+        if self.key() in self.server.objects:
+            self.reply(200, self.server.objects[self.key()])
+        else:
+            self.reply(404, '<Error><Code>NoSuchKey</Code></Error>')
+            
+    def list_bucket(self, bucket):
+        query = self.query()
+        prefix = query.get('prefix', [''])[0]
+        marker = query.get('marker', [''])[0]
+        keys = sorted([key[len(bucket) + 2:] for key in self.server.objects if key.startswith('/%s/%s' % (bucket, prefix))])
+        keys = [key for key in keys if key > marker]
+        max_keys = min(int(query.get('max-keys', [1000])[0]), self.server.max_keys)
+        page = keys[:max_keys]
+        result = '<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker><MaxKeys>%s</MaxKeys>' % (bucket, prefix, marker, max_keys)
+        result += '<IsTruncated>%s</IsTruncated>' % (len(keys) > len(page) and 'true' or 'false')
+        for key in page:
+            data = self.server.objects['/%s/%s' % (bucket, key)]
+            result += '<Contents><Key>%s</Key><LastModified>2013-01-01T00:00:00.000Z</LastModified><ETag>"%s"</ETag><Size>%s</Size></Contents>' % (key, hashlib.md5(data).hexdigest(), len(data))
+        self.reply(200, result + '</ListBucketResult>')
+        
+    def do_DELETE(self):
+        query = self.query()
+        if 'uploadId' in query:
+            del self.server.uploads[query['uploadId'][0]]
+        else:
+            self.server.objects.pop(self.key(), None)
+        self.reply(204)
+        
+    def do_POST(self):
+        body = self.body()
+        query = self.query()
+        if 'uploads' in query:
+            upload_id = 'upload-%s' % len(self.server.requests)
+            self.server.uploads[upload_id] = {}
+            return self.reply(200, '<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>' % upload_id)
+        if 'uploadId' in query:
+            parts = self.server.uploads.pop(query['uploadId'][0])
+            numbers = [int(number) for number in _re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+            self.server.objects[self.key()] = ''.join([parts[number] for number in numbers])
+            return self.reply(200, '<CompleteMultipartUploadResult><Key>%s</Key></CompleteMultipartUploadResult>' % self.key())
+        if 'delete' not in query:
+            return self.reply(400)
+        bucket = self.key().rstrip('/')
+        result = '<DeleteResult>'
+        for key in _re.findall(r'<Key>(.*?)</Key>', body):
+            key = key.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+            if key in self.server.locked:
+                result += '<Error><Key>%s</Key><Code>AccessDenied</Code><Message>Access Denied</Message></Error>' % key
+            elif '%s/%s' % (bucket, key) in self.server.objects:
+                del self.server.objects['%s/%s' % (bucket, key)]
+                if '<Quiet>true</Quiet>' not in body:
+                    result += '<Deleted><Key>%s</Key></Deleted>' % key
+            else:
+                result += '<Error><Key>%s</Key><Code>NoSuchKey</Code><Message>Not there</Message></Error>' % key
+        self.reply(200, result + '</DeleteResult>')
+        
+class FakeS3Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves objects from a dict, on a thread of its own. Counts connections and requests.
+    drop_connections: Close every connection after a response, without telling the client, like an idle timeout.
+    fail_next: Answer the next requests with 500. delay: Seconds to wait before each response.
+    max_keys: Keys per page of a bucket listing. locked: Keys which multi-object deletes fail to delete."""
+    
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FakeS3Handler)
+        self.objects = {}
+        self.uploads = {}
+        self.fail_parts = {}
+        self.requests = []
+        self.connections = 0
+        self.drop_connections = False
+        self.fail_next = 0
+        self.delay = 0
+        self.max_keys = 1000
+        self.locked = set()
+        self.daemon_threads = True
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        
+    def connection(self, **kwargs):
+        import S3
+        self.pool = S3.ConnectionPool()
+        return S3.AWSAuthConnection('id', 'secret', is_secure = False, server = '127.0.0.1', port = self.server_port,
+                                    calling_format = S3.CallingFormat.PATH, pool = self.pool, **kwargs)
+        
+    def handle_error(self, request, client_address):
+        "Clients which time out hang up before the response is written, that is expected."
+        pass
+        
+    def stop(self):
+        "Close the idle client connections too, so the handler threads end."
+        if hasattr(self, 'pool'):
+            self.pool.clear()
+        self.shutdown()
+        self.server_close()
+        
+class TestS3(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = FakeS3Server()
+        self.conn = self.server.connection()
+        
+    def testKeepAlive(self):
+        "Requests reuse one connection."
+        for i in range(5):
+            self.conn.put('bucket', '/Foo/file-%s.txt' % i, 'content')
+        self.assertEqual(self.conn.get('bucket', '/Foo/file-1.txt').object.data, 'content')
+        self.assertEqual(self.server.connections, 1)
+        
+    def testStaleConnection(self):
+        "A connection closed by the server while idle is replaced."
+        self.server.drop_connections = True
+        for i in range(3):
+            self.assertEqual(self.conn.put('bucket', 'file-%s' % i, 'content').http_response.status, 200)
+        self.assertEqual(len(self.server.objects), 3)
+        
+    def testDeleteObjects(self):
+        "Many keys are deleted with one request per thousand keys."
+        keys = ['/Foo/file & %s.txt' % i for i in range(2500)]
+        for key in keys:
+            self.server.objects['/bucket/%s' % key] = 'content'
+        self.server.objects['/bucket/other'] = 'content'
+        responses = self.conn.delete_objects('bucket', keys + ['missing'])
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(self.server.objects.keys(), ['/bucket/other'])
+        self.assertEqual(responses[-1].errors, [('missing', 'NoSuchKey', 'Not there')])
+        self.assertEqual(self.server.connections, 1)
+        
+    def testCanonicalString(self):
+        import S3
+        self.assertTrue(S3.canonical_string('POST', 'bucket', '', {'delete': None}).endswith('/bucket/?delete'))
+        self.assertTrue(S3.canonical_string('PUT', 'bucket', 'key', {'uploadId': 'a', 'partNumber': 2}).endswith('/bucket/key?partNumber=2&uploadId=a'))
+        
+    def testMultipartUpload(self):
+        "Chunks are regrouped into parts, and a failed part is retried on its own."
+        import S3
+        self.server.fail_parts = {2: 1}
+        chunks = ['%05d' % i for i in range(1000)]
+        uploader = S3.MultipartUploader(self.conn, 'bucket', 'big', part_size = 1024, threads = 3)
+        uploader.upload(iter(chunks))
+        self.assertEqual(self.server.objects['/bucket/big'], ''.join(chunks))
+        puts = [path for method, path in self.server.requests if method == 'PUT']
+        self.assertEqual(len(puts), 6)
+        self.assertEqual(self.server.uploads, {})
+        
+    def testMultipartAbort(self):
+        "An upload is aborted when a part keeps failing."
+        import S3
+        self.server.fail_parts = {1: 10}
+        uploader = S3.MultipartUploader(self.conn, 'bucket', 'big', part_size = 1024, threads = 2, retries = 1)
+        self.assertRaises(S3.S3Error, uploader.upload, ['x' * 3000])
+        self.assertEqual(self.server.uploads, {})
+        self.assertFalse('/bucket/big' in self.server.objects)
+        
+    def testMultipartUnexpectedError(self):
+        "A part failing with any other error aborts the upload too, instead of leaving it waiting for the workers."
+        import threading
+        import S3
+        upload_part = self.conn.upload_part
+        def failing(bucket, key, upload_id, part_number, data):
+            if part_number == 1:
+                raise ValueError('bad part')
+            return upload_part(bucket, key, upload_id, part_number, data)
+        self.conn.upload_part = failing
+        uploader = S3.MultipartUploader(self.conn, 'bucket', 'big', part_size = 1024, threads = 2)
+        raised = []
+        def upload():
+            try:
+                uploader.upload(['x' * 1024] * 20)
+            except S3.S3Error, e:
+                raised.append(str(e))
+        thread = threading.Thread(target = upload)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.isAlive())
+        self.assertEqual(raised, ['Could not upload part 1 of big: ValueError: bad part'])
+        self.assertEqual(self.server.uploads, {})
+        
+    def testIterBucket(self):
+        "A bucket walk yields entries as pages are read, and follows the pages."
+        for i in range(25):
+            self.server.objects['/bucket/Foo/file-%02d' % i] = 'x' * i
+        self.server.objects['/bucket/Bar/file'] = 'content'
+        self.server.max_keys = 10
+        walk = self.conn.iter_bucket('bucket', 'Foo/', chunk_size = 64)
+        first = walk.next()
+        self.assertEqual((first.key, first.size), ('Foo/file-00', 0))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual([entry.key for entry in walk], ['Foo/file-%02d' % i for i in range(1, 25)])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual([entry.key for entry in self.conn.iter_bucket('bucket', 'Foo/', 'Foo/file-21')], ['Foo/file-22', 'Foo/file-23', 'Foo/file-24'])
+        
+    def testIterBucketStopped(self):
+        "A walk stopped half way through a page does not leave its connection in the pool."
+        for i in range(2000):
+            self.server.objects['/bucket/file-%04d' % i] = 'content'
+        for entry in self.conn.iter_bucket('bucket', chunk_size = 128):
+            break
+        self.assertEqual(self.conn.get('bucket', 'file-0001').object.data, 'content')
+        self.assertEqual(self.server.connections, 2)
+        
+    def tearDown(self):
+        self.server.stop()
+        
+class TestTransfers(unittest.TestCase):
+    
+    def setUp(self):
+        import transfers
+        self.server = FakeS3Server()
+        self.conn = self.server.connection(timeout = 1)
+        self.manager = transfers.TransferManager(self.conn, threads = 4, retries = 2, backoff = 0.01)
+        
+    def testParallelUploads(self):
+        "Uploads run on the pool, and are counted."
+        submitted = [self.manager.upload('bucket', 'file-%s' % i, 'content %s' % i) for i in range(10)]
+        for transfer in submitted:
+            self.assertEqual(transfer.result(5).http_response.status, 200)
+        self.assertEqual(self.server.objects['/bucket/file-3'], 'content 3')
+        stats = self.manager.stats()['upload']
+        self.assertEqual(stats['requests'], 10)
+        self.assertEqual(stats['bytes'], sum([len('content %s' % i) for i in range(10)]))
+        self.assertTrue(self.server.connections <= 4)
+        
+    def testRetry(self):
+        "A request answered with 500 is sent again."
+        self.server.fail_next = 2
+        self.manager.upload('bucket', 'file', 'content').result(5)
+        self.assertEqual(self.server.objects['/bucket/file'], 'content')
+        stats = self.manager.stats()['upload']
+        self.assertEqual((stats['requests'], stats['failures'], stats['retries']), (3, 2, 2))
+        
+    def testGiveUp(self):
+        "Client errors are not retried, and retries run out."
+        import transfers
+        self.server.objects['/bucket/file'] = 'content'
+        self.assertRaises(transfers.TransferError, self.manager.submit(self.manager.call, 'get', lambda: self.conn.get('bucket', 'missing')).result, 5)
+        self.assertEqual(self.manager.stats()['get']['retries'], 0)
+        self.server.fail_next = 3
+        self.assertRaises(transfers.TransferError, self.manager.upload('bucket', 'file', 'new').result, 5)
+        self.assertEqual(self.manager.stats()['upload']['retries'], 2)
+        
+    def testTimeout(self):
+        "A slow response times out, and is retried."
+        import transfers
+        self.conn.timeout = 0.2
+        self.server.delay = 0.5
+        self.assertRaises(transfers.TransferError, self.manager.upload('bucket', 'file', 'content').result, 10)
+        self.assertEqual(self.manager.stats()['upload']['failures'], 3)
+        
+    def testList(self):
+        "Listings follow the pages."
+        for i in range(25):
+            self.server.objects['/bucket/Foo/file-%02d' % i] = 'x' * i
+        self.server.objects['/bucket/Bar/file'] = 'content'
+        self.server.max_keys = 10
+        entries = self.manager.list('bucket', 'Foo/').result(5)
+        self.assertEqual([entry.key for entry in entries], ['Foo/file-%02d' % i for i in range(25)])
+        self.assertEqual(entries[7].size, 7)
+        self.assertEqual(self.manager.stats()['list']['requests'], 3)
+        
+    def testDelete(self):
+        "Deletes are split in requests of a thousand keys."
+        keys = ['file-%s' % i for i in range(2500)]
+        for key in keys:
+            self.server.objects['/bucket/%s' % key] = 'content'
+        submitted = self.manager.delete('bucket', keys)
+        self.assertEqual(len(submitted), 3)
+        for transfer in submitted:
+            self.assertEqual(transfer.result(5).errors, [])
+        self.assertEqual(self.server.objects, {})
+        
+    def tearDown(self):
+        self.manager.shutdown()
+        self.server.stop()
+        
+class TestSignedUrls(unittest.TestCase):
+    
+    def setUp(self):
+        signedurls.clear()
+        self.signed = []
+        generator = signedurls.get_generator()
+        sign = generator.generate_url
+        def counting_generate_url(method, bucket, key, query_args = {}, headers = {}, expires = None):
+            self.signed.append(key)
+            return sign(method, bucket, key, query_args, headers, expires)
+        generator.generate_url = counting_generate_url
+        
+    def testCache(self):
+        "Urls are signed once per expiry bucket, and stay valid for long enough."
+        now = 1000000 * defaults.signed_url_refresh
+        url = signedurls.sign('Foo/bar-1.txt', now)
+        self.assertEqual(signedurls.sign('Foo/bar-1.txt', now + defaults.signed_url_refresh - 1), url)
+        self.assertEqual(self.signed, ['Foo/bar-1.txt'])
+        expires = int(re.search(r'Expires=(\d+)', url).group(1))
+        self.assertTrue(expires - (now + defaults.signed_url_refresh) >= defaults.expires_in - defaults.signed_url_refresh)
+        self.assertNotEqual(signedurls.sign('Foo/bar-1.txt', now + defaults.signed_url_refresh), url)
+        
+    def testSignMany(self):
+        "A listing signs only what is not cached yet."
+        signedurls.sign('Foo/a-1.txt')
+        urls = signedurls.sign_many(['Foo/a-1.txt', 'Foo/b-1.txt', 'Foo/c-1.txt'])
+        self.assertEqual(self.signed, ['Foo/a-1.txt', 'Foo/b-1.txt', 'Foo/c-1.txt'])
+        self.assertEqual(urls['Foo/b-1.txt'], signedurls.sign('Foo/b-1.txt'))
+        self.assertEqual(len(self.signed), 3)
+        
+    def testDefaultQueryArgs(self):
+        "Signing does not leave the signature in the default query args."
+        import S3
+        generator = S3.QueryStringAuthGenerator('id', 'secret')
+        first = generator.generate_url('GET', 'bucket', 'a', expires = 10)
+        self.assertEqual(generator.generate_url('GET', 'bucket', 'a', expires = 10), first)
+        self.assertEqual(first.count('Signature'), 1)
+        
+    def tearDown(self):
+        del signedurls.get_generator().generate_url
+        signedurls.clear()
+        
+class TestFileStorage(unittest.TestCase):
+    
+    def setUp(self):
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        self.server = FakeS3Server()
+        self.conn = self.server.connection()
+        
+    def add_file(self, name, content):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        form = AddFileForm(self.project, self.user, {}, {'filename': SimpleUploadedFile(name, content)})
+        self.assertTrue(form.is_valid())
+        form.save(storage.S3Storage(self.conn))
+        return ProjectFile.objects.get(project = self.project, filename = name)
+        
+    def testDeduplication(self):
+        "The same content is uploaded once, and shared by the revisions."
+        first = self.add_file('a.txt', 'The content')
+        second = self.add_file('b.txt', 'The content')
+        self.add_file('a.txt', 'The content')
+        puts = [path for method, path in self.server.requests if method == 'PUT']
+        self.assertEqual(len(puts), 1)
+        blob = StoredBlob.objects.get()
+        self.assertEqual(blob.refcount, 3)
+        self.assertEqual(self.server.objects['/%s/%s' % (defaults.bucket, blob.key())], 'The content')
+        self.assertEqual(first.projectfileversion_set.count(), 2)
+        self.assertEqual(second.current_revision.blob_id, blob.id)
+        self.assertTrue('response-content-disposition' in second.current_revision.get_s3_url())
+        
+    def testRelease(self):
+        "A blob is deleted once no revision uses it any more, its object is left for reconcile_storage."
+        first = self.add_file('a.txt', 'The content')
+        self.add_file('a.txt', 'The content')
+        second = self.add_file('b.txt', 'The content')
+        blob = StoredBlob.objects.get()
+        self.assertEqual(StoredBlob.objects.release([blob.id, blob.id]), 0)
+        self.assertEqual(StoredBlob.objects.get().refcount, 1)
+        self.assertEqual(StoredBlob.objects.release([blob.id]), 1)
+        self.assertEqual(StoredBlob.objects.count(), 0)
+        key = '/%s/%s' % (defaults.bucket, blob.key())
+        self.assertTrue(key in self.server.objects)
+        self.add_file('c.txt', 'The content')
+        puts = [path for method, path in self.server.requests if method == 'PUT']
+        self.assertEqual(len(puts), 2)
+        self.assertEqual(StoredBlob.objects.get().refcount, 1)
+        self.assertEqual(self.server.objects[key], 'The content')
+        
+    def testDeleteFailures(self):
+        "Keys S3 would not delete are handed back, keys which were not there are not."
+        first = self.add_file('a.txt', 'First')
+        second = self.add_file('b.txt', 'Second')
+        keys = [first.current_revision.storage_key(), second.current_revision.storage_key()]
+        self.server.locked.add(keys[1])
+        failed = storage.S3Storage(self.conn).delete_many(keys + ['missing'])
+        self.assertEqual(failed, [(keys[1], 'AccessDenied', 'Access Denied')])
+        self.assertEqual(self.server.objects.keys(), ['/%s/%s' % (defaults.bucket, keys[1])])
+        
+    def tearDown(self):
+        self.server.stop()
+        self.user.delete()
+        self.project.delete()
+        StoredBlob.objects.all().delete()
+        
+class TestLocalStorage(unittest.TestCase):
+    
+    def setUp(self):
+        import tempfile
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        self.root = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(self.root)
+        storage._storage = self.storage
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        form = AddFileForm(self.project, self.user, {}, {'filename': SimpleUploadedFile('notes.txt', 'Local content')})
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.revision = ProjectFile.objects.get(project = self.project).current_revision
+        
+    def testSave(self):
+        "Files are stored under their key, and linked to through the download view."
+        import os
+        path = os.path.join(self.root, self.revision.storage_key())
+        self.assertEqual(open(path).read(), 'Local content')
+        self.assertEqual(self.revision.get_s3_url(), '/Foo/files/%s/download/' % self.revision.id)
+        self.assertRaises(ValueError, self.storage.path, '../../etc/passwd')
+        
+    def testMode(self):
+        "Stored files can be read by the web server, not only by the user which stored them."
+        import os
+        import stat
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        umask = os.umask(022)
+        try:
+            default = storage.LocalStorage(self.root)
+            default.save('a.txt', SimpleUploadedFile('a.txt', 'Content'))
+            self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.root, 'a.txt')).st_mode), 0644)
+        finally:
+            os.umask(umask)
+        storage.LocalStorage(self.root, mode = 0640).save('b.txt', SimpleUploadedFile('b.txt', 'Content'))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.root, 'b.txt')).st_mode), 0640)
+        
+    def testServe(self):
+        "The web server is asked to send the file when it can, else the file is streamed."
+        c = Client()
+        c.login(username = 'Shabda', password = 'shabda')
+        response = c.get(self.revision.get_s3_url())
+        self.assertEqual(''.join(response.streaming_content), 'Local content')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.txt"')
+        self.storage.accel, self.storage.accel_prefix = 'x-accel-redirect', '/protected/'
+        response = c.get(self.revision.get_s3_url())
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/%s' % self.revision.storage_key())
+        self.assertEqual(response.content, '')
+        self.storage.accel = 'x-sendfile'
+        self.assertTrue(c.get(self.revision.get_s3_url())['X-Sendfile'].startswith(self.root))
+        
+    def testDelete(self):
+        import os
+        self.storage.delete_many([self.revision.storage_key()])
+        self.assertFalse(os.path.exists(os.path.join(self.root, self.revision.storage_key())))
+        
+    def testIterKeys(self):
+        "Stored files are listed in key order, across directories."
+        import os
+        os.makedirs(os.path.join(self.root, 'a'))
+        for key in ['a/b', 'a-c', 'a.d', 'ab']:
+            open(os.path.join(self.root, key), 'w').write('x')
+        keys = [entry.key for entry in self.storage.iter_keys()]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual([entry.key for entry in self.storage.iter_keys('a')], ['a-c', 'a.d', 'a/b', 'ab'])
+        self.assertEqual([entry.size for entry in self.storage.iter_keys('blobs/')], [len('Local content')])
+        
+    def tearDown(self):
+        import shutil
+        storage._storage = None
+        shutil.rmtree(self.root)
+        self.user.delete()
+        self.project.delete()
+        StoredBlob.objects.all().delete()
+        
+class TestReconcile(unittest.TestCase):
+    
+    def setUp(self):
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        self.server = FakeS3Server()
+        self.server.max_keys = 2
+        storage._storage = storage.S3Storage(self.server.connection())
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        for name, content in [('a.txt', 'First'), ('b.txt', 'Second'), ('a.txt', 'The third')]:
+            form = AddFileForm(self.project, self.user, {}, {'filename': SimpleUploadedFile(name, content)})
+            self.assertTrue(form.is_valid())
+            form.save()
+        self.old = ProjectFile.objects.get(filename = 'b.txt')
+        ProjectFileVersion(file = self.old, revision_name = '/Foo/b-0.txt', user = self.user, size = 3).save()
+        self.server.objects['/%s//Foo/b-0.txt' % defaults.bucket] = 'Old'
+        
+    def reconcile(self, *args, **options):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        out = StringIO()
+        call_command('reconcile_storage', stdout = out, *args, **options)
+        return out.getvalue()
+        
+    def testClean(self):
+        self.assertEqual(ProjectFile.objects.filter(filename = 'b.txt').update(total_size = len('Second') + 3), 1)
+        self.assertTrue(self.reconcile().endswith('4 objects: 0 orphans, 0 missing, 0 wrong sizes, 0 wrong file totals.\n'))
+        
+    def testReport(self):
+        "Orphans, missing objects and wrong sizes are reported, and left alone."
+        bucket = '/%s/' % defaults.bucket
+        self.server.objects[bucket + 'blobs/unknown'] = 'Nobody uses this'
+        del self.server.objects[bucket + StoredBlob.objects.get(size = len('First')).key()]
+        StoredBlob.objects.filter(size = len('Second')).update(size = 100)
+        out = self.reconcile()
+        self.assertTrue('orphan blobs/unknown (16 bytes)' in out)
+        self.assertTrue('size blobs/' in out)
+        self.assertTrue(out.endswith('4 objects: 1 orphans, 1 missing, 1 wrong sizes, 1 wrong file totals.\n'))
+        self.assertTrue(bucket + 'blobs/unknown' in self.server.objects)
+        
+    def testRepair(self):
+        "Old orphans are deleted, sizes are taken from the objects, and file totals are recomputed."
+        bucket = '/%s/' % defaults.bucket
+        self.server.objects[bucket + 'blobs/unknown'] = 'Nobody uses this'
+        self.server.objects[bucket + '/Foo/stray.txt'] = 'Nobody uses this either'
+        self.server.objects[bucket + 'stray'] = 'Not stored by the site'
+        blob = StoredBlob.objects.get(size = len('Second'))
+        StoredBlob.objects.filter(id = blob.id).update(size = 100)
+        ProjectFileVersion.objects.filter(blob = blob).update(size = 100)
+        self.reconcile(repair = True, min_age = 0)
+        self.assertFalse(bucket + 'blobs/unknown' in self.server.objects)
+        self.assertFalse(bucket + '/Foo/stray.txt' in self.server.objects)
+        self.assertTrue(bucket + 'stray' in self.server.objects)
+        self.assertEqual(StoredBlob.objects.get(id = blob.id).size, len('Second'))
+        self.assertEqual(ProjectFile.objects.get(id = self.old.id).total_size, len('Second') + 3)
+        self.assertTrue(self.reconcile().endswith('4 objects: 0 orphans, 0 missing, 0 wrong sizes, 0 wrong file totals.\n'))
+        
+    def testRepairFailures(self):
+        "Orphans S3 would not delete are reported, and found again next time."
+        bucket = '/%s/' % defaults.bucket
+        self.server.objects[bucket + 'blobs/unknown'] = 'Nobody uses this'
+        self.server.objects[bucket + 'blobs/locked'] = 'Nobody uses this either'
+        self.server.locked.add('blobs/locked')
+        out = self.reconcile(repair = True, min_age = 0)
+        self.assertTrue('not deleted blobs/locked: AccessDenied Access Denied' in out)
+        self.assertFalse(bucket + 'blobs/unknown' in self.server.objects)
+        self.assertTrue(self.reconcile().endswith('5 objects: 1 orphans, 0 missing, 0 wrong sizes, 0 wrong file totals.\n'))
+        
+    def tearDown(self):
+        storage._storage = None
+        self.server.stop()
+        self.user.delete()
+        self.project.delete()
+        StoredBlob.objects.all().delete()
+        
+class TestLocalReconcile(unittest.TestCase):
+    "Files on the local disk are reconciled like the objects on S3, legacy ones too."
+    
+    def setUp(self):
+        import os
+        import tempfile
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        self.root = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(self.root)
+        storage._storage = self.storage
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        form = AddFileForm(self.project, self.user, {}, {'filename': SimpleUploadedFile('a.txt', 'First')})
+        self.assertTrue(form.is_valid())
+        form.save()
+        old = ProjectFile.objects.get(filename = 'a.txt')
+        ProjectFileVersion(file = old, revision_name = '/Foo/a-0.txt', user = self.user, size = 3).save()
+        ProjectFile.objects.filter(id = old.id).update(total_size = len('First') + 3)
+        os.mkdir(os.path.join(self.root, 'Foo'))
+        os.mkdir(os.path.join(self.root, 'other'))
+        for name in ('Foo/a-0.txt', 'Foo/stray.txt', 'other/not-ours.txt'):
+            open(os.path.join(self.root, name), 'w').write('Old')
+            
+    def testLegacy(self):
+        "Legacy files are matched with their rows, and only the orphans under the site's prefixes are deleted."
+        import os
+        from django.core.management import call_command
+        from StringIO import StringIO
+        out = StringIO()
+        call_command('reconcile_storage', stdout = out, repair = True, min_age = 0)
+        out = out.getvalue()
+        self.assertTrue('orphan /Foo/stray.txt (3 bytes)' in out)
+        self.assertTrue(out.endswith('3 objects: 1 orphans, 0 missing, 0 wrong sizes, 0 wrong file totals.\n'))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'Foo/stray.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'Foo/a-0.txt')))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'other/not-ours.txt')))
+        
+    def tearDown(self):
+        import shutil
+        storage._storage = None
+        shutil.rmtree(self.root)
+        self.user.delete()
+        self.project.delete()
+        StoredBlob.objects.all().delete()
+        
+class TestFeed(unittest.TestCase):
+    
+    def setUp(self):
+        import rss
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        self.client = Client()
+        self.client.login(username = 'Shabda', password = 'shabda')
+        rss._feed_cache.clear()
+        self.rendered = []
+        get_feed = rss.ProjectRss.get_feed
+        def counting_get_feed(feed, obj, request):
+            self.rendered.append(obj)
+            return get_feed(feed, obj, request)
+        rss.ProjectRss.get_feed = counting_get_feed
+        
+    def testCache(self):
+        "The feed is rendered once per new log."
+        first = self.client.get('/feeds2/project/Foo/')
+        self.assertEqual(first.status_code, 200)
+        self.assertTrue('Bar bax baz' in first.content)
+        second = self.client.get('/feeds2/project/Foo/')
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(len(self.rendered), 1)
+        Log(project = self.project, text = 'Something new happened').save()
+        third = self.client.get('/feeds2/project/Foo/')
+        self.assertTrue('Something new happened' in third.content)
+        self.assertNotEqual(third['ETag'], first['ETag'])
+        self.assertEqual(len(self.rendered), 2)
+        
+    def testNotModified(self):
+        "A reader which has the newest feed gets a 304."
+        first = self.client.get('/feeds2/project/Foo/')
+        response = self.client.get('/feeds2/project/Foo/', HTTP_IF_NONE_MATCH = first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        response = self.client.get('/feeds2/project/Foo/', HTTP_IF_MODIFIED_SINCE = first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get('/feeds2/project/Foo/', HTTP_IF_NONE_MATCH = '"other"').status_code, 200)
+        self.assertEqual(len(self.rendered), 1)
+        
+    def testAccess(self):
+        "Only members get the feed, whether it is cached or not."
+        self.client.get('/feeds2/project/Foo/')
+        User.objects.create_user('Other', 'other@example.com', 'other')
+        other = Client()
+        other.login(username = 'Other', password = 'other')
+        self.assertEqual(other.get('/feeds2/project/Foo/').status_code, 404)
+        self.assertEqual(Client().get('/feeds/project/Foo/').status_code, 401)
+        User.objects.filter(username = 'Other').delete()
+        
+    def tearDown(self):
+        import rss
+        del rss.ProjectRss.get_feed
+        rss._feed_cache.clear()
+        self.user.delete()
+        self.project.delete()
+        
+class TestBasicAuth(unittest.TestCase):
+    
+    def setUp(self):
+        import basicauth
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        basicauth._verified.clear()
+        self.checked = []
+        def counting_authenticate(**credentials):
+            self.checked.append(credentials['username'])
+            return authenticate(**credentials)
+        from django.contrib.auth import authenticate
+        basicauth.authenticate = counting_authenticate
+        
+    def poll(self, password = 'shabda'):
+        import base64
+        header = 'Basic %s' % base64.b64encode('Shabda:%s' % password)
+        return Client().get('/feeds2/project/Foo/', HTTP_AUTHORIZATION = header)
+        
+    def testCache(self):
+        "A password is checked once, and feed polls do not start sessions."
+        from django.contrib.sessions.models import Session
+        sessions = Session.objects.count()
+        for i in range(3):
+            response = self.poll()
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.checked, ['Shabda'])
+        self.assertEqual(Session.objects.count(), sessions)
+        self.assertFalse('sessionid' in response.cookies)
+        self.assertEqual(self.poll('wrong').status_code, 401)
+        self.assertEqual(self.poll('wrong').status_code, 401)
+        self.assertEqual(len(self.checked), 3)
+        
+    def testPasswordChange(self):
+        "Changing the password ends the cached credentials."
+        self.assertEqual(self.poll().status_code, 200)
+        self.user.set_password('new')
+        self.user.save()
+        self.assertEqual(self.poll().status_code, 401)
+        self.assertEqual(self.poll('new').status_code, 200)
+        
+    def testExpiry(self):
+        import basicauth
+        self.poll()
+        ttl = defaults.basicauth_cache_ttl
+        defaults.basicauth_cache_ttl = -1
+        try:
+            basicauth._verified.clear()
+            self.poll()
+            self.poll()
+        finally:
+            defaults.basicauth_cache_ttl = ttl
+        self.assertEqual(len(self.checked), 3)
+        
+    def testBackend(self):
+        "A user from the cache has the backend which authenticated them."
+        import base64
+        import basicauth
+        checking = basicauth.authenticate
+        def other_backend(**credentials):
+            user = checking(**credentials)
+            user.backend = 'project.backends.OtherBackend'
+            return user
+        basicauth.authenticate = other_backend
+        header = base64.b64encode('Shabda:shabda')
+        self.assertEqual(basicauth.authenticate_header(header).backend, 'project.backends.OtherBackend')
+        self.assertEqual(basicauth.authenticate_header(header).backend, 'project.backends.OtherBackend')
+        self.assertEqual(self.checked, ['Shabda'])
+        
+    def testMalformed(self):
+        response = Client().get('/feeds2/project/Foo/', HTTP_AUTHORIZATION = 'Basic !!!')
+        self.assertEqual(response.status_code, 401)
+        
+    def tearDown(self):
+        import basicauth
+        from django.contrib.auth import authenticate
+        basicauth.authenticate = authenticate
+        basicauth._verified.clear()
+        self.user.delete()
+        self.project.delete()
+        
+class TestFragments(unittest.TestCase):
+    
+    def setUp(self):
+        from project.templatetags import fragments
+        fragments._fragments.clear()
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        task = Task(name = 'Foo', user_responsible = self.user, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        task.save()
+        self.task = task
+        
+    def render_row(self, task):
+        from django.template import Template, Context
+        return Template("{% for task in tasks %}{% include 'project/taskrow.html' %}{% endfor %}").render(Context({'tasks': [task]}))
+        
+    def testTaskRow(self):
+        "Rows of unchanged tasks come from the cache, a new version of the task is rendered again."
+        first = self.render_row(self.task)
+        self.assertTrue('>Foo</a>' in first)
+        self.task.name = 'Not saved'
+        self.assertEqual(self.render_row(self.task), first)
+        self.task.name = 'Renamed'
+        self.task.save()
+        current = Task.objects.get(project = self.project, number = self.task.number)
+        self.assertTrue('>Renamed</a>' in self.render_row(current))
+        
+    def testRollbackVersion(self):
+        "Rolling back to an old version makes a new version number, not a copy of an existing one."
+        self.task.name = 'Second'
+        self.task.save()
+        Task.all_objects.get(project = self.project, number = self.task.number, version_number = 1).save()
+        versions = Task.all_objects.filter(project = self.project, number = self.task.number).values_list('version_number', 'name')
+        self.assertEqual(sorted(versions), [(1, 'Foo'), (2, 'Second'), (3, 'Foo')])
+        
+    def tearDown(self):
+        from project.templatetags import fragments
+        fragments._fragments.clear()
+        self.user.delete()
+        self.project.delete()
+        
+class TestQuickEntry(unittest.TestCase):
+    
+    def setUp(self):
+        from django.db import connection
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        task = Task(name = 'Parent', user_responsible = self.user, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        task.save()
+        self.task = task
+        connection.use_debug_cursor = True
+        
+    def key(self, i, name):
+        "Form 0 gets no prefix, as 0 is false."
+        return i and '%s-%s' % (i, name) or name
+        
+    def queries(self, func):
+        "Run func, and return the sql it ran."
+        from django.db import connection
+        connection.queries = []
+        func()
+        return [query['sql'] for query in connection.queries]
+        
+    def testSharedChoices(self):
+        "The forms of a collection share their choices."
+        sql = self.queries(lambda: FormCollection(AddTaskOrSubTaskForm, {'project': self.project, 'user': self.user}, 8))
+        self.assertEqual(len(sql), 2)
+        entry_form = FormCollection(AddTaskOrSubTaskForm, {'project': self.project, 'user': self.user}, 8)
+        self.assertEqual(entry_form.data[7].fields['parent_task'].choices, [('None', 'None'), (self.task.number, 'Parent')])
+        self.assertEqual(entry_form.data[7].fields['user_responsible'].choices, [('None', 'None'), ('Shabda', 'Shabda')])
+        #A project without tasks shares its empty choices too.
+        Task.all_objects.filter(project = self.project).delete()
+        for form_class in (AddTaskOrSubTaskForm, TaskItemQuickForm):
+            sql = self.queries(lambda: FormCollection(form_class, {'project': self.project, 'user': self.user}, 8))
+            self.assertEqual(len(sql), 2)
+        
+    def testSaveTasks(self):
+        "Filled rows are saved together, blank ones are skipped."
+        data = {}
+        for i in range(8):
+            data.update({self.key(i, 'user_responsible'): 'None', self.key(i, 'parent_task'): 'None'})
+        for i, name in enumerate(['First', 'Second', 'Third']):
+            data.update({self.key(i, 'name'): name, self.key(i, 'start_date'): '2013-01-01', self.key(i, 'user_responsible'): 'Shabda'})
+        data['1-parent_task'] = str(self.task.number)
+        entry_form = FormCollection(AddTaskOrSubTaskForm, {'project': self.project, 'user': self.user, 'data': data}, 8)
+        self.assertTrue(entry_form.is_valid())
+        sql = self.queries(entry_form.save)
+        self.assertEqual(len([query for query in sql if 'auth_user' in query]), 1)
+        self.assertEqual(len([query for query in sql if 'MAX(number)' in query]), 1)
+        tasks = Task.objects.filter(project = self.project).order_by('number')
+        self.assertEqual([(task.number, task.name) for task in tasks], [(1, 'Parent'), (2, 'First'), (3, 'Second'), (4, 'Third')])
+        self.assertEqual(tasks[2].parent_task_num, self.task.number)
+        self.assertEqual(tasks[3].user_responsible, self.user)
+        self.assertEqual(Log.objects.filter(project = self.project, text__startswith = 'Task Second').count(), 1)
+        
+    def testInvalidRow(self):
+        "A row which is filled in only partly makes the collection invalid."
+        data = {'name': 'First', 'user_responsible': 'None', 'parent_task': 'None'}
+        entry_form = FormCollection(AddTaskOrSubTaskForm, {'project': self.project, 'user': self.user, 'data': data}, 3)
+        self.assertFalse(entry_form.is_valid())
+        
+    def testSaveItems(self):
+        data = {}
+        for i in range(4):
+            data.update({self.key(i, 'item_name'): 'Item %s' % i, self.key(i, 'time'): '2', self.key(i, 'units'): 'Hours',
+                         self.key(i, 'user'): 'Shabda', self.key(i, 'task'): str(self.task.number)})
+        entry_form = FormCollection(TaskItemQuickForm, {'project': self.project, 'user': self.user, 'data': data}, 8)
+        self.assertTrue(entry_form.is_valid())
+        sql = self.queries(entry_form.save)
+        self.assertEqual(len([query for query in sql if 'FROM "project_task"' in query]), 1)
+        items = TaskItem.objects.filter(project = self.project).order_by('number')
+        self.assertEqual([item.name for item in items], ['Item 0', 'Item 1', 'Item 2', 'Item 3'])
+        self.assertEqual(items[3].number, 4)
+        self.assertEqual(items[3].task, self.task)
+        
+    def tearDown(self):
+        from django.db import connection
+        connection.use_debug_cursor = None
+        self.user.delete()
+        self.project.delete()
+        
+class TestImport(unittest.TestCase):
+    
+    def setUp(self):
+        from django.db import connection
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        task = Task(name = 'Parent', user_responsible = self.user, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        task.save()
+        self.task = task
+        connection.use_debug_cursor = True
+        
+    def csv(self, *rows):
+        import csv, StringIO
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        for row in rows:
+            writer.writerow(row)
+        return out.getvalue()
+        
+    def chunked(self, text, size = 7):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+        
+    def testTaskExport(self):
+        "An export of the tasks page imports back, in small chunks."
+        import importer
+        self.task.actual_start_date = datetime.date(2013, 1, 2)
+        self.task.is_complete = True
+        self.task.save()
+        parent = Task.objects.get(project = self.project, number = self.task.number)
+        text = self.csv(Project.as_csv_header(), self.project.as_csv(), (), Task.as_csv_header(), parent.as_csv(),
+                        ('Second, with "quotes"\nand a new line', '', '2013-02-01', '', '', '', 'False'))
+        result = importer.import_csv(self.project, self.user, self.chunked(text))
+        self.assertEqual((result.kind, result.created, result.errors), ('tasks', 2, []))
+        tasks = Task.objects.filter(project = self.project).order_by('number')
+        self.assertEqual([task.number for task in tasks], [1, 2, 3])
+        self.assertEqual(tasks[1].as_csv()[1:], parent.as_csv()[1:])
+        self.assertEqual(tasks[2].name, 'Second, with "quotes"\nand a new line')
+        self.assertEqual(tasks[2].user_responsible, None)
+        self.assertEqual(SearchDocument.objects.search(self.project, 'quotes'), [SearchDocument.objects.get(project = self.project, kind = 'task', key = 3).id])
+        self.assertEqual(Log.objects.filter(project = self.project, text__startswith = 'Task Second').count(), 1)
+        
+    def testNumbering(self):
+        "Single saves reserve their number like imports do, locking the project first, and both count on from each other."
+        from django.db import connection
+        Task.create_many([Task(name = 'Bulk %s' % i, expected_start_date = today, project = self.project, created_by = self.user, last_updated_by = self.user) for i in range(2)])
+        connection.queries = []
+        task = Task(name = 'Single', expected_start_date = today, project = self.project, created_by = self.user, last_updated_by = self.user)
+        task.save()
+        self.assertEqual(task.number, 4)
+        sql = [query['sql'] for query in connection.queries]
+        lock = [i for i, query in enumerate(sql) if query.startswith('SELECT "project_project"."id" FROM "project_project"')][0]
+        self.assertTrue(sql[lock + 1].startswith('SELECT MAX(number) FROM project_task'))
+        item = TaskItem(name = 'Item', project = self.project, task_num = task.number, expected_time = 1, unit = 'Hours', created_by = self.user, last_updated_by = self.user)
+        item.save()
+        TaskItem.create_many([TaskItem(name = 'Bulk item', project = self.project, task_num = task.number, expected_time = 1, unit = 'Hours', created_by = self.user, last_updated_by = self.user)], {task.number: task})
+        item = TaskItem(name = 'Another item', project = self.project, task_num = task.number, expected_time = 1, unit = 'Hours', created_by = self.user, last_updated_by = self.user)
+        item.save()
+        self.assertEqual(sorted(TaskItem.objects.filter(project = self.project).values_list('number', flat = True)), [1, 2, 3])
+        
+    def testParents(self):
+        "Parents are existing task numbers, or names of tasks, in this import or before it."
+        import importer
+        text = self.csv(('Name', 'User', 'Start Date', 'Parent'), ('Top', 'Shabda', '2013-01-01', ''),
+                        ('Child', 'Shabda', '2013-01-01', 'Top'), ('Grandchild', 'Shabda', '2013-01-01', 'Child'),
+                        ('Under parent', 'Shabda', '2013-01-01', str(self.task.number)), ('By name', 'Shabda', '2013-01-01', 'Parent'),
+                        ('Orphan', 'Shabda', '2013-01-01', 'Nowhere'), ('Lost', 'Shabda', '2013-01-01', '99'))
+        result = importer.import_csv(self.project, self.user, [text], batch_size = 2)
+        self.assertEqual(result.created, 5)
+        self.assertEqual(result.errors, [(7, 'Parent: There is no task Nowhere.'), (8, 'Parent: There is no task 99.')])
+        parents = dict(Task.objects.filter(project = self.project).values_list('name', 'parent_task_num'))
+        numbers = dict(Task.objects.filter(project = self.project).values_list('name', 'number'))
+        self.assertEqual(parents['Child'], numbers['Top'])
+        self.assertEqual(parents['Grandchild'], numbers['Child'])
+        self.assertEqual(parents['Under parent'], self.task.number)
+        self.assertEqual(parents['By name'], self.task.number)
+        self.assertEqual(sorted(numbers.values()), [1, 2, 3, 4, 5, 6])
+        
+    def testRowErrors(self):
+        "Rows are checked like the task forms check them, and the bad ones are reported."
+        import importer
+        text = self.csv(Task.as_csv_header(), ('Good', 'Shabda', '2013-01-01', '2013-01-02', '', '', ''),
+                        ('', 'Shabda', '2013-01-01', '', '', '', ''),
+                        ('Bad date', 'Shabda', 'someday', '2013-01-01', '', '', ''),
+                        ('Backwards', 'Shabda', '2013-01-02', '2013-01-01', '', '', ''),
+                        ('Stranger', 'Nobody', '2013-01-01', '', '', '', ''))
+        result = importer.import_csv(self.project, self.user, [text])
+        self.assertEqual(result.created, 1)
+        self.assertEqual([line for line, message in result.errors], [3, 4, 5, 6])
+        self.assertTrue(result.errors[0][1].startswith('Name: '))
+        self.assertTrue(result.errors[1][1].startswith('Start Date: '))
+        self.assertEqual(result.errors[2][1], 'Start date can not be greater than end date')
+        self.assertTrue(result.errors[3][1].startswith('User: '))
+        self.assertRaises(importer.ImportFileError, importer.import_csv, self.project, self.user, ['Just,some\nthings\n'])
+        
+    def testItems(self):
+        "Task items come from tab separated files too. Their task is in a Task column, or given."
+        import importer
+        rows = [TaskItem.as_csv_header() + ('Task',), ('First', '2.00Hours', 'Shabda', 'False', str(self.task.number)),
+                ('Second', '3Days', '', 'True', ''), ('Third', '1', 'Shabda', 'False', str(self.task.number)),
+                ('Fourth', '1Hours', 'Shabda', 'False', '99')]
+        text = ''.join('\t'.join(row) + '\r\n' for row in rows)
+        result = importer.import_csv(self.project, self.user, self.chunked(text), task_num = self.task.number)
+        self.assertEqual((result.kind, result.created), ('items', 2))
+        self.assertEqual(result.errors, [(4, 'Time: This field is required.'), (5, 'Task: There is no task 99.')])
+        items = TaskItem.objects.filter(project = self.project).order_by('number')
+        self.assertEqual([(item.name, item.expected_time, item.unit, item.user, item.is_complete) for item in items],
+                         [('First', 2, 'Hours', self.user, False), ('Second', 3, 'Days', None, True)])
+        self.assertEqual(items[1].task, self.task)
+        
+    def testBatchQueries(self):
+        "A batch of rows is looked up and inserted in bulk, not row by row."
+        import importer
+        from django.db import connection
+        rows = [Task.as_csv_header()] + [('Task %s' % i, 'Shabda', '2013-01-01', '', '', '', '') for i in range(200)]
+        connection.queries = []
+        result = importer.import_csv(self.project, self.user, [self.csv(*rows)])
+        self.assertEqual(result.created, 200)
+        self.assertTrue(len(connection.queries) < 30)
+        
+    def testUpload(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.test.client import Client
+        client = Client()
+        client.login(username = 'Shabda', password = 'shabda')
+        upload = SimpleUploadedFile('tasks.csv', self.csv(Task.as_csv_header(), ('Uploaded', 'Shabda', '2013-01-01', '', '', '', '')))
+        response = client.post('/Foo/tasks/import/', {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Imported 1 tasks, 0 rows failed.' in response.content)
+        self.assertEqual(Task.objects.filter(project = self.project, name = 'Uploaded').count(), 1)
+        
+    def tearDown(self):
+        from django.db import connection
+        connection.use_debug_cursor = None
+        self.user.delete()
+        self.project.delete()
+        
+class TestRows(unittest.TestCase):
+    
+    def setUp(self):
+        from django.db import connection
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        task = Task(name = 'Parent', user_responsible = self.user, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        task.save()
+        self.task = task
+        subtask = Task(name = 'Child', parent_task_num = task.number, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        subtask.save()
+        item = TaskItem(name = 'Item', project = self.project, task_num = task.number, user = self.user, expected_time = 2, actual_time = 3, unit = 'Hours', created_by = self.user, last_updated_by = self.user)
+        item.save()
+        self.item = item
+        connection.use_debug_cursor = True
+        
+    def testTaskRows(self):
+        "Rows match the tasks they are from, and take one query for all of them."
+        import rows
+        from django.db import connection
+        connection.queries = []
+        task_rows = rows.task_rows(Task.objects.filter(project = self.project).order_by('number'))
+        self.assertEqual(len(connection.queries), 1)
+        tasks = Task.objects.filter(project = self.project).order_by('number')
+        self.assertEqual([row.as_csv() for row in task_rows], [(t.name, t.user_responsible and t.user_responsible.username, t.expected_start_date, t.expected_end_date,
+                                                               t.actual_start_date, t.actual_end_date, t.is_complete) for t in tasks])
+        self.assertEqual([row.get_absolute_url() for row in task_rows], [t.get_absolute_url() for t in tasks])
+        self.assertEqual(task_rows[0].edit_url(), self.task.edit_url())
+        self.assertEqual(task_rows[1].parent_task_num, self.task.number)
+        self.assertFalse(hasattr(task_rows[0], '__dict__'))
+        
+    def testTaskItemRows(self):
+        import rows
+        item_rows = rows.taskitem_rows(TaskItem.objects.filter(project = self.project))
+        item = TaskItem.objects.get(project = self.project, number = self.item.number)
+        self.assertEqual(item_rows[0].as_csv(), (item.name, str(item.expected_time) + item.unit, 'Shabda', item.is_complete))
+        self.assertEqual(item_rows[0].time_worked(), item.time_worked())
+        self.assertEqual(item_rows[0].edit_url(), item.edit_url())
+        
+    def testViews(self):
+        "The export, the user page and the json of the project list rows."
+        from django.test.client import Client
+        from django.db import connection
+        client = Client()
+        client.login(username = 'Shabda', password = 'shabda')
+        response = client.get('/Foo/tasks/', {'csv': 1})
+        self.assertTrue('Parent,Shabda,' in response.content)
+        response = client.get('/Foo/user/Shabda/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.task.get_absolute_url() in response.content)
+        self.assertTrue(self.item.edit_url() in response.content)
+        connection.queries = []
+        response = client.get('/projson/Foo/')
+        self.assertEqual(len([query for query in connection.queries if 'project_task' in query['sql']]), 1)
+        from django.utils import simplejson
+        items = dict((item['name'], item) for item in simplejson.loads(response.content)['items'])
+        self.assertEqual(items['Parent'], {'name': 'Parent', 'type': 'task', 'children': [{'_reference': 'Child'}]})
+        self.assertEqual(items['Child']['children'], [])
+        
+    def tearDown(self):
+        from django.db import connection
+        connection.use_debug_cursor = None
+        self.user.delete()
+        self.project.delete()
+        
+class TestTaskReferences(unittest.TestCase):
+    
+    def setUp(self):
+        from django.db import connection
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        self.tasks = []
+        for name in ('First', 'Second'):
+            task = Task(name = name, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+            task.save()
+            self.tasks.append(task)
+        subtask = Task(name = 'Child', parent_task_num = self.tasks[0].number, expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        subtask.save()
+        for i in range(4):
+            item = TaskItem(name = 'Item %s' % i, project = self.project, task_num = self.tasks[i % 2].number, expected_time = 1, unit = 'Hours', created_by = self.user, last_updated_by = self.user)
+            item.save()
+        connection.use_debug_cursor = True
+        
+    def task_queries(self, func):
+        "Run func, and return the number of queries on tasks it ran."
+        from django.db import connection
+        connection.queries = []
+        func()
+        return len([query for query in connection.queries if 'FROM "project_task"' in query['sql']])
+        
+    def testInstanceCache(self):
+        "An item looks its task up once."
+        item = TaskItem.objects.filter(project = self.project)[0]
+        self.assertEqual(self.task_queries(lambda: (item.task, item.task, item.as_text(), item.revision_url())), 1)
+        item.task_num = self.tasks[1].number
+        self.assertEqual(item.task.name, 'Second')
+        
+    def testPrefetch(self):
+        "The tasks of a list of items, and the parents of tasks, take one query."
+        items = []
+        self.assertEqual(self.task_queries(lambda: items.extend(prefetch_tasks(TaskItem.objects.filter(project = self.project)))), 1)
+        self.assertEqual(self.task_queries(lambda: [item.task for item in items]), 0)
+        self.assertEqual(sorted((item.name, item.task.name) for item in items), [('Item 0', 'First'), ('Item 1', 'Second'), ('Item 2', 'First'), ('Item 3', 'Second')])
+        tasks = prefetch_tasks(Task.objects.filter(project = self.project))
+        self.assertEqual(self.task_queries(lambda: [task.parent for task in tasks]), 0)
+        self.assertEqual(dict((task.name, task.parent and task.parent.name) for task in tasks), {'First': None, 'Second': None, 'Child': 'First'})
+        
+    def testPrefetchChildren(self):
+        "The sub tasks and items of a page of tasks take a query each, and point back at the tasks of the page."
+        import identitymap
+        identitymap.start()
+        try:
+            tasks = list(Task.objects.filter(project = self.project, parent_task_num__isnull = True).order_by('number'))
+            self.assertEqual(self.task_queries(lambda: prefetch_children(tasks)), 1)
+        finally:
+            identitymap.stop()
+        self.assertEqual([[subtask.name for subtask in task.subtasks] for task in tasks], [['Child'], []])
+        self.assertEqual([sorted(item.name for item in task.task_items) for task in tasks], [['Item 0', 'Item 2'], ['Item 1', 'Item 3']])
+        self.assertTrue(tasks[0].subtasks[0].parent is tasks[0] and tasks[1].task_items[0].task is tasks[1])
+        
+    def testIdentityMap(self):
+        "In a request, tasks are looked up once for all the objects pointing at them, until a task is saved."
+        import identitymap
+        identitymap.start()
+        try:
+            items = list(TaskItem.objects.filter(project = self.project, task_num = self.tasks[0].number))
+            self.assertEqual(self.task_queries(lambda: [item.task for item in items]), 1)
+            self.assertTrue(items[0].task is items[1].task)
+            task = items[0].task
+            task.name = 'Renamed'
+            task.save()
+            item = TaskItem.objects.get(project = self.project, number = items[0].number)
+            self.assertEqual(item.task.name, 'Renamed')
+        finally:
+            identitymap.stop()
+        items = list(TaskItem.objects.filter(project = self.project, task_num = self.tasks[0].number))
+        self.assertEqual(self.task_queries(lambda: [item.task for item in items]), 2)
+        self.assertRaises(Task.DoesNotExist, lambda: TaskItem(project = self.project, task_num = 99).task)
+        
+    def tearDown(self):
+        from django.db import connection
+        connection.use_debug_cursor = None
+        self.user.delete()
+        self.project.delete()
+        
+class TestTaskNotes(unittest.TestCase):
+    
+    def setUp(self):
+        from django.db import connection
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        self.projects = []
+        self.tasks = []
+        for shortname in ('Foo', 'Bar'):
+            project = Project(shortname = shortname, name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+            project.save()
+            self.projects.append(project)
+            task = Task(name = 'Task of %s' % shortname, expected_start_date = datetime.date.today(), project = project, created_by = self.user, last_updated_by = self.user)
+            task.save()
+            self.tasks.append(task)
+        self.project = self.projects[0]
+        connection.use_debug_cursor = True
+        
+    def queries(self, func):
+        from django.db import connection
+        connection.queries = []
+        func()
+        return len(connection.queries)
+        
+    def testProjectNotes(self):
+        "Tasks of the same number in two projects have their own notes, looked up once."
+        self.tasks[0].add_note('First note', self.user)
+        self.tasks[0].add_note('Second note', self.user)
+        self.tasks[1].add_note('Other project', self.user)
+        self.assertEqual(self.tasks[0].number, self.tasks[1].number)
+        task = Task.objects.get(project = self.project, number = self.tasks[0].number)
+        self.assertEqual(self.queries(lambda: [(note.text, note.user.username) for note in task.get_notes()]), 1)
+        self.assertEqual(self.queries(task.get_notes), 0)
+        self.assertEqual([note.text for note in task.get_notes()], ['First note', 'Second note'])
+        self.assertEqual([note.text for note in self.tasks[1].get_notes()], ['Other project'])
+        
+    def testPrefetchNotes(self):
+        "The notes of a page of tasks take one query."
+        more = Task(name = 'More', expected_start_date = datetime.date.today(), project = self.project, created_by = self.user, last_updated_by = self.user)
+        more.save()
+        more.add_note('On more', self.user)
+        tasks = []
+        self.assertEqual(self.queries(lambda: tasks.extend(prefetch_notes(Task.objects.filter(project = self.project).order_by('number')))), 2)
+        self.assertEqual(self.queries(lambda: [task.get_notes() for task in tasks]), 0)
+        self.assertEqual([[note.text for note in task.get_notes()] for task in tasks], [[], ['On more']])
+        
+    def testIndex(self):
+        from django.db import connection
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA index_list(project_tasknote)')
+        columns = []
+        for row in cursor.fetchall():
+            cursor.execute('PRAGMA index_info(%s)' % row[1])
+            columns.append([info[2] for info in cursor.fetchall()])
+        self.assertTrue(['project_id', 'task_num'] in columns)
+        
+    def testBackfill(self):
+        "upgrade_schema gives old notes the project of the search index, or the one project of their author with their task."
+        from django.core.management import call_command
+        import StringIO
+        indexed = self.tasks[1].add_note('Indexed', self.user)
+        other = User.objects.create_user('Other', 'other@example.com', 'other')
+        SubscribedUser(user = other, project = self.project, group = 'Participant').save()
+        authored = TaskNote(task_num = self.tasks[0].number, text = 'By a participant', user = other)
+        authored.save()
+        ambiguous = TaskNote(task_num = self.tasks[0].number, text = 'By the owner of both', user = self.user)
+        ambiguous.save()
+        missing = TaskNote(task_num = 99, text = 'No such task', user = other)
+        missing.save()
+        TaskNote.objects.all().update(project = None)
+        out = StringIO.StringIO()
+        try:
+            call_command('upgrade_schema', stdout = out)
+            self.assertTrue('Task notes: 1 projects from the search index, 1 from their authors, 2 unknown.' in out.getvalue())
+            projects = dict(TaskNote.objects.values_list('text', 'project'))
+            self.assertEqual(projects, {'Indexed': self.projects[1].id, 'By a participant': self.project.id, 'By the owner of both': None, 'No such task': None})
+        finally:
+            TaskNote.objects.all().delete()
+            other.delete()
+        
+    def tearDown(self):
+        from django.db import connection
+        connection.use_debug_cursor = None
+        self.user.delete()
+        for project in self.projects:
+            project.delete()
+        
+def seed_project(project, user, tasks):
+    """Fill project with tasks, each with a sub task, two items and a note, and a wiki page per task."""
+    for i in range(tasks):
+        task = Task(name = 'Task %s' % i, user_responsible = user, expected_start_date = today, project = project, created_by = user, last_updated_by = user)
+        task.save()
+        subtask = Task(name = 'Sub task %s' % i, parent_task_num = task.number, user_responsible = user, expected_start_date = today, project = project, created_by = user, last_updated_by = user)
+        subtask.save()
+        for j in range(2):
+            item = TaskItem(name = 'Item %s %s' % (i, j), project = project, task_num = task.number, user = user, expected_time = 2, unit = 'Hours', created_by = user, last_updated_by = user)
+            item.save()
+        task.add_note('Note %s' % i, user)
+        page = WikiPage(title = 'Page%s' % i, project = project)
+        page.save()
+        revision = WikiPageRevision(wiki_page = page, wiki_text = 'Text of page %s' % i, user = user)
+        revision.save()
+    
+class TestQueryBudget(unittest.TestCase):
+    """The pages of a seeded project stay within their number of queries. A page over its budget usually
+    looks up something per row, the fingerprints which repeat say what."""
+    
+    #Most queries of a page, for the project seeded with seed_project(project, user, 3).
+    budgets = {
+        '/dashboard/': 6,
+        '/Foo/': 16,
+        '/Foo/logs/': 7,
+        '/Foo/noticeboard/': 6,
+        '/Foo/todo/': 6,
+        '/Foo/tasks/': 10,
+        '/Foo/tasks/?csv=1': 9,
+        '/Foo/taskhier/': 14,
+        '/Foo/taskdetails/1/': 19,
+        '/Foo/wiki/': 9,
+        '/Foo/wiki/Page0/': 8,
+        '/Foo/user/Shabda/': 9,
+        '/projson/Foo/': 5,
+    }
+    
+    def setUp(self):
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        seed_project(project, user, 3)
+        self.client = Client()
+        self.client.login(username = 'Shabda', password = 'shabda')
+        #Time the queries of every request, not a sample of them.
+        self.sample_rate = defaults.query_sample_rate
+        defaults.query_sample_rate = 1.0
+        
+    def assertQueryBudget(self, url, budget):
+        """Get url and fail when it takes more than budget queries."""
+        import dbinstrument
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, '%s: status %s' % (url, response.status_code))
+        queries = dbinstrument.last_request()
+        repeated = '\n'.join('%s times: %s' % (count, key) for key, count in sorted(queries.duplicates.items()))
+        self.assertTrue(queries.count <= budget, '%s took %s queries, its budget is %s. Repeated queries:\n%s' % (url, queries.count, budget, repeated))
+        return queries
+        
+    #Pages which still look up something per task or page, their budget grows with the project.
+    grows_per_row = ['/Foo/taskhier/', '/Foo/wiki/']
+    
+    def testBudgets(self):
+        for url, budget in sorted(self.budgets.items()):
+            self.assertQueryBudget(url, budget)
+            
+    def testMoreRows(self):
+        "The other pages take as many queries for a project twice the size."
+        seed_project(self.project, self.user, 3)
+        for url, budget in sorted(self.budgets.items()):
+            if url not in self.grows_per_row:
+                self.assertQueryBudget(url, budget)
+                
+    def testFiles(self):
+        "The files page signs the urls of all the revisions at once, however many files there are."
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        server = FakeS3Server()
+        storage._storage = storage.S3Storage(server.connection())
+        try:
+            for names in [('a.txt', 'b.txt'), ('c.txt', 'd.txt', 'e.txt', 'f.txt')]:
+                for name in names * 2:
+                    form = AddFileForm(self.project, self.user, {}, {'filename': SimpleUploadedFile(name, 'Content of %s' % name)})
+                    self.assertTrue(form.is_valid())
+                    form.save()
+                self.assertQueryBudget('/Foo/files/', 6)
+            self.assertEqual(self.client.get('/Foo/files/').content.count('Signature'), 18)
+        finally:
+            server.stop()
+            storage._storage = None
+            StoredBlob.objects.all().delete()
+            
+    def testStats(self):
+        import dbinstrument
+        self.assertEqual(dbinstrument.fingerprint("SELECT * FROM t WHERE a = 12 AND b IN (1, 2, 3) AND c = 'it''s'"),
+                         "SELECT * FROM t WHERE a = ? AND b IN (?...) AND c = ?")
+        self.assertEqual(dbinstrument.fingerprint("SELECT * FROM t WHERE a = %s AND b IN (%s, %s)"), "SELECT * FROM t WHERE a = ? AND b IN (?...)")
+        dbinstrument.reset()
+        self.client.get('/Foo/tasks/')
+        self.client.get('/Foo/tasks/')
+        stats = dict((s.view, s) for s in dbinstrument.stats())
+        tasks = stats['project.tasks.project_tasks']
+        self.assertEqual(tasks.requests, 2)
+        self.assertTrue(0 < tasks.max_queries <= self.budgets['/Foo/tasks/'] and tasks.max_queries < tasks.queries)
+        self.assertTrue(tasks.top_duplicates(1)[0][0] > 0)
+        self.assertEqual(sum(tasks.histogram.totals()), 2)
+        fingerprints = dbinstrument.top_fingerprints(1000)
+        self.assertEqual(sum(query.count for query in fingerprints), tasks.queries)
+        self.assertTrue('project.tasks.project_tasks' in dict(fingerprints[0].top_views()))
+        
+    def testHistogram(self):
+        import dbinstrument
+        histogram = dbinstrument.Histogram()
+        window = defaults.query_histogram_window
+        for seconds in [0.003] * 9 + [0.3]:
+            histogram.add(seconds, 10 * window)
+        self.assertEqual((histogram.percentile(0.5, 10 * window), histogram.percentile(0.95, 10 * window)), ('5ms', '500ms'))
+        histogram.add(10, 11 * window)
+        self.assertEqual(sum(histogram.totals(11 * window)), 11)
+        self.assertEqual(histogram.percentile(1, 11 * window), '>5s')
+        self.assertEqual(sum(histogram.totals(12 * window)), 1)
+        self.assertEqual(histogram.percentile(0.5, 14 * window), None)
+        
+    def testSlowQueries(self):
+        "Slow queries are kept with their plan, which is looked up once per window."
+        import dbinstrument
+        from django.db import connection
+        slow_query_seconds = defaults.slow_query_seconds
+        defaults.slow_query_seconds = 0
+        dbinstrument.logger.disabled = True
+        dbinstrument.reset()
+        try:
+            dbinstrument.start('test')
+            for i in range(2):
+                cursor = connection.cursor()
+                cursor.execute('SELECT COUNT(*) FROM project_task WHERE project_id = %s', [self.project.id])
+                self.assertEqual(cursor.fetchone()[0], 6)
+            record = dbinstrument.stop()
+        finally:
+            defaults.slow_query_seconds = slow_query_seconds
+            dbinstrument.logger.disabled = False
+        self.assertEqual(record.duplicates, {'SELECT COUNT(*) FROM project_task WHERE project_id = ?': 2})
+        query = dbinstrument.top_fingerprints(1)[0]
+        self.assertEqual((query.count, query.slow), (2, 2))
+        self.assertTrue('project_task' in query.plan)
+        self.assertEqual([slow['view'] for slow in dbinstrument.slow_queries()], ['test', 'test'])
+        #Not timed outside of start() and stop().
+        self.assertFalse(isinstance(connection.cursor(), dbinstrument.TimedCursor))
+        
+    def testStaffPage(self):
+        self.client.get('/Foo/tasks/')
+        response = self.client.get('/querystats/')
+        self.assertFalse('project.tasks.project_tasks' in response.content)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/querystats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('project.tasks.project_tasks' in response.content)
+        self.client.post('/querystats/')
+        self.assertFalse('project.tasks.project_tasks' in self.client.get('/querystats/').content)
+    
+    def tearDown(self):
+        defaults.query_sample_rate = self.sample_rate
+        self.user.delete()
+        self.project.delete()
+        
+def metric_values():
+    """The lines of the telemetry exposition, by what comes before the value."""
+    import telemetry
+    lines = [line.rsplit(' ', 1) for line in telemetry.exposition().splitlines() if not line.startswith('#')]
+    return dict((name, float(value)) for name, value in lines)
+    
+class TestTelemetry(unittest.TestCase):
+    
+    def setUp(self):
+        import tempfile
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        self.dir = tempfile.mkdtemp()
+        
+    def testExposition(self):
+        import telemetry
+        counter = telemetry.counter('test_things_total', 'Things.', ('kind',))
+        gauge = telemetry.gauge('test_level', 'Level.')
+        histogram = telemetry.histogram('test_seconds', 'Seconds.', ('kind',), buckets = (0.1, 1))
+        counter.inc(kind = 'a "quoted"\nthing')
+        counter.inc(2, kind = 'b')
+        gauge.set(7)
+        for seconds in (0.05, 0.5, 0.7, 3):
+            histogram.observe(seconds, kind = 'x')
+        text = telemetry.exposition()
+        self.assertTrue('# TYPE test_seconds histogram\n' in text)
+        self.assertTrue('test_things_total{kind="a \\"quoted\\"\\nthing"} 1\n' in text)
+        self.assertTrue('test_seconds_bucket{kind="x",le="0.1"} 1\ntest_seconds_bucket{kind="x",le="1.0"} 3\n'
+                        'test_seconds_bucket{kind="x",le="+Inf"} 4\ntest_seconds_sum{kind="x"} 4.25\ntest_seconds_count{kind="x"} 4\n' in text)
+        values = metric_values()
+        self.assertEqual((values['test_things_total{kind="b"}'], values['test_level']), (2, 7))
+        self.assertTrue(telemetry.counter('test_things_total', 'Things.', ('kind',)) is counter)
+        
+    def testWorkerFiles(self):
+        "The files of other workers are added up, without the gauges of workers which stopped."
+        from django.utils import simplejson
+        import os
+        import telemetry
+        counter = telemetry.counter('test_worker_total', 'Worker things.')
+        gauge = telemetry.gauge('test_worker_level', 'Worker level.')
+        counter.inc(1)
+        gauge.set(1)
+        telemetry_dir = defaults.telemetry_dir
+        defaults.telemetry_dir = self.dir
+        try:
+            telemetry.write()
+            self.assertTrue(os.path.exists(os.path.join(self.dir, '%s.json' % os.getpid())))
+            for pid in (os.getppid(), 2 ** 22 + 1):
+                metrics = [{'name': 'test_worker_total', 'kind': 'counter', 'help': 'Worker things.', 'labels': [], 'buckets': None, 'values': [[[], 10]]},
+                           {'name': 'test_worker_level', 'kind': 'gauge', 'help': 'Worker level.', 'labels': [], 'buckets': None, 'values': [[[], 100]]}]
+                f = open(os.path.join(self.dir, '%s.json' % pid), 'w')
+                simplejson.dump({'pid': pid, 'metrics': metrics}, f)
+                f.close()
+            values = metric_values()
+        finally:
+            defaults.telemetry_dir = telemetry_dir
+            telemetry.stop()
+        self.assertEqual((values['test_worker_total'], values['test_worker_level']), (21, 101))
+        
+    def testWriteOnChange(self):
+        "Writing the values does not have them written again, the collectors of the caches only read their counts."
+        import lrucache
+        import telemetry
+        cache = lrucache.LRUCache(10)
+        telemetry.watch_cache('test', cache)
+        cache.set('key', 'value')
+        telemetry_dir = defaults.telemetry_dir
+        defaults.telemetry_dir = self.dir
+        try:
+            telemetry.changed()
+            telemetry.write()
+            self.assertFalse(telemetry._flush['dirty'])
+        finally:
+            defaults.telemetry_dir = telemetry_dir
+            telemetry.stop()
+        self.assertEqual(metric_values()['dashbard_cache_entries{cache="test"}'], 1)
+        
+    def testWriterStops(self):
+        "The writer thread ends once there is no telemetry_dir any more, and starts again when there is."
+        import os
+        import telemetry
+        counter = telemetry.counter('test_worker_total', 'Worker things.')
+        telemetry_dir, flush_seconds = defaults.telemetry_dir, defaults.telemetry_flush_seconds
+        defaults.telemetry_dir, defaults.telemetry_flush_seconds = self.dir, 0.01
+        try:
+            counter.inc()
+            writer = telemetry._flush['writer']
+            self.assertEqual(telemetry._flush['pid'], os.getpid())
+            defaults.telemetry_dir = None
+            writer.join(5)
+            self.assertFalse(writer.isAlive())
+            self.assertEqual(telemetry._flush['pid'], None)
+            defaults.telemetry_dir = self.dir
+            counter.inc()
+            self.assertTrue(telemetry._flush['writer'] is not writer and telemetry._flush['writer'].isAlive())
+        finally:
+            defaults.telemetry_dir, defaults.telemetry_flush_seconds = telemetry_dir, flush_seconds
+            telemetry.stop()
+        self.assertEqual(telemetry._flush['writer'], None)
+        
+    def testRequests(self):
+        import base64
+        import diffcache
+        client = Client()
+        client.login(username = 'Shabda', password = 'shabda')
+        before = metric_values()
+        client.get('/Foo/tasks/')
+        client.get('/Foo/tasks/', {'csv': 1})
+        diffcache.compute_diff('one two', 'one three')
+        values = metric_values()
+        def grew(name):
+            return values.get(name, 0) - before.get(name, 0)
+        self.assertEqual(grew('dashbard_request_seconds_count{view="project.tasks.project_tasks",format="html"}'), 1)
+        self.assertEqual(grew('dashbard_request_seconds_count{view="project.tasks.project_tasks",format="csv"}'), 1)
+        self.assertEqual(grew('dashbard_requests_total{view="project.tasks.project_tasks",status="200"}'), 2)
+        self.assertEqual(grew('dashbard_render_seconds_count{template="project/projecttask.html"}'), 1)
+        self.assertEqual(grew('dashbard_csv_exports_total'), 1)
+        self.assertEqual(grew('dashbard_diff_seconds_count{engine="char"}'), 1)
+        self.assertTrue('dashbard_cache_entries{cache="fragment"}' in values)
+        self.assertEqual(client.get('/metrics/').status_code, 401)
+        self.user.is_staff = True
+        self.user.save()
+        response = Client().get('/metrics/', HTTP_AUTHORIZATION = 'Basic ' + base64.b64encode('Shabda:shabda'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertTrue('# TYPE dashbard_request_seconds histogram' in response.content)
+        
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+        self.user.delete()
+        self.project.delete()
+        
+class TestTracing(unittest.TestCase):
+    
+    def setUp(self):
+        import tempfile
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        seed_project(project, user, 2)
+        self.trace_file = tempfile.mktemp()
+        self.saved = defaults.trace_output, defaults.trace_sample_rate, defaults.query_sample_rate
+        #The spans have the queries of the request when dbinstrument times all of them.
+        defaults.query_sample_rate = 1.0
+        
+    def testSpans(self):
+        import threading
+        import tracing
+        @tracing.traced('work', kind = 'test')
+        def work():
+            with tracing.span('inner') as inner:
+                inner.set(size = 3)
+        self.assertTrue(tracing.span('outside') is tracing._no_span)
+        root = tracing.start('root')
+        work()
+        parent = tracing.current()
+        def in_thread():
+            with tracing.attach(parent):
+                with tracing.span('thread'):
+                    pass
+        thread = threading.Thread(target = in_thread)
+        thread.start()
+        thread.join()
+        try:
+            with tracing.span('failing'):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(tracing.finish(done = True) is root)
+        self.assertEqual(tracing.current(), None)
+        data = root.as_dict(root.start)
+        self.assertEqual([child['name'] for child in data['children']], ['work', 'thread', 'failing'])
+        self.assertEqual(data['children'][0]['attrs'], {'kind': 'test', 'function': 'work'})
+        self.assertEqual(data['children'][0]['children'][0]['attrs'], {'size': 3})
+        self.assertEqual(data['children'][2]['attrs'], {'error': 'ValueError'})
+        self.assertEqual(data['attrs'], {'done': True})
+        self.assertTrue(data['duration_ms'] >= data['children'][0]['duration_ms'] >= 0)
+        #A span too quick for the clock took 0ms, not an unknown time.
+        quick = tracing.Span('quick', {})
+        quick.duration = 0.0
+        self.assertEqual(quick.as_dict(quick.start)['duration_ms'], 0.0)
+        
+    def testStages(self):
+        import diffcache
+        import tracing
+        root = tracing.start('test')
+        self.assertEqual(self.project.num_deadline_miss(), 0)
+        diffcache.compute_diff('one two', 'one three')
+        tracing.finish()
+        sql, diff = root.as_dict(root.start)['children']
+        self.assertEqual((sql['name'], sql['attrs']['function']), ('sql', 'num_deadline_miss'))
+        self.assertEqual((diff['name'], diff['attrs']), ('diff', {'engine': 'char', 'chars': 16}))
+        
+    def testRequestTrace(self):
+        "Sampled requests are written with their spans."
+        from django.utils import simplejson
+        defaults.trace_output = self.trace_file
+        defaults.trace_sample_rate = 1
+        client = Client()
+        client.login(username = 'Shabda', password = 'shabda')
+        client.get('/Foo/tasks/')
+        client.get('/Foo/tasks/', {'csv': 1})
+        defaults.trace_sample_rate = 0
+        client.get('/Foo/tasks/')
+        traces = [simplejson.loads(line) for line in open(self.trace_file)]
+        self.assertEqual(len(traces), 2)
+        tasks, export = traces
+        self.assertEqual((tasks['name'], tasks['attrs']['view'], tasks['attrs']['status']), ('request', 'project.tasks.project_tasks', 200))
+        render = [child for child in tasks['children'] if child['name'] == 'render'][0]
+        self.assertEqual(render['attrs']['template'], 'project/projecttask.html')
+        self.assertTrue(render['attrs']['queries'] >= 0)
+        self.assertEqual((export['attrs']['path'], export.get('children')), ('/Foo/tasks/', None))
+        
+    def testRequestQueries(self):
+        "Traced requests time their queries when dbinstrument did not sample them, and no trace is left over."
+        import dbinstrument
+        import tracing
+        from django.utils import simplejson
+        defaults.trace_output = self.trace_file
+        defaults.trace_sample_rate = 1
+        defaults.query_sample_rate = 0
+        client = Client()
+        client.login(username = 'Shabda', password = 'shabda')
+        requests = lambda: sum(stats.requests for stats in dbinstrument.stats())
+        before = requests()
+        client.get('/Foo/tasks/')
+        self.assertEqual(dbinstrument.current(), None)
+        self.assertEqual(requests(), before)
+        trace = simplejson.loads(open(self.trace_file).readlines()[-1])
+        self.assertEqual(trace['attrs']['path'], '/Foo/tasks/')
+        render = [child for child in trace['children'] if child['name'] == 'render'][0]
+        self.assertTrue(render['attrs']['queries'] >= 0)
+        #The spans of a request which is not traced do not go under a root left by an earlier one.
+        defaults.trace_sample_rate = 0
+        stale = tracing.start('stale')
+        client.get('/Foo/tasks/')
+        self.assertEqual((tracing.current(), stale.children), (None, []))
+        
+    def tearDown(self):
+        import os
+        defaults.trace_output, defaults.trace_sample_rate, defaults.query_sample_rate = self.saved
+        if os.path.exists(self.trace_file):
+            os.remove(self.trace_file)
+        self.user.delete()
+        self.project.delete()
+        
+class TestProfiler(unittest.TestCase):
+    
+    def setUp(self):
+        import tempfile
+        import profiler
+        user = User.objects.create_user('Shabda', 'Shabda@gmail.com', 'shabda')
+        user.is_staff = True
+        user.save()
+        self.user = user
+        project = Project(shortname = 'Foo', name='Bar bax baz', owner = self.user, start_date = datetime.date.today())
+        project.save()
+        self.project = project
+        subs = SubscribedUser(user = user, project = self.project, group = 'Owner')
+        subs.save()
+        seed_project(project, user, 2)
+        self.saved = defaults.profile_dir, defaults.profile_sample_interval, defaults.profile_max_per_minute
+        defaults.profile_dir = tempfile.mkdtemp()
+        defaults.profile_sample_interval = 0.001
+        profiler._started.clear()
+        self.client = Client()
+        self.client.login(username = 'Shabda', password = 'shabda')
+        
+    def testProfile(self):
+        "A request with a token is profiled, and answered as usual."
+        import os
+        import pstats
+        import profiler
+        response = self.client.get('/Foo/tasks/', {'_profile': profiler.profile_token(self.user)})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('Task 0' in response.content)
+        name = response['X-Profile']
+        self.assertTrue(name.endswith('-project.tasks.project_tasks-%s' % os.getpid()))
+        path = os.path.join(defaults.profile_dir, name)
+        stats = pstats.Stats(path + '.prof')
+        self.assertTrue([function for function in stats.stats if function[2] == 'project_tasks'])
+        for line in open(path + '.collapsed'):
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(int(count) > 0 and stack, line)
+        self.assertTrue('project_tasks (tasks.py:' in open(path + '.collapsed').read())
+        
+    def testTokens(self):
+        "Requests without a good token for a staff user are not profiled."
+        import os
+        import profiler
+        other = User.objects.create_user('Other', 'other@example.com', 'other')
+        try:
+            for token in (None, 'nonsense', profiler.profile_token(other), profiler.profile_token(self.user) + 'x'):
+                response = self.client.get('/Foo/tasks/', token and {'_profile': token} or {})
+                self.assertEqual(response.status_code, 200)
+                self.assertFalse(response.has_header('X-Profile'))
+        finally:
+            other.delete()
+        self.assertEqual(os.listdir(defaults.profile_dir), [])
+        response = self.client.get('/Foo/tasks/', HTTP_X_PROFILE_TOKEN = profiler.profile_token(self.user))
+        self.assertTrue(response.has_header('X-Profile'))
+        
+    def testRateLimit(self):
+        import profiler
+        defaults.profile_max_per_minute = 1
+        token = profiler.profile_token(self.user)
+        self.assertNotEqual(self.client.get('/Foo/tasks/', {'_profile': token})['X-Profile'], 'busy')
+        self.assertEqual(self.client.get('/Foo/tasks/', {'_profile': token})['X-Profile'], 'busy')
+        self.assertEqual(profiler._running, [0])
+        
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(defaults.profile_dir)
+        defaults.profile_dir, defaults.profile_sample_interval, defaults.profile_max_per_minute = self.saved
+        self.user.delete()
+        self.project.delete()
+        
 #Test that correct view gets called on URLs
 # class TestUrls(unittest.TestCase):
 #     def setUp(self):
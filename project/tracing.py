@@ -0,0 +1,190 @@
+"""Traces of requests: a tree of timed spans, to see where the time of a slow page went.
+
+    with tracing.span('pdf', template = name):
+        ...
+
+    @tracing.traced('sql')
+    def num_deadline_miss(self):
+        ...
+
+TracingMiddleware samples defaults.trace_sample_rate of the requests. A sampled request gets a root span, and
+the spans opened while it runs nest under the span which is open at the time. When the request took
+defaults.trace_min_seconds or more its trace is written as a line of json to defaults.trace_output, a file or
+'stdout'. Spans also have the number of queries and the database time they saw, dbinstrument times the queries
+of a sampled request when it was not timing them already. Outside of a sampled request span() only hands back a
+span which does nothing.
+Work done for the request on other threads, like the S3 transfers, joins its trace with attach(current()).
+"""
+import functools
+import random
+import sys
+import threading
+import time
+import uuid
+
+from django.utils import simplejson
+
+import dbinstrument
+import defaults
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+class Span(object):
+    def __init__(self, name, attrs, parent = None):
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.start = time.time()
+        self.duration = None
+        if parent is not None:
+            parent.children.append(self)
+        self.queries = dbinstrument.current()
+        if self.queries is not None:
+            self.queries_start = self.queries.count, self.queries.seconds
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def close(self):
+        self.duration = time.time() - self.start
+        if self.queries is not None and self.queries is dbinstrument.current():
+            self.attrs['queries'] = self.queries.count - self.queries_start[0]
+            self.attrs['db_ms'] = round((self.queries.seconds - self.queries_start[1]) * 1000, 3)
+
+    def __enter__(self):
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.close()
+        stack = getattr(_local, 'stack', None)
+        if stack and stack[-1] is self:
+            stack.pop()
+
+    def as_dict(self, origin):
+        data = {'name': self.name, 'start_ms': round((self.start - origin) * 1000, 3),
+                'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None}
+        if self.attrs:
+            data['attrs'] = self.attrs
+        if self.children:
+            data['children'] = [child.as_dict(origin) for child in self.children]
+        return data
+
+class NoSpan(object):
+    """What span() gives when nothing is traced."""
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_no_span = NoSpan()
+
+def current():
+    """The innermost open span of this thread, or None when it is not tracing."""
+    stack = getattr(_local, 'stack', None)
+    return stack and stack[-1] or None
+
+def span(name, **attrs):
+    """A span under the current one, to use with with."""
+    parent = current()
+    if parent is None:
+        return _no_span
+    return Span(name, attrs, parent)
+
+def traced(name, **attrs):
+    """Decorator putting the calls of a function in spans, with the name of the function as an attribute."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            parent = current()
+            if parent is None:
+                return func(*args, **kwargs)
+            with Span(name, dict(attrs, function = func.__name__), parent):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class attach(object):
+    """Context manager which has the spans of this thread go under span, from the thread it was handed over by."""
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        self.saved = getattr(_local, 'stack', None)
+        _local.stack = self.span is not None and [self.span] or None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.stack = self.saved
+
+def start(name, **attrs):
+    """Start the trace of this thread, with its root span."""
+    root = Span(name, attrs)
+    _local.stack = [root]
+    return root
+
+def finish(**attrs):
+    """End the trace of this thread, and write it out when it was slow enough. Returns its root span, or None."""
+    stack = getattr(_local, 'stack', None)
+    _local.stack = None
+    if not stack:
+        return None
+    root = stack[0]
+    root.attrs.update(attrs)
+    for open_span in reversed(stack):
+        open_span.close()
+    if defaults.trace_output and root.duration >= defaults.trace_min_seconds:
+        export(root)
+    return root
+
+def export(root):
+    data = root.as_dict(root.start)
+    data['trace_id'] = uuid.uuid4().hex
+    data['time'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(root.start))
+    line = simplejson.dumps(data) + '\n'
+    with _write_lock:
+        try:
+            if defaults.trace_output == 'stdout':
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            else:
+                f = open(defaults.trace_output, 'a')
+                try:
+                    f.write(line)
+                finally:
+                    f.close()
+        except IOError:
+            #A trace is not worth failing the request for.
+            pass
+
+class TracingMiddleware(object):
+    """Put it after QueryCountMiddleware, so the spans see the queries of the request."""
+    def process_request(self, request):
+        #A request which failed before process_response must not leave its spans to this one.
+        _local.stack = None
+        if defaults.trace_output and random.random() < defaults.trace_sample_rate:
+            request._timing_queries = dbinstrument.current() is None
+            if request._timing_queries:
+                dbinstrument.start()
+            start('request', method = request.method, path = request.path)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stack = getattr(_local, 'stack', None)
+        if stack:
+            stack[0].attrs['view'] = dbinstrument.view_name(view_func)
+
+    def process_response(self, request, response):
+        finish(status = response.status_code)
+        if getattr(request, '_timing_queries', False):
+            #Only the requests QueryCountMiddleware sampled go into the stats of the views.
+            queries = dbinstrument.current()
+            if queries is not None:
+                queries.view = None
+            dbinstrument.stop()
+        return response
@@ -0,0 +1,200 @@
+"""Parallel S3 transfers, with timeouts, retries and metrics.
+
+A TransferManager runs uploads, deletes and bucket listings on a bounded pool of threads. Submitting
+returns a Transfer right away; its result() waits for the operation. Every S3 request of an operation is
+retried on network errors, timeouts and 5xx answers, after an exponential backoff with full jitter, and
+the latency and bytes of each request are counted per operation, see stats(), and in the telemetry.
+Requests time out as set on the AWSAuthConnection the manager is given.
+"""
+import httplib
+import random
+import socket
+import threading
+import time
+import Queue
+
+import S3
+import telemetry
+import tracing
+
+s3_seconds = telemetry.histogram('dashbard_s3_request_seconds', 'Time of S3 requests, by operation.', ('operation',))
+s3_requests = telemetry.counter('dashbard_s3_requests_total', 'S3 requests, by operation and whether they failed.', ('operation', 'result'))
+s3_retries = telemetry.counter('dashbard_s3_retries_total', 'S3 requests sent again after a failure.', ('operation',))
+s3_bytes = telemetry.counter('dashbard_s3_bytes_total', 'Bytes sent to and read from S3.', ('operation',))
+
+class TransferError(Exception):
+    pass
+
+#Errors worth another try. socket.timeout is a socket.error.
+RETRYABLE_ERRORS = (socket.error, httplib.HTTPException)
+
+class Transfer(object):
+    """An operation submitted to a TransferManager."""
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.finished.isSet()
+
+    def result(self, timeout = None):
+        """Wait for the operation and return its result, or raise its error."""
+        if not self.finished.wait(timeout):
+            raise TransferError('The transfer did not finish in %s seconds.' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class TransferManager(object):
+    """Runs S3 operations on threads threads. At most queue_size operations wait for a thread, submitting more blocks.
+    retries: How many times a failed request is sent again.
+    backoff, max_backoff: The wait before retry n is random, up to min(max_backoff, backoff * 2 ** n) seconds."""
+
+    def __init__(self, conn, threads = 4, retries = 3, backoff = 0.2, max_backoff = 5.0, queue_size = None):
+        self.conn = conn
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tasks = Queue.Queue(queue_size or threads * 4)
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(threads):
+            worker = threading.Thread(target = self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, func, *args):
+        """Run func(*args) on the pool. Returns its Transfer."""
+        transfer = Transfer()
+        self.tasks.put((transfer, func, args, tracing.current()))
+        return transfer
+
+    def shutdown(self):
+        """Finish the submitted operations and stop the threads."""
+        for worker in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            transfer, func, args, span = task
+            try:
+                with tracing.attach(span):
+                    transfer.value = func(*args)
+            except Exception, e:
+                transfer.error = e
+            transfer.finished.set()
+
+    def upload(self, bucket, key, data):
+        """Put data under key."""
+        return self.submit(self.call, 'upload', lambda: self.conn.put(bucket, key, data), len(data))
+
+    def upload_file(self, bucket, key, uploaded, multipart_threshold, part_size, threads):
+        """Put an uploaded file under key. Files of multipart_threshold bytes or more are streamed in parts."""
+        if uploaded.size < multipart_threshold:
+            return self.upload(bucket, key, ''.join(uploaded.chunks()))
+        uploader = S3.MultipartUploader(self.conn, bucket, key, part_size = part_size, threads = threads, retries = self.retries)
+        return self.submit(self._timed, 'multipart_upload', lambda: uploader.upload(uploaded.chunks()), uploaded.size)
+
+    def delete(self, bucket, keys):
+        """Delete the keys, in requests of up to S3.MAX_DELETE_KEYS keys which run in parallel. Returns a Transfer per request.
+        The result of each is its S3.DeleteObjectsResponse, whose errors are the keys S3 did not delete."""
+        keys = list(keys)
+        transfers = []
+        for start in range(0, len(keys), S3.MAX_DELETE_KEYS):
+            chunk = keys[start:start + S3.MAX_DELETE_KEYS]
+            transfers.append(self.submit(self.call, 'delete', lambda chunk = chunk: self.conn.delete_objects(bucket, chunk)[0]))
+        return transfers
+
+    def list(self, bucket, prefix = ''):
+        """List the keys starting with prefix, following the pages of the listing. The result is a list of S3.ListEntry."""
+        return self.submit(self._list, bucket, prefix)
+
+    def _list(self, bucket, prefix):
+        entries = []
+        marker = ''
+        while True:
+            options = {'prefix': prefix}
+            if marker:
+                options['marker'] = marker
+            response = self.call('list', lambda: self.conn.list_bucket(bucket, options))
+            entries.extend(response.entries)
+            if not response.is_truncated or not response.entries:
+                return entries
+            marker = response.next_marker or response.entries[-1].key
+
+    def call(self, operation, request, nbytes = 0):
+        """Send request(), an S3 call returning a Response, retrying it when it fails in a way which may pass.
+        nbytes: Bytes sent with the request, for the metrics."""
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.record(operation, retried = True)
+                time.sleep(self.delay(attempt))
+            start = time.time()
+            try:
+                response = request()
+            except RETRYABLE_ERRORS, e:
+                self.record(operation, time.time() - start, failed = True)
+                error = e
+                continue
+            status = response.http_response.status
+            self.record(operation, time.time() - start, nbytes + len(response.body), failed = status >= 300)
+            if status >= 500:
+                error = response.message
+                continue
+            if status >= 300:
+                raise TransferError('%s failed: %s' % (operation, response.message))
+            return response
+        raise TransferError('%s failed after %s attempts: %s' % (operation, self.retries + 1, error))
+
+    def _timed(self, operation, func, nbytes = 0):
+        """Run func, which does its own retries, counting it in the metrics."""
+        start = time.time()
+        try:
+            result = func()
+        except:
+            self.record(operation, time.time() - start, failed = True)
+            raise
+        self.record(operation, time.time() - start, nbytes)
+        return result
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def record(self, operation, seconds = 0.0, nbytes = 0, failed = False, retried = False):
+        if retried:
+            s3_retries.inc(operation = operation)
+        else:
+            s3_seconds.observe(seconds, operation = operation)
+            s3_requests.inc(operation = operation, result = failed and 'failed' or 'ok')
+            s3_bytes.inc(nbytes, operation = operation)
+        self.lock.acquire()
+        try:
+            metrics = self.metrics.setdefault(operation, {'requests': 0, 'failures': 0, 'retries': 0, 'bytes': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            if retried:
+                metrics['retries'] += 1
+                return
+            metrics['requests'] += 1
+            metrics['failures'] += failed and 1 or 0
+            metrics['bytes'] += nbytes
+            metrics['seconds'] += seconds
+            metrics['max_seconds'] = max(metrics['max_seconds'], seconds)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Metrics per operation: requests, failures, retries, bytes, and total and worst seconds per request."""
+        self.lock.acquire()
+        try:
+            return dict((operation, metrics.copy()) for operation, metrics in self.metrics.items())
+        finally:
+            self.lock.release()
@@ -13,6 +13,11 @@ urlpatterns = patterns('project.foo',
     (r'^projson/(?P<project_name>\w+)/$', 'proj_json')
     )
 
+urlpatterns += patterns('project.metrics',
+    (r'^querystats/$', 'query_stats'),
+    (r'^metrics/$', 'metrics_text'),
+    )
+
 urlpatterns += patterns('project.users',
     (r'^accounts/login/$', 'login'),
     (r'^accounts/logout/$', 'logout'),
@@ -31,7 +36,7 @@ feeds = {
     'project': ProjectRss,
 }
 urlpatterns += patterns('',
-    (r'^feeds/(?P<url>.*)/$', 'django.contrib.syndication.views.Feed', {'feed_dict': feeds}),
+    (r'^feeds/(?P<url>.*)/$', 'project.rss.proj_feed', {'feed_dict': feeds}),
     (r'^feeds2/(?P<url>.*)/$', 'project.rss.proj_feed', {'feed_dict': feeds}),
     )
 
@@ -52,6 +57,7 @@ urlpatterns += patterns('project.tasks',
     (r'^(?P<project_name>\w+)/taskhier/$', 'task_hierachy'),
     (r'^(?P<project_name>\w+)/tasks/quickentry/$', 'tasks_quickentry'),
     (r'^(?P<project_name>\w+)/taskitems/quickentry/$', 'taskitems_quickentry'),
+    (r'^(?P<project_name>\w+)/tasks/import/$', 'tasks_import'),
     (r'^(?P<project_name>\w+)/taskdetails/(?P<task_num>\d+)/$', 'task_details'),
     (r'^(?P<project_name>\w+)/taskhistory/(?P<task_num>\d+)/$', 'task_history'),
     (r'^(?P<project_name>\w+)/taskdetails/(?P<task_num>\d+)/addnote/$', 'add_task_note'),
@@ -77,8 +83,13 @@ urlpatterns += patterns('project.metrics',
     (r'^(?P<project_name>\w+)/userstats/$', 'user_stats'),
     )
 
+urlpatterns += patterns('project.search',
+    (r'^(?P<project_name>\w+)/search/$', 'search'),
+    )
+
 urlpatterns += patterns('project.files',
     (r'^(?P<project_name>\w+)/files/$', 'files'),
+    (r'^(?P<project_name>\w+)/files/(?P<revision_id>\d+)/download/$', 'download'),
     )
 
 urlpatterns += patterns('project.pcalendar',
@@ -10,6 +10,7 @@ from models import *
 from prefs.models import *
 import bforms
 import userforms
+import rows
 from django.contrib.auth import REDIRECT_FIELD_NAME
 
 @login_required
@@ -131,6 +132,8 @@ def user_details(request, project_name, username):
     else:
         tasks = project.task_set.filter(user_responsible = user, is_complete = False)
         items = project.taskitem_set.filter(user = user, is_complete = False)
+    tasks = rows.task_rows(tasks)
+    items = rows.taskitem_rows(items)
     if request.POST.has_key('markdone') or request.POST.has_key('markundone'):
         if request.POST.has_key('xhr'):
             return handle_task_status(request, True)
@@ -4,8 +4,7 @@ from django.contrib.auth.decorators import login_required
 from helpers import *
 from models import *
 import bforms
-import diff_match_patch
-from html2text import html2text
+import diffcache
 
 def wiki(request, project_name):
     """Shows recently created pages.
@@ -102,10 +101,7 @@ def wikipage_diff(request, project_name, page_name):
     if version1 and version2:
         rev1 = WikiPageRevision.objects.get(wiki_page = page, id = version1)
         rev2 = WikiPageRevision.objects.get(wiki_page = page, id = version2)
-        app = diff_match_patch.diff_match_patch()
-        diff = app.diff_main(html2text(rev1.html_text), html2text(rev2.html_text))
-        app.diff_cleanupSemantic(diff)
-        htmldiff = app.diff_prettyHtml(diff)
+        htmldiff = diffcache.wiki_diff(rev1, rev2)
         payload = {'project':project, 'page':page, 'revision1':rev1, 'revision2':rev2, 'htmldiff': htmldiff}
         return render(request, 'project/wikidiffresult.html', payload)
     else:
@@ -80,6 +80,9 @@ STATICFILES_FINDERS = (
 #    'django.contrib.staticfiles.finders.DefaultStorageFinder',
 )
 MIDDLEWARE_CLASSES = (
+    'project.telemetry.TelemetryMiddleware',
+    'project.dbinstrument.QueryCountMiddleware',
+    'project.tracing.TracingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -87,6 +90,8 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.doc.XViewMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
+    'project.identitymap.IdentityMapMiddleware',
+    'project.profiler.ProfilerMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -144,6 +149,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'WARNING',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -152,6 +161,18 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'project.slowqueries': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'project.storage': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'project.telemetry': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
     }
 }
 